@@ -2,4 +2,24 @@
 
 __version__ = "0.1.0"
 
-__all__ = ["console", "drivers", "exceptions", "logging", "projects", "utils"]
+__all__ = [
+    "artifacts",
+    "benchmark",
+    "cache",
+    "compdb",
+    "config",
+    "console",
+    "daemon",
+    "depgraph",
+    "drivers",
+    "exceptions",
+    "logging",
+    "packages",
+    "profiling",
+    "projects",
+    "remote",
+    "scheduler",
+    "sources",
+    "testing",
+    "utils",
+]
@@ -0,0 +1,316 @@
+"""Cache of prebuilt libraries of dependency packages."""
+
+import errno
+import hashlib
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+from .cache import DEFAULT_CACHE_SIZE, EVICTION_RATIO
+from .logging import logger
+from .utils import Pathlike
+
+# Bump this when the layout of archives or the key changes.
+ARTIFACT_VERSION = 1
+
+# Suffix of the archives
+ARCHIVE_SUFFIX = ".tar.gz"
+
+# Seconds to wait for the remote tier
+REMOTE_TIMEOUT = 30.0
+
+
+def artifact_key(*parts: str) -> str:
+    """Combine the parts identifying a build into a key."""
+    h = hashlib.sha256(str(ARTIFACT_VERSION).encode())
+    for part in parts:
+        h.update(b"\0")
+        h.update(part.encode())
+    return h.hexdigest()
+
+
+def _link_or_copy(src: pathlib.Path, dest: pathlib.Path) -> None:
+    """Replace dest with a hardlink to src, or a copy across file systems."""
+    tmp = dest.with_name("." + dest.name + ".tmp")
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+def _is_inside(directory: pathlib.Path, path: pathlib.Path) -> bool:
+    """Check if path is below directory, with .. and links resolved."""
+    directory_real = os.path.realpath(directory)
+    path_real = os.path.realpath(path)
+    return path_real != directory_real and (
+        os.path.commonpath([directory_real, path_real]) == directory_real
+    )
+
+
+def _tree_size(directory: str) -> int:
+    """Total size of the files below directory."""
+    size = 0
+    for (dirpath, _, filenames) in os.walk(directory):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class ArtifactCache:
+    """
+    Prebuilt outputs of packages, packed into compressed archives.
+
+    Archives are stored as archives/<key[:2]>/<key>.tar.gz under the
+    directory, and unpacked once into unpacked/<key>, from which hits are
+    hardlinked into the build directories of projects. Unpacked files are
+    read-only, builds replace their outputs instead of writing into them.
+
+    A remote tier shared by machines may be given as a directory, like a
+    network mount, or an HTTP server answering GET and PUT of
+    <remote>/<key>.tar.gz. Archives are fetched from the remote on local
+    misses and uploaded when stored. A remote failing only logs a warning.
+
+    The mtime of an archive is the last used time of the artifact, the
+    least recently used ones are evicted with their unpacked files when the
+    local directory grows over the size limit.
+    """
+
+    def __init__(
+        self,
+        directory: Pathlike,
+        remote: Optional[str] = None,
+        max_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        """
+        Initialize the cache in directory, created when needed.
+
+        Args:
+            directory: The local directory of the cache.
+            remote: The remote tier, a directory or an http(s) url.
+            max_size: The size limit of the local directory, in bytes.
+        """
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.remote = remote.rstrip("/") if remote else None
+        if self.remote and self.remote.startswith("file://"):
+            self.remote = self.remote[len("file://"):]
+        self.hits = 0
+        self.misses = 0
+
+    def _archive(self, key: str) -> pathlib.Path:
+        return self.directory / "archives" / key[:2] / (key + ARCHIVE_SUFFIX)
+
+    def _is_http(self) -> bool:
+        return (self.remote or "").split(":")[0] in ("http", "https")
+
+    def _download(self, key: str, archive: pathlib.Path) -> bool:
+        """Fetch the archive of key from the remote, returns if found."""
+        if not self.remote:
+            return False
+        name = key + ARCHIVE_SUFFIX
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=archive.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if self._is_http():
+                    url = "{}/{}".format(self.remote, name)
+                    with urllib.request.urlopen(
+                        url, timeout=REMOTE_TIMEOUT
+                    ) as response:
+                        shutil.copyfileobj(response, f)
+                else:
+                    with open(os.path.join(str(self.remote), name), "rb") as r:
+                        shutil.copyfileobj(r, f)
+            os.replace(tmp, archive)
+        except (FileNotFoundError, urllib.error.HTTPError) as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code != 404:
+                logger.warning("Remote artifact cache: {}".format(e))
+            return False
+        except OSError as e:
+            logger.warning("Remote artifact cache: {}".format(e))
+            return False
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        logger.debug("Downloaded {} from {}.".format(name, self.remote))
+        return True
+
+    def _upload(self, key: str, archive: pathlib.Path) -> None:
+        if not self.remote:
+            return
+        name = key + ARCHIVE_SUFFIX
+        try:
+            if self._is_http():
+                request = urllib.request.Request(
+                    "{}/{}".format(self.remote, name),
+                    data=archive.read_bytes(),
+                    method="PUT",
+                )
+                urllib.request.urlopen(request, timeout=REMOTE_TIMEOUT).close()
+            else:
+                os.makedirs(str(self.remote), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=self.remote, suffix=".tmp")
+                os.close(fd)
+                shutil.copyfile(archive, tmp)
+                os.replace(tmp, os.path.join(str(self.remote), name))
+        except OSError as e:
+            logger.warning("Remote artifact cache: {}".format(e))
+
+    def _unpack(self, key: str) -> Optional[pathlib.Path]:
+        """Unpack the archive of key, returns the directory or None."""
+        unpacked = self.directory / "unpacked" / key
+        if unpacked.exists():
+            return unpacked
+        archive = self._archive(key)
+        if not archive.exists() and not self._download(key, archive):
+            return None
+        unpacked.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=unpacked.parent))
+        try:
+            with tarfile.open(archive, "r:gz") as tar:
+                for member in tar.getmembers():
+                    # Only plain files below the directory are expected,
+                    # archives of the remote tier may be written by anyone.
+                    if not member.isfile() or not _is_inside(
+                        tmp, tmp / member.name
+                    ):
+                        raise tarfile.TarError(
+                            "Bad member {}.".format(member.name)
+                        )
+                    tar.extract(member, tmp)
+                    os.chmod(tmp / member.name, member.mode & 0o555)
+            os.rename(tmp, unpacked)
+        except (OSError, tarfile.TarError) as e:
+            if not unpacked.exists():
+                logger.warning("Ignored broken {}: {}".format(archive, e))
+                archive.unlink()
+                return None
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return unpacked
+
+    def fetch(self, key: str, dest: pathlib.Path, files: List[str]) -> bool:
+        """
+        Link the cached files of key into dest.
+
+        Args:
+            key: The key from artifact_key.
+            dest: The directory the files are built in.
+            files: Paths of the files relative to dest.
+
+        Returns: If all the files are cached.
+        """
+        unpacked = self._unpack(key)
+        if unpacked is None or not all(
+            (unpacked / x).is_file() for x in files
+        ):
+            self.misses += 1
+            return False
+        for name in files:
+            (dest / name).parent.mkdir(parents=True, exist_ok=True)
+            _link_or_copy(unpacked / name, dest / name)
+        try:
+            os.utime(self._archive(key))
+        except FileNotFoundError:  # Evicted by someone else.
+            pass
+        self.hits += 1
+        return True
+
+    def store(self, key: str, base: pathlib.Path, files: List[str]) -> None:
+        """Pack files relative to base as the artifact of key."""
+        archive = self._archive(key)
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=archive.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                    for name in files:
+                        tar.add(base / name, name, recursive=False)
+            os.replace(tmp, archive)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        logger.debug("Stored artifact {}.".format(key))
+        self._upload(key, archive)
+        self.evict()
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """List last used time, size and key of all the local artifacts."""
+        used: Dict[str, float] = {}
+        sizes: Dict[str, int] = {}
+        archives = self.directory / "archives"
+        for d in os.scandir(archives) if archives.is_dir() else []:
+            if d.is_dir():
+                for x in os.scandir(d.path):
+                    if x.name.endswith(ARCHIVE_SUFFIX):
+                        st = x.stat()
+                        key = x.name[: -len(ARCHIVE_SUFFIX)]
+                        used[key] = st.st_mtime
+                        sizes[key] = st.st_size
+        unpacked = self.directory / "unpacked"
+        for x in os.scandir(unpacked) if unpacked.is_dir() else []:
+            # Directories being unpacked are named tmp*, never like a key.
+            if x.is_dir() and not x.name.startswith("tmp"):
+                used.setdefault(x.name, x.stat().st_mtime)
+                sizes[x.name] = sizes.get(x.name, 0) + _tree_size(x.path)
+        return [(used[x], sizes[x], x) for x in used]
+
+    def stats(self) -> Dict[str, int]:
+        """Statistics of the local directory of the cache."""
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "size": sum(x[1] for x in entries),
+            "max_size": self.max_size,
+        }
+
+    def evict(self, max_size: Optional[int] = None) -> int:
+        """
+        Remove the least recently used artifacts until under max_size.
+
+        Files already linked into build directories stay there.
+
+        Args:
+            max_size: Defaults to the size limit of the cache.
+
+        Returns: Number of removed artifacts.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        size = sum(x[1] for x in entries)
+        if size <= max_size:
+            return 0
+        target = int(max_size * EVICTION_RATIO)
+        removed = 0
+        for (_, artifact_size, key) in sorted(entries):
+            if size <= target:
+                break
+            try:
+                os.unlink(self._archive(key))
+            except FileNotFoundError:  # Evicted by someone else.
+                pass
+            shutil.rmtree(
+                self.directory / "unpacked" / key, ignore_errors=True
+            )
+            size -= artifact_size
+            removed += 1
+        logger.debug("Evicted {} artifacts from the cache.".format(removed))
+        return removed
+
+    def clean(self) -> None:
+        """Remove everything in the local directory of the cache."""
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
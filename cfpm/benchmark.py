@@ -0,0 +1,197 @@
+"""Benchmarks of clean, no-op and incremental builds."""
+
+import os
+import pathlib
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional
+from .drivers import CLIDriver, exit_code
+from .exceptions import ExternalProgramError
+
+# Bump this when the format of the results changes.
+RESULTS_VERSION = 1
+
+# Builds measured in each round, in order
+SCENARIOS = ["clean", "noop", "touch"]
+
+# Default ratio a result may exceed its baseline by
+DEFAULT_TOLERANCE = 0.1
+
+# Program started by the spawn microbenchmark
+SPAWN_PROGRAM = "true"
+
+
+class Measurement(NamedTuple):
+    """Wall time and peak resident set size of a build."""
+
+    seconds: float
+    # In KiB, of cfpm or the largest compiler it waited for
+    max_rss: int
+
+
+def measure_build(
+    package_dir: pathlib.Path, args: List[str], env: Dict[str, str]
+) -> Measurement:
+    """
+    Build the package in a new cfpm process and measure it.
+
+    Raise an ExternalProgramError if the build failed.
+    """
+    cfpm_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(env)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [cfpm_dir] + [x for x in [env.get("PYTHONPATH")] if x]
+    )
+    command = [sys.executable, "-m", "cfpm.console", "build", "--no-daemon"]
+    # A file instead of a pipe, which would block before the process is
+    # waited for.
+    with tempfile.TemporaryFile() as output:
+        start = time.monotonic()
+        process = subprocess.Popen(
+            command + args,
+            cwd=str(package_dir),
+            env=env,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+        # Reaped already, don't let Popen wait for it.
+        process.returncode = exit_code(status)
+        if process.returncode != 0:
+            output.seek(0)
+            raise ExternalProgramError(
+                "Failed to build {} (exit code {}):\n{}".format(
+                    package_dir,
+                    process.returncode,
+                    output.read().decode(errors="replace"),
+                )
+            )
+    max_rss = usage.ru_maxrss
+    if sys.platform == "darwin":  # Bytes instead of KiB
+        max_rss //= 1024
+    return Measurement(seconds, max_rss)
+
+
+def _summarize(measurements: List[Measurement]) -> Dict:
+    seconds = [x.seconds for x in measurements]
+    return {
+        "seconds": seconds,
+        "median": statistics.median(seconds),
+        "min": min(seconds),
+        "max_rss_kib": max(x.max_rss for x in measurements),
+    }
+
+
+def run_benchmark(
+    package_dir: pathlib.Path,
+    touched: pathlib.Path,
+    repeat: int = 3,
+    args: Optional[List[str]] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> Dict:
+    """
+    Benchmark builds of the package in package_dir.
+
+    Each round removes the build directory and builds from scratch, builds
+    again with nothing changed, and builds after changing touched. The
+    object cache is not used, so clean builds compile everything.
+
+    Args:
+        package_dir: The root of the package.
+        touched: A source changed before the last build of each round, it's
+            restored afterwards.
+        repeat: Number of rounds.
+        args: Extra arguments of cfpm build.
+        env: Environment variables of cfpm, like CFPM_HOME.
+
+    Returns: Results of each scenario in SCENARIOS.
+    """
+    args = ["--no-cache"] + list(args or [])
+    env = dict(os.environ if env is None else env)
+    measurements: Dict[str, List[Measurement]] = {x: [] for x in SCENARIOS}
+    original = touched.read_bytes()
+    try:
+        for i in range(repeat):
+            shutil.rmtree(package_dir / "build", ignore_errors=True)
+            measurements["clean"].append(
+                measure_build(package_dir, args, env)
+            )
+            measurements["noop"].append(measure_build(package_dir, args, env))
+            touched.write_bytes(
+                original + "\n/* touched {} */\n".format(i).encode()
+            )
+            measurements["touch"].append(
+                measure_build(package_dir, args, env)
+            )
+    finally:
+        touched.write_bytes(original)
+    return {
+        "version": RESULTS_VERSION,
+        "results": {k: _summarize(v) for (k, v) in measurements.items()},
+    }
+
+
+def compare(
+    results: Dict, baseline: Dict, tolerance: float = DEFAULT_TOLERANCE
+) -> List[str]:
+    """
+    Compare results with a baseline from run_benchmark.
+
+    The median time and the peak RSS of every scenario may exceed the
+    baseline by tolerance, a ratio.
+
+    Returns: Descriptions of the regressions. Raise a ValueError if the
+        baseline is malformed or of another version.
+    """
+    if baseline.get("version") != RESULTS_VERSION:
+        raise ValueError("Baseline is of another version.")
+    regressions: List[str] = []
+    for (scenario, current) in results["results"].items():
+        try:
+            base = baseline["results"].get(scenario)
+            if base is None:
+                continue
+            for (key, unit) in (("median", "s"), ("max_rss_kib", " KiB")):
+                limit = float(base[key])
+                if current[key] > limit * (1 + tolerance):
+                    regressions.append(
+                        "{} {} {:.3f}{} > baseline {:.3f}{}".format(
+                            scenario, key, current[key], unit, limit, unit
+                        )
+                    )
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Bad baseline: {}".format(e))
+    return regressions
+
+
+def measure_spawns(count: int, ballast: int = 0) -> Dict[str, float]:
+    """
+    Measure how many programs per second cfpm starts and waits for.
+
+    CLIDriver.run, which starts programs with posix_spawn where possible,
+    is compared with subprocess.run forking cfpm. The cost of forking grows
+    with the memory of cfpm, so ballast MiB of memory may be filled first
+    to mimic a large build.
+
+    Returns: Programs per second of "cfpm" and "subprocess".
+    """
+    filled = b"\1" * (ballast << 20)  # noqa: F841
+    driver = CLIDriver(SPAWN_PROGRAM)
+    rates: Dict[str, float] = {}
+    for (method, run) in (
+        ("cfpm", lambda: driver.run([], capture_output=True)),
+        (
+            "subprocess",
+            lambda: subprocess.run([driver.program], capture_output=True),
+        ),
+    ):
+        start = time.monotonic()
+        for _ in range(count):
+            run()
+        rates[method] = count / (time.monotonic() - start)
+    return rates
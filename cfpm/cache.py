@@ -0,0 +1,233 @@
+"""Content-addressed cache of build artifacts."""
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from .drivers import GenericDriver
+from .logging import logger
+from .utils import Pathlike
+
+# Default size limit of the object cache, in bytes
+DEFAULT_CACHE_SIZE = 5 * 1024 ** 3
+
+# Trim the cache to this ratio of the limit when evicting, so eviction won't
+# happen again on the next build right away.
+EVICTION_RATIO = 0.9
+
+
+def hash_file(path: Pathlike, h: Optional["hashlib._Hash"] = None) -> str:
+    """Hash the content of a file with sha256, returns the hex digest."""
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def command_digest(
+    driver: GenericDriver, args: List[str], out: Pathlike
+) -> str:
+    """Digest of the program of driver and the arguments writing out."""
+    h = hashlib.sha256()
+    h.update(driver.identity().encode())
+    h.update(b"\0")
+    for arg in args:
+        # The output path doesn't affect the output.
+        if arg != str(out):
+            h.update(arg.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def atomic_copy(src: Pathlike, dest: pathlib.Path) -> None:
+    """Copy src to dest, readers never see a half written dest."""
+    fd, tmp = tempfile.mkstemp(dir=str(dest.parent), prefix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class ObjectCache:
+    """
+    A cache of object files under cfpm home.
+
+    Objects are keyed by the compiler, the compile arguments and the content
+    of the source. Since headers matter too, each key has a manifest listing
+    the inputs found by the last compile, and the object is stored under the
+    key combined with the digest of those inputs. Files are stored as
+    objects/<key[:2]>/<key>.* and their mtime is used as the last used time
+    for LRU eviction.
+    """
+
+    def __init__(
+        self, directory: Pathlike, max_size: int = DEFAULT_CACHE_SIZE
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            directory: The directory of the cache, created if not exists.
+            max_size: The size limit of all the objects, in bytes.
+        """
+        self.directory = pathlib.Path(directory)
+        self.objects = self.directory / "objects"
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.objects.mkdir(parents=True, exist_ok=True)
+
+    def key(self, command: str, src: Pathlike) -> str:
+        """Compute the key of compiling src with the command digest."""
+        h = hashlib.sha256()
+        h.update(command.encode())
+        return hash_file(src, h)
+
+    def _path(self, key: str, suffix: str = ".o") -> pathlib.Path:
+        return self.objects / key[:2] / (key + suffix)
+
+    @staticmethod
+    def _combine(key: str, digest: str) -> str:
+        return hashlib.sha256("{}{}".format(key, digest).encode()).hexdigest()
+
+    def fetch(
+        self,
+        key: str,
+        obj: pathlib.Path,
+        digest: Callable[[List[str]], Optional[str]],
+    ) -> Optional[List[str]]:
+        """
+        Copy the cached object of key to obj.
+
+        Args:
+            key: The key from ObjectCache.key.
+            obj: The destination.
+            digest: A function computing the digest of the inputs, returns
+                None if any of them doesn't exist.
+
+        Returns: The inputs of the object if it's cached, None otherwise.
+        """
+        manifest = self._path(key, ".json")
+        try:
+            with open(manifest, "r") as f:
+                inputs = json.load(f)
+            inputs_digest = digest(inputs)
+            if inputs_digest is None:
+                raise FileNotFoundError
+            path = self._path(self._combine(key, inputs_digest))
+            atomic_copy(path, obj)
+            os.utime(path)
+            os.utime(manifest)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return inputs
+
+    def store(
+        self, key: str, obj: pathlib.Path, inputs: List[str], digest: str
+    ) -> None:
+        """
+        Store obj as the cached object of key.
+
+        Args:
+            key: The key from ObjectCache.key.
+            obj: The object.
+            inputs: All the inputs of the object from the depfile.
+            digest: The digest of the inputs.
+        """
+        manifest = self._path(key, ".json")
+        path = self._path(self._combine(key, digest))
+        manifest.parent.mkdir(exist_ok=True)
+        path.parent.mkdir(exist_ok=True)
+        atomic_copy(obj, path)
+        fd, tmp = tempfile.mkstemp(dir=str(manifest.parent), prefix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(inputs, f)
+        os.replace(tmp, manifest)
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """List last used time, size and path of all the cached objects."""
+        result: List[Tuple[float, int, str]] = []
+        for d in os.scandir(self.objects):
+            if d.is_dir():
+                for x in os.scandir(d.path):
+                    st = x.stat()
+                    result.append((st.st_mtime, st.st_size, x.path))
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """Statistics of the cache, hits and misses are accumulated."""
+        entries = self.entries()
+        stats = self._load_stats()
+        stats["entries"] = sum(1 for x in entries if x[2].endswith(".o"))
+        stats["size"] = sum(x[1] for x in entries)
+        stats["max_size"] = self.max_size
+        return stats
+
+    def _load_stats(self) -> Dict[str, int]:
+        try:
+            with open(self.directory / "stats.json", "r") as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {}
+        return {x: int(stats.get(x, 0)) for x in ("hits", "misses")}
+
+    def flush(self) -> None:
+        """Save the statistics and evict objects over the size limit."""
+        with self._lock:
+            stats = self._load_stats()
+            stats["hits"] += self.hits
+            stats["misses"] += self.misses
+            misses = self.misses
+            self.hits = self.misses = 0
+        with open(self.directory / "stats.json", "w") as f:
+            json.dump(stats, f)
+        if misses:  # Nothing new is stored otherwise.
+            self.evict()
+
+    def evict(self, max_size: Optional[int] = None) -> int:
+        """
+        Remove the least recently used objects until under max_size.
+
+        Args:
+            max_size: Defaults to the size limit of the cache.
+
+        Returns: Number of removed objects.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        size = sum(x[1] for x in entries)
+        if size <= max_size:
+            return 0
+        target = int(max_size * EVICTION_RATIO)
+        removed = 0
+        for (_, file_size, path) in sorted(entries):
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:  # Evicted by someone else.
+                pass
+            size -= file_size
+            removed += 1
+        logger.debug("Evicted {} objects from the cache.".format(removed))
+        return removed
+
+    def clean(self) -> None:
+        """Remove everything in the cache."""
+        shutil.rmtree(self.directory)
+        self.objects.mkdir(parents=True)
@@ -0,0 +1,89 @@
+"""Export of the compilation database, compile_commands.json."""
+
+import json
+import os
+import pathlib
+from typing import Dict, List, Tuple
+from .logging import logger
+from .utils import Pathlike
+
+# Name of the compilation database in the build directory, where clangd and
+# most IDEs look for it
+COMPDB_FILE = "compile_commands.json"
+
+
+class CompilationDatabase:
+    """
+    A compile_commands.json kept up to date incrementally.
+
+    Each entry is serialized on its own and the text is kept between updates,
+    so only new or changed entries are serialized again. The file is not
+    written at all if no entry changed, so tools watching it don't reload.
+    """
+
+    def __init__(self, path: Pathlike):
+        """
+        Load the database at path.
+
+        A missing or broken file is treated as an empty database.
+        """
+        self.path = pathlib.Path(path)
+        # output -> (entry, its serialized text)
+        self.entries: Dict[str, Tuple[Dict, str]] = {}
+        try:
+            with open(self.path, "r") as f:
+                for entry in json.load(f):
+                    self.entries[self._key(entry)] = (
+                        entry,
+                        self._dump(entry),
+                    )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.debug("Ignored broken {}: {}".format(self.path, e))
+            self.entries = {}
+
+    @staticmethod
+    def _key(entry: Dict) -> str:
+        return str(entry.get("output") or entry["file"])
+
+    @staticmethod
+    def _dump(entry: Dict) -> str:
+        return json.dumps(entry, indent=2).replace("\n", "\n  ")
+
+    def update(self, entries: List[Dict]) -> int:
+        """
+        Replace all the entries and write the file if anything changed.
+
+        Args:
+            entries: Entries with "directory", "arguments", "file" and
+                "output", in the order to write.
+
+        Returns: Number of entries added, changed or removed.
+        """
+        changed = 0
+        updated: Dict[str, Tuple[Dict, str]] = {}
+        for entry in entries:
+            key = self._key(entry)
+            old = self.entries.get(key)
+            if old is not None and old[0] == entry:
+                updated[key] = old
+                continue
+            updated[key] = (entry, self._dump(entry))
+            changed += 1
+        changed += len(self.entries.keys() - updated.keys())
+        order_changed = list(self.entries) != list(updated)
+        self.entries = updated
+        if changed or order_changed or not self.path.exists():
+            self._write()
+        return changed
+
+    def _write(self) -> None:
+        texts = [x[1] for x in self.entries.values()]
+        content = "[\n  " + ",\n  ".join(texts) + "\n]\n" if texts else "[]\n"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, self.path)
+        logger.debug("Wrote {}.".format(self.path))
@@ -0,0 +1,198 @@
+"""Parsing and caching of the build configuration."""
+
+import hashlib
+import os
+import pathlib
+import pickle
+from typing import Any, Dict, List, Optional, Tuple
+from .cache import hash_file
+from .exceptions import BadConfigurationError
+from .logging import logger
+from .utils import Pathlike
+
+try:
+    import tomllib  # type: ignore
+except ImportError:  # Python < 3.11
+    tomllib = None  # type: ignore
+
+# Bump this when the format of the cached configuration changes.
+CONFIG_CACHE_VERSION = 1
+
+# (path, mtime_ns, size, sha256) of a file the configuration is read from
+FileKey = Tuple[str, int, int, str]
+
+
+def _plain(value: Any) -> Any:
+    """Convert tomlkit items to builtin types, so they pickle compactly."""
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for (k, v) in value.items()}
+    if isinstance(value, list):
+        return [_plain(x) for x in value]
+    for t in (bool, int, float, str):
+        if isinstance(value, t):
+            return t(value)
+    return value
+
+
+def parse_toml(path: Pathlike) -> Dict:
+    """
+    Parse a toml file into builtin types.
+
+    The read-only tomllib is used if available, it's much faster than
+    tomlkit. Raise an OSError if path can't be read, or a ValueError if it's
+    malformed.
+    """
+    if tomllib is not None:
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path, "r") as f:
+        return parse_toml_text(f.read())
+
+
+def parse_toml_text(content: str) -> Dict:
+    """Parse toml content like parse_toml, raise a ValueError if failed."""
+    if tomllib is not None:
+        return tomllib.loads(content)
+    import tomlkit
+
+    return _plain(tomlkit.parse(content))
+
+
+def file_key(path: Pathlike) -> FileKey:
+    """Key a configuration file by its path, mtime, size and content."""
+    st = os.stat(path)
+    return (str(path), st.st_mtime_ns, st.st_size, hash_file(path))
+
+
+class ConfigCache:
+    """
+    Parsed configurations of projects under cfpm home.
+
+    The configuration of a project is pickled with the keys of all the files
+    it's read from. It's used as long as none of those files changed, so a
+    no-op build doesn't parse any toml. Files with the same mtime and size
+    aren't hashed again.
+    """
+
+    def __init__(self, directory: Pathlike):
+        """Initialize the cache in directory, created when storing."""
+        self.directory = pathlib.Path(directory)
+
+    def _path(self, root: pathlib.Path) -> pathlib.Path:
+        digest = hashlib.sha256(str(root).encode()).hexdigest()
+        return self.directory / (digest + ".pickle")
+
+    def load(self, root: pathlib.Path) -> Optional[Dict]:
+        """Get the cached configuration of the project at root, or None."""
+        path = self._path(root)
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if data["version"] != CONFIG_CACHE_VERSION:
+                return None
+            files: List[FileKey] = data["files"]
+            changed = False
+            for (i, (name, mtime, size, digest)) in enumerate(files):
+                st = os.stat(name)
+                if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                    continue
+                key = file_key(name)
+                if key[3] != digest:
+                    return None
+                files[i] = key
+                changed = True
+        except FileNotFoundError:
+            return None
+        except (
+            OSError,
+            ValueError,
+            KeyError,
+            TypeError,
+            EOFError,
+            pickle.UnpicklingError,
+        ) as e:
+            logger.debug("Ignored broken {}: {}".format(path, e))
+            return None
+        if changed:  # Only touched, save the hashing next time.
+            self._save(path, files, data["config"])
+        logger.debug("Loaded cached configuration {}.".format(path))
+        return data["config"]
+
+    def store(
+        self, root: pathlib.Path, config: Dict, files: List[FileKey]
+    ) -> None:
+        """
+        Cache the configuration of the project at root.
+
+        Args:
+            root: The root of the project.
+            config: The configuration, of builtin types only.
+            files: Keys of all the files config is read from, taken before
+                they're parsed.
+        """
+        self._save(self._path(root), files, config)
+
+    def _save(
+        self, path: pathlib.Path, files: List[FileKey], config: Dict
+    ) -> None:
+        data = {
+            "version": CONFIG_CACHE_VERSION,
+            "files": files,
+            "config": config,
+        }
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Failed to cache configuration: {}".format(e))
+
+
+def read_toml(path: pathlib.Path, files: List[FileKey]) -> Dict:
+    """
+    Read and parse a toml file, its key is appended to files.
+
+    Raise a BadConfigurationError if failed.
+    """
+    logger.debug("Reading configuration file {}.".format(path))
+    try:
+        files.append(file_key(path))
+        return parse_toml(path)
+    except (OSError, ValueError) as e:
+        raise BadConfigurationError("Failed to read {}: {}".format(path, e))
+
+
+def load_config(
+    root: pathlib.Path, cache: Optional[ConfigCache] = None
+) -> Dict:
+    """
+    Load cfpm.toml and all the target configurations under root.
+
+    The [target] table of each target configuration is merged into its entry
+    of [[targets]] as "target". The parsed configuration is taken from and
+    stored to cache if given. Raise a BadConfigurationError if failed.
+    """
+    if cache:
+        cached = cache.load(root)
+        if cached is not None:
+            return cached
+    files: List[FileKey] = []
+    config = read_toml(root / "cfpm.toml", files)
+    for entry in config.get("targets", []):
+        try:
+            target_path = root / str(entry["dir"]) / "{}.toml".format(
+                entry["name"]
+            )
+        except KeyError as e:
+            raise BadConfigurationError("Missing key {} in target.".format(e))
+        target_config = read_toml(target_path, files)
+        if "target" not in target_config:
+            raise BadConfigurationError(
+                "Missing [target] in {}.".format(target_path)
+            )
+        entry["target"] = target_config["target"]
+    if cache:
+        cache.store(root, config, files)
+    return config
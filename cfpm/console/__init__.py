@@ -4,14 +4,6 @@ import sys
 from ..logging import logger
 from .cli import cli
 
-from .build import build
-from .new import new
-from .version import version
-
-cli.add_command(build)
-cli.add_command(new)
-cli.add_command(version)
-
 
 def main():
     """
@@ -0,0 +1,171 @@
+"""Command benchmark."""
+
+import click
+import json
+import os
+import pathlib
+import tempfile
+from typing import Dict, List, Optional
+from ..benchmark import (
+    DEFAULT_TOLERANCE,
+    SCENARIOS,
+    compare,
+    measure_spawns,
+    run_benchmark,
+)
+from ..exceptions import ExternalProgramError
+from ..logging import logger
+from ..utils import handle, error_exit
+from .new import synthetic_templates, write_templates
+
+
+@click.command()
+@click.option(
+    "--targets",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of libraries of the synthetic package.",
+)
+@click.option(
+    "--sources",
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of sources of each library.",
+)
+@click.option(
+    "--fanout",
+    type=click.IntRange(min=0),
+    default=4,
+    show_default=True,
+    help="Number of headers included by each source.",
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Number of rounds of builds.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of jobs of the builds. [default: number of CPUs]",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the results to the JSON file.",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Compare with results written by --output, exit with 1 if slower.",
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0),
+    default=DEFAULT_TOLERANCE,
+    show_default=True,
+    help="Ratio the results may exceed the baseline by.",
+)
+@click.option(
+    "--spawn",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Measure starting the given number of programs instead of builds.",
+)
+@click.option(
+    "--ballast",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="MiB of memory filled before measuring --spawn.",
+)
+def benchmark(
+    targets: int,
+    sources: int,
+    fanout: int,
+    repeat: int,
+    jobs: Optional[int],
+    output: Optional[str],
+    baseline: Optional[str],
+    tolerance: float,
+    spawn: Optional[int],
+    ballast: int,
+):
+    """Benchmark builds of a synthetic package."""
+    if spawn:
+        rates = handle(measure_spawns, (OSError, RuntimeError), spawn, ballast)
+        for (method, rate) in rates.items():
+            click.echo("{:12} {:10.1f} programs/s".format(method, rate))
+        if output:
+            with handle(open, OSError, output, "w") as f:
+                json.dump({"spawn": rates, "ballast_mib": ballast}, f)
+        return
+    with tempfile.TemporaryDirectory(prefix="cfpm-benchmark-") as tmp:
+        package_dir = pathlib.Path(tmp) / "synthetic"
+        write_templates(
+            package_dir,
+            "synthetic",
+            synthetic_templates(targets, sources, fanout),
+        )
+        # A home of its own, so no cache of other builds is used.
+        env = dict(os.environ, CFPM_HOME=str(pathlib.Path(tmp) / "home"))
+        os.mkdir(env["CFPM_HOME"])
+        logger.info(
+            "Benchmarking {} targets x {} sources, fan-out {}.".format(
+                targets, sources, fanout
+            )
+        )
+        results = handle(
+            run_benchmark,
+            ExternalProgramError,
+            package_dir,
+            package_dir / "t0" / "s0.c",
+            repeat,
+            ["-j", str(jobs)] if jobs else [],
+            env,
+        )
+    results["package"] = {
+        "targets": targets,
+        "sources": sources,
+        "fanout": fanout,
+    }
+    for scenario in SCENARIOS:
+        result = results["results"][scenario]
+        click.echo(
+            "{:8} {:8.3f}s median {:8.3f}s min {:8} KiB peak RSS".format(
+                scenario,
+                result["median"],
+                result["min"],
+                result["max_rss_kib"],
+            )
+        )
+    if output:
+        with handle(open, OSError, output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Wrote results to {}.".format(output))
+    if baseline:
+        regressions = handle(
+            _compare, (OSError, ValueError), results, baseline, tolerance
+        )
+        for regression in regressions:
+            logger.error(regression)
+        if regressions:
+            error_exit()
+        logger.info("No regressions from {}.".format(baseline))
+
+
+def _compare(results: Dict, path: str, tolerance: float) -> List[str]:
+    with open(path, "r") as f:
+        baseline = json.load(f)
+    if baseline.get("package") != results["package"]:
+        logger.warning("Baseline is of another synthetic package.")
+    return compare(results, baseline, tolerance)
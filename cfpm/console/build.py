@@ -2,25 +2,247 @@
 
 import click
 import pathlib
-import tomlkit
-from tomlkit.exceptions import TOMLKitError
-from typing import Dict
+from typing import Dict, List, Optional
+from ..config import ConfigCache, load_config
+from ..daemon import request_build
+from ..exceptions import BadConfigurationError, ExternalProgramError
 from ..logging import logger
+from ..drivers import ProbeCache
+from ..profiling import tracer
 from ..projects import Build
-from ..utils import handle, error
+from ..scheduler import DurationHistory, ResourceHistory
+from ..utils import handle, error, error_exit
+from .cache import (
+    cache_size_option,
+    open_artifacts,
+    open_cache,
+    parse_size_option,
+)
+from .cli import start_log_pipeline
+from .daemon import poll_option, run_daemon
+from .worker import open_worker_pool
 
 
 @click.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of jobs running in parallel. [default: number of CPUs]",
+)
+@click.option(
+    "-k",
+    "--keep-going",
+    is_flag=True,
+    help="Keep going with other jobs after a job failed.",
+)
+@click.option(
+    "--mem-limit",
+    default=None,
+    callback=parse_size_option,
+    help="Don't start a job while the peak memory predicted for it and the "
+    "running jobs exceeds the limit, e.g. 16G.",
+)
+@click.option(
+    "--load-limit",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="Don't start a job while the load average is at least the limit.",
+)
+@click.option(
+    "--asyncio",
+    "use_asyncio",
+    is_flag=True,
+    help="Supervise compilers in an asyncio event loop and stream their "
+    "output.",
+)
+@click.option(
+    "--workers",
+    default="",
+    envvar="CFPM_WORKERS",
+    help="Comma separated addresses of remote workers, host:port or "
+    "unix:path.",
+)
+@click.option("--no-cache", is_flag=True, help="Don't use the object cache.")
+@cache_size_option
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write a Chrome trace of the build to the file, which "
+    "chrome://tracing and Perfetto open.",
+)
+@click.option(
+    "--timings",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Show the given number of slowest compiles.",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep the build in memory and rebuild whenever a file changes.",
+)
+@poll_option
+@click.option(
+    "--compdb",
+    is_flag=True,
+    help="Write build/compile_commands.json before building.",
+)
+@click.option(
+    "--no-daemon",
+    is_flag=True,
+    help="Don't build with the running cfpm daemon of the package.",
+)
 @click.pass_obj
-def build(obj: Dict):
+def build(
+    obj: Dict,
+    jobs: Optional[int],
+    keep_going: bool,
+    mem_limit: Optional[int],
+    load_limit: Optional[float],
+    use_asyncio: bool,
+    workers: str,
+    no_cache: bool,
+    cache_size: int,
+    trace: Optional[str],
+    timings: Optional[int],
+    watch: bool,
+    poll: bool,
+    compdb: bool,
+    no_daemon: bool,
+):
     """Build your package."""
-    config_path = pathlib.Path('./cfpm.toml').absolute()
-    logger.debug("cfpm configuration file {}.".format(config_path))
-    with handle(open, OSError, config_path, 'r') as f:
-        content = f.read()
-        config = handle(tomlkit.parse, TOMLKitError, content)
+    if watch:
+        # The daemon keeps no trace, and schedules jobs without limits.
+        for (name, value) in [
+            ("--asyncio", use_asyncio),
+            ("--trace", trace),
+            ("--timings", timings),
+            ("--mem-limit", mem_limit),
+            ("--load-limit", load_limit),
+        ]:
+            if value:
+                raise click.UsageError(
+                    "{} can't be used with --watch.".format(name)
+                )
+        run_daemon(
+            obj,
+            jobs,
+            keep_going,
+            workers,
+            no_cache,
+            cache_size,
+            poll,
+            False,
+            compdb,
+        )
+        return
+    # Options about this very build are not supported by the daemon.
+    if not (
+        no_daemon
+        or use_asyncio
+        or workers
+        or no_cache
+        or trace
+        or timings
+        or mem_limit
+        or load_limit
+    ):
+        ok = handle(
+            request_build,
+            ExternalProgramError,
+            pathlib.Path(".").absolute(),
+            jobs,
+            keep_going or None,
+            compdb,
+        )
+        if ok is not None:
+            if not ok:
+                error_exit()
+            return
+    if trace or timings:
+        tracer.enable()
     try:
-        build = Build(config)
-    except TypeError as e:
+        run_build(
+            obj,
+            jobs,
+            keep_going,
+            use_asyncio,
+            workers,
+            no_cache,
+            cache_size,
+            compdb,
+            mem_limit,
+            load_limit,
+        )
+    finally:
+        tracer.disable()
+        if trace:
+            tracer.write(trace)
+            logger.info("Wrote trace to {}.".format(trace))
+        if timings:
+            for (name, seconds) in tracer.slowest("compile", timings):
+                logger.info("{:8.3f}s {}".format(seconds, name))
+
+
+def run_build(
+    obj: Dict,
+    jobs: Optional[int],
+    keep_going: bool,
+    use_asyncio: bool,
+    workers: str,
+    no_cache: bool,
+    cache_size: int,
+    compdb: bool = False,
+    mem_limit: Optional[int] = None,
+    load_limit: Optional[float] = None,
+    targets: Optional[List[str]] = None,
+) -> Build:
+    """Build the package in the current directory, exit if failed."""
+    start_log_pipeline(obj)
+    root = pathlib.Path(".").absolute()
+    with tracer.span("load config", "config"):
+        config = load_package_config(obj, root)
+    object_cache = None if no_cache else open_cache(obj, cache_size)
+    artifacts = None if no_cache else open_artifacts(obj, cache_size)
+    pool = open_worker_pool(workers)
+    try:
+        build = Build(
+            config,
+            root,
+            jobs=jobs,
+            keep_going=keep_going,
+            use_asyncio=use_asyncio,
+            cache=object_cache,
+            probes=ProbeCache(obj["cfpm_home"] / "probes.json"),
+            workers=pool,
+            history=DurationHistory(obj["cfpm_home"] / "durations.json"),
+            artifacts=artifacts,
+            resources=ResourceHistory(obj["cfpm_home"] / "resources.json"),
+            lto_cache=obj["cfpm_home"] / "lto",
+            mem_limit=mem_limit,
+            load_limit=load_limit,
+            targets=targets,
+        )
+    except (BadConfigurationError, TypeError) as e:
         error(e)
-    build.build()
+    try:
+        if compdb:
+            handle(build.write_compdb, (BadConfigurationError, OSError))
+        handle(build.build, (BadConfigurationError, ExternalProgramError))
+    finally:
+        if pool:
+            pool.close()
+    return build
+
+
+def load_package_config(obj: Dict, root: pathlib.Path) -> Dict:
+    """Load the configuration of the package at root, exit if failed."""
+    return handle(
+        load_config,
+        BadConfigurationError,
+        root,
+        ConfigCache(obj["cfpm_home"] / "configs"),
+    )
@@ -0,0 +1,102 @@
+"""Command cache."""
+
+import click
+import os
+from typing import Callable, Dict, Optional
+from ..artifacts import ArtifactCache
+from ..cache import ObjectCache
+from ..utils import handle, parse_size
+
+
+def parse_size_option(
+    ctx: click.Context, param: click.Parameter, value: Optional[str]
+) -> Optional[int]:
+    """Parse the value of a size option, like 512M or 5G, into bytes."""
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def cache_size_option(f: Callable) -> Callable:
+    """Add a `--cache-size` option to the decorated command."""
+    return click.option(
+        "--cache-size",
+        default="5G",
+        envvar="CFPM_CACHE_SIZE",
+        show_default=True,
+        callback=parse_size_option,
+        help="Size limit of the object cache, and of the prebuilt packages, "
+        "e.g. 512M or 5G.",
+    )(f)
+
+
+def open_cache(obj: Dict, cache_size: int) -> ObjectCache:
+    """Open the object cache under cfpm home."""
+    return handle(
+        ObjectCache, OSError, obj["cfpm_home"] / "cache", cache_size
+    )
+
+
+def open_artifacts(obj: Dict, cache_size: int) -> ArtifactCache:
+    """
+    Open the cache of prebuilt packages under cfpm home.
+
+    CFPM_ARTIFACTS_REMOTE may be set to a directory or an http(s) url as the
+    remote tier shared by machines.
+    """
+    return ArtifactCache(
+        obj["cfpm_home"] / "artifacts",
+        os.environ.get("CFPM_ARTIFACTS_REMOTE") or None,
+        cache_size,
+    )
+
+
+@click.group()
+def cache():
+    """Manage the build cache."""
+
+
+@cache.command()
+@cache_size_option
+@click.pass_obj
+def stats(obj: Dict, cache_size: int):
+    """Show statistics of the build cache."""
+    object_cache = open_cache(obj, cache_size)
+    stats = handle(object_cache.stats, OSError)
+    total = stats["hits"] + stats["misses"]
+    click.echo("Cache directory  {}".format(object_cache.directory))
+    click.echo("Objects          {}".format(stats["entries"]))
+    click.echo(
+        "Size             {:.1f} / {:.1f} MiB".format(
+            stats["size"] / 1024 ** 2, stats["max_size"] / 1024 ** 2
+        )
+    )
+    click.echo(
+        "Hits             {} / {} ({:.1f}%)".format(
+            stats["hits"], total, 100 * stats["hits"] / total if total else 0
+        )
+    )
+    artifacts = open_artifacts(obj, cache_size)
+    stats = handle(artifacts.stats, OSError)
+    click.echo("Prebuilt         {}".format(stats["entries"]))
+    click.echo(
+        "Prebuilt size    {:.1f} / {:.1f} MiB".format(
+            stats["size"] / 1024 ** 2, stats["max_size"] / 1024 ** 2
+        )
+    )
+
+
+@cache.command()
+@cache_size_option
+@click.pass_obj
+def clean(obj: Dict, cache_size: int):
+    """Remove everything in the build cache."""
+    object_cache = open_cache(obj, cache_size)
+    handle(object_cache.clean, OSError)
+    click.echo("Cleaned {}.".format(object_cache.directory))
+    artifacts = open_artifacts(obj, cache_size)
+    handle(artifacts.clean, OSError)
+    click.echo("Cleaned {}.".format(artifacts.directory))
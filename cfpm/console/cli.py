@@ -1,13 +1,74 @@
 """Click group of the main cli."""
 
 import click
+import importlib
 import pathlib
 from os.path import expanduser
+from typing import Dict, List, Optional
 from ..utils import handle
-from ..logging import logger, simple_verbosity_option
+from ..logging import (
+    LOG_FORMATS,
+    LogPipeline,
+    logger,
+    logger_basic_config,
+    simple_verbosity_option,
+)
+
+
+class LazyGroup(click.Group):
+    """
+    A click group importing the module of a subcommand only when it's used.
+
+    Subcommands are registered by name as "module:attribute", relative to
+    this package, so running one command doesn't pay for the imports of all
+    the others.
+    """
+
+    def __init__(
+        self, *args, lazy_commands: Optional[Dict[str, str]] = None, **kwargs
+    ):
+        """
+        Initialize the group.
+
+        Args:
+            lazy_commands: Mapping from names of subcommands to where they
+                are, like {"build": ".build:build"}.
+        """
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = dict(lazy_commands or {})
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        """List the names of all the subcommands."""
+        names = set(super().list_commands(ctx)) | set(self.lazy_commands)
+        return sorted(names)
 
+    def get_command(
+        self, ctx: click.Context, cmd_name: str
+    ) -> Optional[click.Command]:
+        """Get a subcommand, import it if it's not loaded yet."""
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[cmd_name].split(":")
+            module = importlib.import_module(module_name, __package__)
+            self.add_command(getattr(module, attribute), cmd_name)
+        return super().get_command(ctx, cmd_name)
 
-@click.group(context_settings=dict(help_option_names=["-h", "--help"]))
+
+@click.group(
+    cls=LazyGroup,
+    lazy_commands={
+        "benchmark": ".benchmark:benchmark",
+        "build": ".build:build",
+        "cache": ".cache:cache",
+        "compdb": ".compdb:compdb",
+        "daemon": ".daemon:daemon",
+        "fetch": ".fetch:fetch",
+        "new": ".new:new",
+        "test": ".test:test",
+        "version": ".version:version",
+        "worker": ".worker:worker",
+    },
+    context_settings=dict(help_option_names=["-h", "--help"]),
+)
 @simple_verbosity_option(logger, envvar="CFPM_VERBOSITY")
 @click.option(
     "--cfpm-home",
@@ -16,12 +77,38 @@ from ..logging import logger, simple_verbosity_option
     help="Home directory for cfpm to store all the build cache and "
     "configuration and stuff.",
 )
+@click.option(
+    "--log-format",
+    type=click.Choice(LOG_FORMATS),
+    default="text",
+    envvar="CFPM_LOG_FORMAT",
+    show_default=True,
+    help="Write logs as colored text or a JSON object per line.",
+)
 @click.pass_context
-def cli(ctx: click.Context, cfpm_home: str):  # noqa: D400, D401
+def cli(
+    ctx: click.Context, cfpm_home: str, log_format: str
+):  # noqa: D400, D401
     """C-Family Package Manager"""
-    ctx.obj = dict()
+    logger_basic_config(logger, log_format)
+    # Started by commands running jobs, see start_log_pipeline.
+    pipeline = LogPipeline(logger)
+    ctx.call_on_close(pipeline.stop)
+    ctx.obj = dict(log_pipeline=pipeline)
     cfpm_home_path = pathlib.Path(cfpm_home).absolute()
     if not cfpm_home_path.exists():
         handle(cfpm_home_path.mkdir, OSError, parents=False)
     ctx.obj["cfpm_home"] = cfpm_home_path
     logger.debug("cfpm home path {}.".format(cfpm_home_path))
+
+
+def start_log_pipeline(obj: Dict) -> None:
+    """
+    Write logs on a background thread, so jobs don't wait for the terminal.
+
+    Only commands running jobs start it, the thread and its imports would
+    slow down quick commands like cfpm version.
+    """
+    pipeline = obj.get("log_pipeline")
+    if pipeline:
+        pipeline.start()
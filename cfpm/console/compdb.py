@@ -0,0 +1,28 @@
+"""Command compdb."""
+
+import click
+import pathlib
+from typing import Dict
+from ..compdb import COMPDB_FILE
+from ..drivers import ProbeCache
+from ..exceptions import BadConfigurationError
+from ..logging import logger
+from ..projects import Build
+from ..utils import handle, error
+from .build import load_package_config
+
+
+@click.command()
+@click.pass_obj
+def compdb(obj: Dict):
+    """Write build/compile_commands.json without building."""
+    root = pathlib.Path(".").absolute()
+    config = load_package_config(obj, root)
+    try:
+        build = Build(
+            config, root, probes=ProbeCache(obj["cfpm_home"] / "probes.json")
+        )
+    except (BadConfigurationError, TypeError) as e:
+        error(e)
+    handle(build.write_compdb, (BadConfigurationError, OSError))
+    logger.info("Wrote {}.".format(root / "build" / COMPDB_FILE))
@@ -0,0 +1,114 @@
+"""Command daemon."""
+
+import click
+import pathlib
+import threading
+from typing import Callable, Dict, Optional
+from ..daemon import DAEMON_SOCKET, Daemon
+from ..logging import logger
+from ..utils import handle
+from .cache import cache_size_option, open_artifacts, open_cache
+from .cli import start_log_pipeline
+from .worker import open_worker_pool
+
+
+def poll_option(f: Callable) -> Callable:
+    """Add a `--poll` option to the decorated command."""
+    return click.option(
+        "--poll",
+        is_flag=True,
+        help="Poll the source tree for changes instead of using inotify.",
+    )(f)
+
+
+def run_daemon(
+    obj: Dict,
+    jobs: Optional[int],
+    keep_going: bool,
+    workers: str,
+    no_cache: bool,
+    cache_size: int,
+    poll: bool,
+    serve: bool,
+    compdb: bool = False,
+) -> None:
+    """
+    Build the package and rebuild it on changes until interrupted.
+
+    Args:
+        serve: Also serve builds to cfpm build on the Unix socket of the
+            daemon.
+        compdb: Write the compilation database before every build.
+    """
+    start_log_pipeline(obj)
+    root = pathlib.Path(".").absolute()
+    object_cache = None if no_cache else open_cache(obj, cache_size)
+    pool = open_worker_pool(workers)
+    daemon = Daemon(
+        root,
+        obj["cfpm_home"],
+        jobs=jobs,
+        keep_going=keep_going,
+        cache=object_cache,
+        workers=pool,
+        artifacts=None if no_cache else open_artifacts(obj, cache_size),
+    )
+    server = handle(daemon.server, OSError) if serve else None
+    if server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        daemon.build(compdb=compdb)
+        logger.info("Watching {} for changes.".format(root))
+        daemon.watch(polling=poll, compdb=compdb)
+    except KeyboardInterrupt:
+        logger.info("Stopped.")
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+            try:
+                (daemon.build_dir / DAEMON_SOCKET).unlink()
+            except FileNotFoundError:
+                pass
+        if pool:
+            pool.close()
+
+
+@click.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of jobs running in parallel. [default: number of CPUs]",
+)
+@click.option(
+    "-k",
+    "--keep-going",
+    is_flag=True,
+    help="Keep going with other jobs after a job failed.",
+)
+@click.option(
+    "--workers",
+    default="",
+    envvar="CFPM_WORKERS",
+    help="Comma separated addresses of remote workers, host:port or "
+    "unix:path.",
+)
+@click.option("--no-cache", is_flag=True, help="Don't use the object cache.")
+@cache_size_option
+@poll_option
+@click.pass_obj
+def daemon(
+    obj: Dict,
+    jobs: Optional[int],
+    keep_going: bool,
+    workers: str,
+    no_cache: bool,
+    cache_size: int,
+    poll: bool,
+):
+    """Keep your package built, and build it for cfpm build."""
+    run_daemon(
+        obj, jobs, keep_going, workers, no_cache, cache_size, poll, True
+    )
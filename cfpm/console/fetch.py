@@ -0,0 +1,52 @@
+"""Command fetch."""
+
+import click
+import pathlib
+from typing import Dict, Optional
+from ..exceptions import BadConfigurationError, ExternalProgramError
+from ..logging import logger
+from ..packages import LockedPackage, PackageStore, fetch_dependencies
+from ..utils import handle
+from .build import load_package_config
+from .cli import start_log_pipeline
+
+
+@click.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of repositories fetched in parallel.",
+)
+@click.option(
+    "-u",
+    "--update",
+    is_flag=True,
+    help="Update dependencies to the newest matching versions, ignoring "
+    "cfpm.lock.",
+)
+@click.pass_obj
+def fetch(obj: Dict, jobs: Optional[int], update: bool):
+    """Fetch the dependencies of your package into build/deps."""
+    start_log_pipeline(obj)
+    root = pathlib.Path(".").absolute()
+    config = load_package_config(obj, root)
+    store = PackageStore(obj["cfpm_home"] / "packages", jobs)
+
+    def installed(package: LockedPackage) -> None:
+        logger.info("Installed {} {}.".format(package.name, package.version))
+
+    try:
+        packages = handle(
+            fetch_dependencies,
+            (BadConfigurationError, ExternalProgramError),
+            root,
+            config,
+            store,
+            update,
+            installed,
+        )
+    finally:
+        store.close()
+    logger.info("{} packages are up to date.".format(len(packages)))
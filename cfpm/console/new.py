@@ -64,6 +64,77 @@ int main(int argc, char const *argv[]) {
 # fmt: on
 
 
+# Functions in every synthetic header, so sources take some time to compile
+SYNTHETIC_FUNCTIONS = 8
+
+
+def synthetic_templates(
+    targets: int, sources: int, fanout: int
+) -> Dict[str, str]:
+    """
+    Templates of a synthetic package, used to benchmark builds.
+
+    The package has targets static libraries of sources C sources each, and
+    an executable app linking all of them. Every source includes fanout of
+    2 * fanout shared headers in include/.
+    """
+    templates: Dict[str, str] = {}
+    headers = 2 * fanout
+    for h in range(headers):
+        functions = "".join(
+            "static inline int h{0}_f{1}(int x) {{\n"
+            "    return (x * {2} + {1}) ^ (x >> {3});\n"
+            "}}\n".format(h, f, h + f + 3, f % 7 + 1)
+            for f in range(SYNTHETIC_FUNCTIONS)
+        )
+        templates["include/h{}.h".format(h)] = (
+            "#ifndef H{0}_H\n#define H{0}_H\n\n{1}\n#endif\n".format(
+                h, functions
+            )
+        )
+    templates["include/targets.h"] = "".join(
+        "int t{}_s0(int x);\n".format(t) for t in range(targets)
+    )
+    config = (
+        '[package]\nname = "%NAME%"\nversion = "0.1.0"\n\n'
+        'c_standard = "99"\n'
+    )
+    for t in range(targets):
+        config += '\n[[targets]]\ndir = "t{0}"\nname = "t{0}"\n'.format(t)
+        templates["t{0}/t{0}.toml".format(t)] = (
+            '[target]\ntype = "lib"\nheaders = ["../include"]\n'
+            'sources = ["."]\n'
+        )
+        for i in range(sources):
+            included = [(i + t + k) % headers for k in range(fanout)]
+            body = "".join(
+                "    x = h{}_f{}(x);\n".format(
+                    h, (i + k) % SYNTHETIC_FUNCTIONS
+                )
+                for (k, h) in enumerate(included)
+            )
+            templates["t{}/s{}.c".format(t, i)] = (
+                "".join('#include "h{}.h"\n'.format(h) for h in included)
+                + "\nint t{}_s{}(int x) {{\n{}    return x;\n}}\n".format(
+                    t, i, body
+                )
+            )
+    config += '\n[[targets]]\ndir = "app"\nname = "app"\n'
+    templates["app/app.toml"] = (
+        '[target]\ntype = "bin"\nheaders = ["../include"]\n'
+        'sources = ["."]\ndeps = [{}]\n'.format(
+            ", ".join('"t{}"'.format(t) for t in range(targets))
+        )
+    )
+    templates["app/main.c"] = (
+        '#include "targets.h"\n\nint main(void) {\n    int x = 0;\n'
+        + "".join("    x += t{}_s0(x);\n".format(t) for t in range(targets))
+        + "    return x == 0x7fffffff;\n}\n"
+    )
+    templates["cfpm.toml"] = config
+    return templates
+
+
 def check_package_name(name: str) -> None:
     """Check if package name is avaliable. Raise exceptions otherwise."""
     if not vaild_name.match(name):
@@ -80,19 +151,57 @@ def check_package_name(name: str) -> None:
         )
 
 
-@click.command()
-@click.argument("package_name", envvar="CFPM_NEW_PACKAGE_NAME")
-def new(package_name: str):
-    """Create a new package."""
-    handle(check_package_name, BadConfigurationError, package_name)
-    package_dir = pathlib.Path(".").absolute() / package_name
-    for (dest, content) in TEMPLATES.items():
+def write_templates(
+    package_dir: pathlib.Path, package_name: str, templates: Dict[str, str]
+) -> None:
+    """Write templates into package_dir, exit if failed."""
+    for (dest, content) in templates.items():
         write_file = package_dir / dest
         write_base_dir = pathlib.Path(*write_file.parts[:-1])
         handle(write_base_dir.mkdir, OSError, parents=True, exist_ok=True)
         with handle(open, OSError, write_file, "w") as f:
             logger.debug("Created file {}.".format(write_file))
             f.write(content.replace("%NAME%", package_name))
+
+
+@click.command()
+@click.argument("package_name", envvar="CFPM_NEW_PACKAGE_NAME")
+@click.option(
+    "--synthetic",
+    is_flag=True,
+    help="Create a synthetic package to benchmark builds.",
+)
+@click.option(
+    "--targets",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of libraries of the synthetic package.",
+)
+@click.option(
+    "--sources",
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of sources of each library.",
+)
+@click.option(
+    "--fanout",
+    type=click.IntRange(min=0),
+    default=4,
+    show_default=True,
+    help="Number of headers included by each source.",
+)
+def new(
+    package_name: str, synthetic: bool, targets: int, sources: int, fanout: int
+):
+    """Create a new package."""
+    handle(check_package_name, BadConfigurationError, package_name)
+    package_dir = pathlib.Path(".").absolute() / package_name
+    templates = TEMPLATES
+    if synthetic:
+        templates = synthetic_templates(targets, sources, fanout)
+    write_templates(package_dir, package_name, templates)
     logger.info(
         click.style(
             "Successfully created package {}.".format(package_name), fg="green"
@@ -0,0 +1,142 @@
+"""Command test."""
+
+import click
+import pathlib
+from typing import Dict, List, Optional, Tuple
+from ..logging import logger
+from ..projects import TestTarget
+from ..testing import (
+    DEFAULT_TEST_TIMEOUT,
+    TestCase,
+    TestHistory,
+    parse_shard,
+    run_tests,
+    shard as select_shard,
+    write_junit,
+)
+from ..utils import handle, error_exit
+from .build import load_package_config, run_build
+from .cache import cache_size_option
+
+
+def _parse_shard(
+    ctx: click.Context, param: click.Parameter, value: Optional[str]
+) -> Optional[Tuple[int, int]]:
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@click.command()
+@click.argument("names", nargs=-1)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of jobs building and tests running in parallel. "
+    "[default: number of CPUs]",
+)
+@click.option(
+    "-k",
+    "--keep-going",
+    is_flag=True,
+    help="Keep going with other jobs after a job of the build failed.",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="Seconds each test may run, overriding timeout of the targets. "
+    "[default: {:.0f}]".format(DEFAULT_TEST_TIMEOUT),
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=_parse_shard,
+    help="Only build and run the tests of a shard, e.g. 2/4 for the "
+    "second of four CI machines.",
+)
+@click.option(
+    "--junit",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the results to the file as JUnit XML.",
+)
+@click.option("--no-cache", is_flag=True, help="Don't use the object cache.")
+@cache_size_option
+@click.pass_obj
+def test(
+    obj: Dict,
+    names: Tuple[str, ...],
+    jobs: Optional[int],
+    keep_going: bool,
+    timeout: Optional[float],
+    shard: Optional[Tuple[int, int]],
+    junit: Optional[str],
+    no_cache: bool,
+    cache_size: int,
+):
+    """
+    Build and run the tests of your package, or the given tests.
+
+    Tests failed last time run first, then the longest ones.
+    """
+    root = pathlib.Path(".").absolute()
+    config = load_package_config(obj, root)
+    tests = [
+        str(x.get("name"))
+        for x in config.get("targets", [])
+        if x.get("target", {}).get("type") == "test"
+    ]
+    for name in names:
+        if name not in tests:
+            logger.error("Target {} is not a test.".format(name))
+            error_exit()
+    selected = list(names) or tests
+    if shard:
+        selected = select_shard(selected, *shard)
+    cases: List[TestCase] = []
+    build_dir = root / "build"
+    if selected:
+        build = run_build(
+            obj,
+            jobs,
+            keep_going,
+            False,
+            "",
+            no_cache,
+            cache_size,
+            targets=selected,
+        )
+        for name in selected:
+            target = build.project.target(name)
+            assert isinstance(target, TestTarget)
+            cases.append(
+                TestCase(
+                    name,
+                    target.output(build_dir),
+                    target.args,
+                    target.directory,
+                    timeout or target.timeout or DEFAULT_TEST_TIMEOUT,
+                )
+            )
+    else:
+        logger.info("No tests to run.")
+    history = TestHistory(build_dir / "tests.json")
+    results = run_tests(cases, jobs, history)
+    handle(history.save, OSError)
+    if junit:
+        suite = str(config.get("package", {}).get("name", root.name))
+        handle(write_junit, OSError, junit, suite, results)
+        logger.info("Wrote JUnit XML to {}.".format(junit))
+    failed = [x.name for x in results if x.failed]
+    logger.info(
+        "{} passed, {} failed.".format(len(results) - len(failed), len(failed))
+    )
+    if failed:
+        logger.error("Failed tests: {}.".format(", ".join(failed)))
+        error_exit()
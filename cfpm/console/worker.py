@@ -0,0 +1,54 @@
+"""Command worker."""
+
+import click
+from typing import Dict, Optional
+from ..logging import logger
+from ..remote import (
+    DEFAULT_WORKER_ADDRESS,
+    Worker,
+    WorkerPool,
+    parse_address,
+)
+from ..utils import handle
+from .cli import start_log_pipeline
+
+
+def open_worker_pool(workers: str) -> Optional[WorkerPool]:
+    """Connect to comma separated addresses of workers, None if empty."""
+    addresses = [x.strip() for x in workers.split(",") if x.strip()]
+    return handle(WorkerPool, ValueError, addresses) if addresses else None
+
+
+@click.command()
+@click.option(
+    "-l",
+    "--listen",
+    default=DEFAULT_WORKER_ADDRESS,
+    envvar="CFPM_WORKER_LISTEN",
+    show_default=True,
+    help="Address to listen on, host:port or unix:path.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of compilers running in parallel. [default: number of "
+    "CPUs]",
+)
+@click.pass_obj
+def worker(obj: Dict, listen: str, jobs: Optional[int]):
+    """Compile for remote builds."""
+    start_log_pipeline(obj)
+    address = handle(parse_address, ValueError, listen)
+    compile_worker = Worker(jobs)
+    server = handle(compile_worker.server, OSError, address)
+    logger.info(
+        "Listening on {} with {} slots.".format(listen, compile_worker.jobs)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopped.")
+    finally:
+        server.server_close()
@@ -0,0 +1,474 @@
+"""A long-lived build daemon watching the source tree."""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import pathlib
+import select
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from .artifacts import ArtifactCache
+from .cache import ObjectCache
+from .config import ConfigCache, load_config
+from .depgraph import DependencyGraph
+from .drivers import ProbeCache
+from .exceptions import BadConfigurationError, ExternalProgramError
+from .logging import logger
+from .projects import Build
+from .remote import WorkerPool, recv_message, send_message
+from .scheduler import DurationHistory, ResourceHistory
+from .sources import SourceFinder
+
+# Name of the Unix socket of the daemon in the build directory
+DAEMON_SOCKET = "daemon.sock"
+
+# Seconds to wait for more changes before rebuilding, editors write a file
+# in several steps.
+DEBOUNCE = 0.05
+
+# Seconds between scans of the polling watcher
+POLL_INTERVAL = 0.5
+
+# Events of inotify, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _walk_dirs(
+    root: pathlib.Path, ignored: Callable[[str], bool]
+) -> List[str]:
+    """List root and all the directories under it not ignored."""
+    result = []
+    for (directory, dirs, _) in os.walk(root):
+        result.append(directory)
+        dirs[:] = [x for x in dirs if not ignored(os.path.join(directory, x))]
+    return result
+
+
+class PollingWatcher:
+    """Watch a directory tree by comparing snapshots of it."""
+
+    def __init__(
+        self, root: pathlib.Path, ignored: Callable[[str], bool]
+    ) -> None:
+        """
+        Take the first snapshot of root.
+
+        Args:
+            root: The directory to watch.
+            ignored: A function checking if a path shouldn't be watched.
+        """
+        self.root = root
+        self.ignored = ignored
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        result: Dict[str, Tuple[int, int]] = {}
+        for directory in _walk_dirs(self.root, self.ignored):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:  # Removed while walking
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        result[entry.path] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    pass
+        return result
+
+    def wait(self, timeout: float) -> List[str]:
+        """Wait up to timeout seconds for changes, returns changed paths."""
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._snapshot()
+            changed = [
+                x
+                for x in set(snapshot) | set(self.snapshot)
+                if snapshot.get(x) != self.snapshot.get(x)
+            ]
+            self.snapshot = snapshot
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+    def close(self) -> None:
+        """Stop watching."""
+
+
+class InotifyWatcher:
+    """Watch a directory tree with inotify of Linux."""
+
+    def __init__(
+        self, root: pathlib.Path, ignored: Callable[[str], bool]
+    ) -> None:
+        """
+        Watch every directory under root.
+
+        Raise an OSError if inotify isn't available.
+        """
+        self.root = root
+        self.ignored = ignored
+        name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(name, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches: Dict[int, str] = {}
+        self._add_tree(str(root))
+
+    def _add_tree(self, top: str) -> List[str]:
+        """Watch directories under top, returns files already in them."""
+        files: List[str] = []
+        for directory in _walk_dirs(pathlib.Path(top), self.ignored):
+            self._add(directory)
+            # Files created before the watch is added are not notified.
+            try:
+                files.extend(
+                    x.path for x in os.scandir(directory) if x.is_file()
+                )
+            except OSError:
+                pass
+        return files
+
+    def _add(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), IN_WATCH_MASK
+        )
+        if wd >= 0:
+            self.watches[wd] = directory
+        else:  # Removed already, or out of watches
+            logger.debug(
+                "Failed to watch {}: {}".format(
+                    directory, os.strerror(ctypes.get_errno())
+                )
+            )
+
+    def _read(self) -> List[str]:
+        changed: List[str] = []
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.append(str(self.root))
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                path = os.path.join(self.watches.get(wd, ""), name)
+                if not name or self.ignored(path):
+                    continue
+                changed.append(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self._add_tree(path))
+
+    def wait(self, timeout: float) -> List[str]:
+        """Wait up to timeout seconds for changes, returns changed paths."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            changed = self._read() if readable else []
+            if changed or remaining <= 0:
+                return changed
+
+    def close(self) -> None:
+        """Stop watching."""
+        os.close(self.fd)
+
+
+def create_watcher(
+    root: pathlib.Path, ignored: Callable[[str], bool], polling: bool = False
+):
+    """Create an inotify watcher if possible, a polling one otherwise."""
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, ignored)
+        except (OSError, AttributeError) as e:
+            logger.debug("Falling back to polling: {}".format(e))
+    return PollingWatcher(root, ignored)
+
+
+class _ForwardHandler(logging.Handler):
+    """Send log records to a client of the daemon."""
+
+    def __init__(self, sock: socket.socket):
+        logging.Handler.__init__(self)
+        self.sock = sock
+
+    def emit(self, record):
+        try:
+            send_message(
+                self.sock,
+                {
+                    "op": "log",
+                    "level": record.levelno,
+                    "message": record.getMessage(),
+                },
+            )
+        except OSError:  # The client is gone, the build goes on.
+            pass
+
+
+class Daemon:
+    """
+    A long-lived build of a project.
+
+    The dependency graph, the source index, the compiler probes and the
+    parsed configuration are kept in memory between builds, so a rebuild
+    only stats the inputs before running the compilers. Builds are run one
+    at a time, triggered by changes of the source tree or by clients.
+    """
+
+    def __init__(
+        self,
+        root: pathlib.Path,
+        cfpm_home: pathlib.Path,
+        jobs: Optional[int] = None,
+        keep_going: bool = False,
+        cache: Optional[ObjectCache] = None,
+        workers: Optional[WorkerPool] = None,
+        artifacts: Optional[ArtifactCache] = None,
+    ):
+        """
+        Initialize the daemon of the project at root.
+
+        Args:
+            root: The root directory of the project.
+            cfpm_home: The cfpm home directory.
+            jobs: Number of jobs running in parallel.
+            keep_going: Keep building other targets after a failure.
+            cache: The object cache to use.
+            workers: Remote workers to compile on.
+            artifacts: The cache of prebuilt packages.
+        """
+        self.root = root
+        self.build_dir = root / "build"
+        self.jobs = jobs
+        self.keep_going = keep_going
+        self.cache = cache
+        self.workers = workers
+        self.artifacts = artifacts
+        self.configs = ConfigCache(cfpm_home / "configs")
+        self.probes = ProbeCache(cfpm_home / "probes.json")
+        self.history = DurationHistory(cfpm_home / "durations.json")
+        self.resources = ResourceHistory(cfpm_home / "resources.json")
+        self.lto_cache = cfpm_home / "lto"
+        self.graph = DependencyGraph(self.build_dir / "deps.json")
+        self.finder = SourceFinder(self.build_dir / "sources.json")
+        self._lock = threading.Lock()
+
+    def ignored(self, path: str) -> bool:
+        """Check if a change of path doesn't matter to builds."""
+        rel = os.path.relpath(path, self.root)
+        parts = pathlib.PurePath(rel).parts
+        return bool(parts) and (
+            parts[0] == "build" or any(x.startswith(".") for x in parts)
+        )
+
+    def build(
+        self,
+        handler: Optional[logging.Handler] = None,
+        jobs: Optional[int] = None,
+        keep_going: Optional[bool] = None,
+        compdb: bool = False,
+    ) -> bool:
+        """
+        Build the project, returns if succeeded.
+
+        Args:
+            handler: An extra handler of the logs of this build.
+            jobs: Override the number of jobs of the daemon.
+            keep_going: Override keep_going of the daemon.
+            compdb: Write the compilation database before building.
+        """
+        with self._lock:
+            if handler:
+                logger.addHandler(handler)
+            try:
+                config = load_config(self.root, self.configs)
+                build = Build(
+                    config,
+                    self.root,
+                    jobs=jobs or self.jobs,
+                    keep_going=(
+                        self.keep_going if keep_going is None else keep_going
+                    ),
+                    cache=self.cache,
+                    probes=self.probes,
+                    workers=self.workers,
+                    graph=self.graph,
+                    finder=self.finder,
+                    history=self.history,
+                    artifacts=self.artifacts,
+                    resources=self.resources,
+                    lto_cache=self.lto_cache,
+                )
+                if compdb:
+                    build.write_compdb()
+                build.build()
+                return True
+            except (
+                BadConfigurationError,
+                ExternalProgramError,
+                OSError,
+            ) as e:
+                logger.error(e)
+                return False
+            finally:
+                if handler:
+                    logger.removeHandler(handler)
+
+    def watch(
+        self,
+        stop: Optional[threading.Event] = None,
+        polling: bool = False,
+        compdb: bool = False,
+    ) -> None:
+        """
+        Rebuild whenever the source tree changes, until stop is set.
+
+        Args:
+            stop: The event stopping the loop, checked every second.
+            polling: Poll the tree even if inotify is available.
+            compdb: Write the compilation database before every rebuild.
+        """
+        stop = stop or threading.Event()
+        watcher = create_watcher(self.root, self.ignored, polling)
+        try:
+            while not stop.is_set():
+                changed = watcher.wait(1.0)
+                if not changed:
+                    continue
+                while True:
+                    more = watcher.wait(DEBOUNCE)
+                    if not more:
+                        break
+                    changed.extend(more)
+                logger.info(
+                    "{} file(s) changed, rebuilding.".format(len(set(changed)))
+                )
+                self.build(compdb=compdb)
+        finally:
+            watcher.close()
+
+    def server(self) -> socketserver.BaseServer:
+        """Create a server of the daemon on its Unix socket."""
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    header, _ = recv_message(self.request)
+                except (ConnectionError, struct.error, ValueError):
+                    return
+                if header.get("op") != "build":
+                    op = header.get("op")
+                    send_message(
+                        self.request, {"error": "Unknown op {}.".format(op)}
+                    )
+                    return
+                ok = daemon.build(
+                    _ForwardHandler(self.request),
+                    header.get("jobs"),
+                    header.get("keep_going"),
+                    bool(header.get("compdb")),
+                )
+                try:
+                    send_message(self.request, {"op": "done", "ok": ok})
+                except OSError:
+                    pass
+
+        path = str(self.build_dir / DAEMON_SOCKET)
+        self.build_dir.mkdir(exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        return server
+
+
+def request_build(
+    root: pathlib.Path,
+    jobs: Optional[int] = None,
+    keep_going: Optional[bool] = None,
+    compdb: bool = False,
+) -> Optional[bool]:
+    """
+    Ask the daemon of the project at root to build it.
+
+    The compilation database is written first if compdb is True.
+
+    The logs of the build are logged here as they come.
+
+    Returns: If the build succeeded, or None if no daemon is running.
+    """
+    path = root / "build" / DAEMON_SOCKET
+    if not hasattr(socket, "AF_UNIX") or not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(str(path))
+        except OSError as e:  # A stale socket
+            logger.debug("Daemon is not running: {}".format(e))
+            return None
+        logger.debug("Building with the daemon at {}.".format(path))
+        send_message(
+            sock,
+            {
+                "op": "build",
+                "jobs": jobs,
+                "keep_going": keep_going,
+                "compdb": compdb,
+            },
+        )
+        while True:
+            header, _ = recv_message(sock)
+            if header.get("op") == "log":
+                logger.log(int(header["level"]), header["message"])
+            elif "error" in header:
+                raise ExternalProgramError(header["error"])
+            else:
+                return bool(header.get("ok"))
+    except (ConnectionError, struct.error) as e:
+        raise ExternalProgramError("Lost the daemon: {}".format(e))
+    finally:
+        sock.close()
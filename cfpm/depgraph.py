@@ -0,0 +1,212 @@
+"""Dependency tracking of objects for incremental builds."""
+
+import hashlib
+import json
+import os
+import pathlib
+import threading
+from typing import Dict, List, Optional, Tuple
+from .cache import hash_file
+from .logging import logger
+from .utils import Pathlike
+
+# Bump this when the format of the dependency file changes.
+GRAPH_VERSION = 1
+
+
+def parse_depfile(path: Pathlike) -> List[str]:
+    """
+    Parse a make-style depfile written by -MMD -MF.
+
+    Returns: The prerequisites of the first rule, which are the source and
+        all the included headers.
+    """
+    with open(path, "r") as f:
+        content = f.read()
+    content = content.replace("\\\r\n", " ").replace("\\\n", " ")
+    # Only the first rule counts, -MP may add phony rules of headers.
+    rule = content.split("\n", 1)[0]
+    # The colon of the rule is the first one followed by a whitespace, so
+    # Windows drive letters are kept.
+    colon = rule.find(": ")
+    if colon < 0:
+        colon = rule.rstrip().find(":")
+        if colon < 0 or colon != len(rule.rstrip()) - 1:
+            raise ValueError("Bad depfile {}.".format(path))
+    deps: List[str] = []
+    current = ""
+    escaped = False
+    for c in rule[colon + 1:].replace("$$", "$"):
+        if escaped:
+            current += c if c in " #\\" else "\\" + c
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c.isspace():
+            if current:
+                deps.append(current)
+            current = ""
+        else:
+            current += c
+    if escaped:
+        current += "\\"
+    if current:
+        deps.append(current)
+    return deps
+
+
+class DependencyGraph:
+    """
+    A persistent graph from objects to their inputs.
+
+    Each object records the digest of its compile command and the combined
+    digest of its inputs when it was built. Input files are checked by mtime
+    and size first and only hashed again if those changed, so a no-op build
+    costs a stat per input.
+    """
+
+    def __init__(self, path: Pathlike):
+        """
+        Load the graph from path.
+
+        A missing or broken file is treated as an empty graph.
+        """
+        self.path = pathlib.Path(path)
+        # path -> (mtime_ns, size, sha256)
+        self.files: Dict[str, Tuple[int, int, str]] = {}
+        # obj -> {"args": digest, "inputs": [path], "digest": digest}
+        self.objects: Dict[str, Dict] = {}
+        self._checked: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data["version"] == GRAPH_VERSION:
+                paths = data["paths"]
+                self.files = {
+                    paths[int(k)]: tuple(v)  # type: ignore
+                    for (k, v) in data["files"].items()
+                }
+                for (obj, record) in data["objects"].items():
+                    record["inputs"] = [paths[x] for x in record["inputs"]]
+                    self.objects[obj] = record
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.debug("Ignored broken {}: {}".format(self.path, e))
+
+    def save(self) -> None:
+        """Write the graph to its file, paths are stored once."""
+        with self._lock:
+            # Files no longer included by any object are dropped.
+            ids: Dict[str, int] = {}
+            objects = {}
+            for (obj, r) in self.objects.items():
+                inputs = [ids.setdefault(x, len(ids)) for x in r["inputs"]]
+                objects[obj] = dict(r, inputs=inputs)
+            data = {
+                "version": GRAPH_VERSION,
+                "paths": list(ids),
+                "files": {
+                    str(ids[k]): v for (k, v) in self.files.items() if k in ids
+                },
+                "objects": objects,
+            }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def refresh(self) -> None:
+        """Forget which files are checked, before building again."""
+        with self._lock:
+            self._checked = {}
+
+    def file_digest(self, path: str) -> Optional[str]:
+        """
+        Get the sha256 of a file, or None if it doesn't exist.
+
+        Every file is checked at most once until refresh is called.
+        """
+        with self._lock:
+            if path in self._checked:
+                return self._checked[path]
+        try:
+            st = os.stat(path)
+            record = self.files.get(path)
+            if record and record[:2] == (st.st_mtime_ns, st.st_size):
+                digest: Optional[str] = record[2]
+            else:
+                digest = hash_file(path)
+                with self._lock:
+                    self.files[path] = (st.st_mtime_ns, st.st_size, digest)
+        except FileNotFoundError:
+            digest = None
+        with self._lock:
+            self._checked[path] = digest
+        return digest
+
+    def digest(self, inputs: List[str]) -> Optional[str]:
+        """Combine digests of inputs, None if any of them doesn't exist."""
+        h = hashlib.sha256()
+        for path in inputs:
+            digest = self.file_digest(path)
+            if digest is None:
+                return None
+            h.update(path.encode())
+            h.update(b"\0")
+            h.update(digest.encode())
+        return h.hexdigest()
+
+    def up_to_date(self, obj: pathlib.Path, args: str) -> bool:
+        """
+        Check if obj is built from the same command and inputs.
+
+        Args:
+            obj: The object.
+            args: The digest of the compile command.
+        """
+        record = self.objects.get(str(obj))
+        if not record or record["args"] != args or not obj.exists():
+            return False
+        return self.digest(record["inputs"]) == record["digest"]
+
+    def output_up_to_date(
+        self, out: pathlib.Path, args: str, inputs: List[str]
+    ) -> bool:
+        """
+        Check if out is built from the same command and inputs.
+
+        Unlike up_to_date, inputs are not hashed, out only has to be newer
+        than all of them. This is for linked outputs, whose inputs are
+        objects only written when they changed.
+        """
+        record = self.objects.get(str(out))
+        if not record or record["args"] != args or record["inputs"] != inputs:
+            return False
+        try:
+            mtime = os.stat(out).st_mtime_ns
+            return all(os.stat(x).st_mtime_ns <= mtime for x in inputs)
+        except FileNotFoundError:
+            return False
+
+    def record(
+        self,
+        obj: pathlib.Path,
+        args: str,
+        inputs: List[str],
+        digest: Optional[str],
+    ) -> None:
+        """
+        Record obj as built from the command and inputs.
+
+        The digest of inputs is None for outputs checked by mtime, see
+        output_up_to_date.
+        """
+        with self._lock:
+            self.objects[str(obj)] = {
+                "args": args,
+                "inputs": inputs,
+                "digest": digest,
+            }
@@ -1,12 +1,81 @@
 """Command line program drivers."""
 
+import asyncio
+import hashlib
+import json
+import locale
 import pathlib
 import os
+import selectors
+import signal
 import subprocess
-from typing import List, Optional, Dict
+import sys
+import tempfile
+import threading
+from typing import (
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+)
 from .logging import logger
+from .profiling import tracer
 from .utils import ensure_path, Pathlike
 
+# Buffer limit of a line streamed from a program, in bytes
+STREAM_LIMIT = 1 << 20
+
+# If the resource usage of each program can be measured
+MEASURED = hasattr(os, "wait4")
+
+# If programs can be started without forking cfpm
+POSIX_SPAWN = hasattr(os, "posix_spawn")
+
+# Bytes of the common arguments of a compiler moved into a response file
+RESPONSE_FILE_THRESHOLD = 8192
+
+
+class ResourceUsage(NamedTuple):
+    """Resources used by a finished program."""
+
+    # Peak resident set size in bytes
+    max_rss: int
+    # User and system CPU time in seconds
+    cpu_seconds: float
+
+
+class MeasuredProcess(subprocess.CompletedProcess):
+    """A CompletedProcess with the resource usage of the program."""
+
+    def __init__(
+        self,
+        args: List[str],
+        returncode: int,
+        stdout=None,
+        stderr=None,
+        usage: Optional[ResourceUsage] = None,
+    ):  # noqa: D107
+        super().__init__(args, returncode, stdout, stderr)
+        self.usage = usage
+
+
+def find_program(program_name: str) -> str:
+    """
+    Search for the executable program_name in PATH.
+
+    Returns: The path of the executable. Raise a RuntimeError if it's not
+        found.
+    """
+    for p in os.environ.get("PATH", "").split(os.pathsep):
+        possible_path = pathlib.Path(p) / program_name
+        if possible_path.is_file():
+            logger.debug("Found {} in {}.".format(program_name, possible_path))
+            return str(possible_path)
+    raise RuntimeError("Program {} is not found in PATH.".format(program_name))
+
 
 class CLIDriver:
     """
@@ -36,30 +105,312 @@ class CLIDriver:
             path = ensure_path(program_name)
             self.program = str(path)
         else:  # Searches for the executable in PATH.
-            path_list = list(map(pathlib.Path, os.environ["PATH"].split(":")))
-            for p in path_list:
-                possible_path = p / program_name
-                if possible_path.is_file():
-                    logger.debug(
-                        "Found {} in {}.".format(program_name, possible_path)
-                    )
-                    self.program = str(possible_path)
-                    return
-            raise RuntimeError(
-                "Program {} is not found in PATH.".format(program_name)
-            )
+            self.program = find_program(str(program_name))
+        # Converting os.environ for every program is slow, it's copied once.
+        self.environment = dict(os.environ)
 
     def run(self, args: List[str], **kwargs) -> subprocess.CompletedProcess:
         """
         Execute self with arguments and args blocked.
 
         Extra args and kwargs will be passed into the underlying
-        subprocess.call.
+        subprocess.run. Where supported, the result is a MeasuredProcess
+        with the resource usage of the program.
         """
         a = [self.program]
         a.extend(args)
         logger.debug("Running {}.".format(a))
-        return subprocess.run(a, **kwargs)
+        with tracer.span(os.path.basename(self.program), "process", args=a):
+            if MEASURED:
+                kwargs.setdefault("env", self.environment)
+                return _run_measured(a, **kwargs)
+            return subprocess.run(a, **kwargs)
+
+    async def run_async(
+        self,
+        args: List[str],
+        on_line: Optional[Callable[[str], None]] = None,
+        **kwargs
+    ) -> subprocess.CompletedProcess:
+        """
+        Execute self with arguments args in asyncio.
+
+        Lines of stdout and stderr are passed to on_line as soon as they are
+        printed, and logged as warnings if on_line is None. The output is not
+        kept in the returned CompletedProcess. Extra kwargs will be passed
+        into the underlying asyncio.create_subprocess_exec.
+        """
+        a = [self.program]
+        a.extend(args)
+        logger.debug("Running {}.".format(a))
+        if on_line is None:
+            on_line = logger.warning
+        with tracer.span(os.path.basename(self.program), "process", args=a):
+            if MEASURED:
+                kwargs.setdefault("env", self.environment)
+                return await _run_measured_async(a, on_line, **kwargs)
+            process = await asyncio.create_subprocess_exec(
+                *a,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=STREAM_LIMIT,
+                **kwargs
+            )
+            await asyncio.gather(
+                _stream_lines(process.stdout, on_line),
+                _stream_lines(process.stderr, on_line),
+            )
+            return subprocess.CompletedProcess(a, await process.wait())
+
+
+def exit_code(status: int) -> int:
+    """
+    Convert a status of wait4 into an exit code like Popen.returncode.
+
+    Programs killed by a signal get the negative signal number.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _usage(status: int, rusage) -> Tuple[int, ResourceUsage]:
+    """Convert the results of wait4 into an exit code and the usage."""
+    code = exit_code(status)
+    max_rss = rusage.ru_maxrss
+    if sys.platform != "darwin":  # KiB instead of bytes
+        max_rss *= 1024
+    return (code, ResourceUsage(max_rss, rusage.ru_utime + rusage.ru_stime))
+
+
+class _Child:
+    """A running program started by _spawn, reaped with wait4."""
+
+    def __init__(
+        self,
+        pid: int,
+        stdout: Optional[int],
+        stderr: Optional[int],
+        process: Optional[subprocess.Popen] = None,
+    ):
+        self.pid = pid
+        # File descriptors of the pipes of the outputs
+        self.stdout = stdout
+        self.stderr = stderr
+        self.process = process
+
+    def reaped(self, returncode: int) -> None:
+        """Tell Popen the program is reaped, so it won't wait for it."""
+        if self.process:
+            self.process.returncode = returncode
+
+    def kill(self) -> None:
+        """Kill and reap the program."""
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            return
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except ChildProcessError:  # Reaped already
+            pass
+
+
+def _spawn(args: List[str], stdout=None, stderr=None, **kwargs) -> _Child:
+    """
+    Start args with stdout and stderr given like Popen.
+
+    Programs are started with posix_spawn if possible, which doesn't copy
+    the page tables of a large cfpm like the fork of Popen does. Options
+    posix_spawn doesn't support, like cwd, fall back to Popen. The outputs
+    piped are returned as file descriptors.
+    """
+    env = kwargs.pop("env", None)
+    spawn = POSIX_SPAWN and not kwargs
+    ends: Dict[int, Tuple[int, int]] = {}  # fd -> (read, write) of pipes
+    try:
+        for (fd, mode) in ((1, stdout), (2, stderr)):
+            if mode == subprocess.PIPE:
+                ends[fd] = os.pipe()
+            elif mode is not None:
+                spawn = False
+        if spawn:
+            actions = [
+                (os.POSIX_SPAWN_DUP2, w, x) for (x, (_, w)) in ends.items()
+            ]
+            pid = os.posix_spawn(
+                args[0],
+                args,
+                os.environ if env is None else env,
+                file_actions=actions,
+            )
+            process = None
+        else:
+            process = subprocess.Popen(
+                args,
+                stdout=ends[1][1] if 1 in ends else stdout,
+                stderr=ends[2][1] if 2 in ends else stderr,
+                env=env,
+                **kwargs
+            )
+            pid = process.pid
+    except BaseException:
+        for (read, _) in ends.values():
+            os.close(read)
+        raise
+    finally:
+        for (_, write) in ends.values():
+            os.close(write)
+    return _Child(
+        pid,
+        ends[1][0] if 1 in ends else None,
+        ends[2][0] if 2 in ends else None,
+        process,
+    )
+
+
+def _read_pipes(fds: List[int]) -> List[bytes]:
+    """Read pipes until they're closed, like Popen.communicate."""
+    chunks: Dict[int, List[bytes]] = {x: [] for x in fds}
+    with selectors.DefaultSelector() as selector:
+        for fd in fds:
+            selector.register(fd, selectors.EVENT_READ)
+        while selector.get_map():
+            for (key, _) in selector.select():
+                data = os.read(key.fd, 1 << 16)
+                if data:
+                    chunks[key.fd].append(data)
+                else:
+                    selector.unregister(key.fd)
+    return [b"".join(chunks[x]) for x in fds]
+
+
+def _run_measured(
+    args: List[str],
+    capture_output: bool = False,
+    text: bool = False,
+    **kwargs
+) -> MeasuredProcess:
+    """
+    Run args like subprocess.run, reaping the program with wait4.
+
+    Popen would reap the program with waitpid, which loses its usage. Its
+    output is read here instead of by Popen.communicate, which waits.
+    """
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    child = _spawn(args, **kwargs)
+    fds = [x for x in (child.stdout, child.stderr) if x is not None]
+    try:
+        try:
+            data = iter(_read_pipes(fds))
+        finally:
+            for fd in fds:
+                os.close(fd)
+        _, status, rusage = os.wait4(child.pid, 0)
+    except BaseException:
+        child.kill()
+        raise
+    returncode, usage = _usage(status, rusage)
+    child.reaped(returncode)
+    outputs: List = []
+    for pipe in (child.stdout, child.stderr):
+        output = next(data) if pipe is not None else None
+        if text and output is not None:  # Decoded like Popen does
+            decoded = output.decode(locale.getpreferredencoding(False))
+            outputs.append(
+                decoded.replace("\r\n", "\n").replace("\r", "\n")
+            )
+        else:
+            outputs.append(output)
+    return MeasuredProcess(args, returncode, outputs[0], outputs[1], usage)
+
+
+def _wait4_async(pid: int) -> "asyncio.Future":
+    """Reap pid with wait4 in a thread, like the child watchers of asyncio."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def wait() -> None:
+        try:
+            result = os.wait4(pid, 0)
+        except OSError as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+
+    threading.Thread(target=wait, daemon=True).start()
+    return future
+
+
+async def _run_measured_async(
+    args: List[str], on_line: Callable[[str], None], **kwargs
+) -> MeasuredProcess:
+    """Run args like CLIDriver.run_async, reaping the program with wait4."""
+    loop = asyncio.get_running_loop()
+    child = _spawn(args, subprocess.PIPE, subprocess.PIPE, **kwargs)
+    transports = []
+    try:
+        readers = []
+        for fd in (child.stdout, child.stderr):
+            assert fd is not None
+            # The transport closes the pipe.
+            pipe = os.fdopen(fd, "rb")
+            reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+            protocol = asyncio.StreamReaderProtocol(reader)
+            transport, _ = await loop.connect_read_pipe(
+                lambda: protocol, pipe
+            )
+            transports.append(transport)
+            readers.append(reader)
+        await asyncio.gather(*(_stream_lines(x, on_line) for x in readers))
+        _, status, rusage = await _wait4_async(child.pid)
+    except BaseException:
+        child.kill()
+        raise
+    finally:
+        for transport in transports:
+            transport.close()
+    returncode, usage = _usage(status, rusage)
+    child.reaped(returncode)
+    return MeasuredProcess(args, returncode, usage=usage)
+
+
+async def _stream_lines(
+    stream: Optional[asyncio.StreamReader], on_line: Callable[[str], None]
+) -> None:
+    if stream is None:
+        return
+    async for line in stream:
+        on_line(line.decode(errors="replace").rstrip("\r\n"))
+
+
+def _quote_response(arg: str) -> str:
+    """Quote arg for a response file read by GCC or Clang."""
+    return '"{}"'.format(arg.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def write_response_file(directory: pathlib.Path, args: List[str]) -> str:
+    """
+    Write args into a response file under directory.
+
+    The file is named by its content, so drivers with the same arguments
+    share it, and a command referring to it changes when args change.
+
+    Returns: The argument @path referring to the file.
+    """
+    content = "".join(_quote_response(x) + "\n" for x in args).encode()
+    name = hashlib.sha256(content).hexdigest()[:32] + ".rsp"
+    path = directory / name
+    if not path.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(directory), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+    return "@{}".format(path)
 
 
 class GenericDriver:
@@ -68,6 +419,18 @@ class GenericDriver:
     def __init__(self) -> None:
         """Initialize the driver."""
         self.program: Optional[CLIDriver] = None
+        self.version: str = ""
+
+    def identity(self) -> str:
+        """
+        Identify the adapted program.
+
+        Returns: A string with the path and the version of the program, which
+            changes when the program is changed.
+        """
+        if not self.program:
+            raise RuntimeError("Program hasn't been adapted.")
+        return "{}\n{}".format(self.program.program, self.version)
 
     def adapts(self, program: Pathlike) -> bool:
         """
@@ -93,6 +456,16 @@ class GenericCompilerDriver(GenericDriver):
         self.includes: List[pathlib.Path] = []
         self.link_dir: List[pathlib.Path] = []
         self.links: List[str] = []
+        self.standard: Optional[str] = None
+        self.pch: Optional[pathlib.Path] = None
+        self.linker: Optional[str] = None
+        self.link_threads: Optional[int] = None
+        self.gdb_index = False
+        self.split_dwarf = False
+        self.response_dir: Optional[pathlib.Path] = None
+        self.lto = "off"
+        self.lto_jobs: Optional[int] = None
+        self.lto_cache: Optional[pathlib.Path] = None
 
     # Arguments
     def add_definition(self, key: str, value: Optional[str] = None) -> None:
@@ -119,6 +492,105 @@ class GenericCompilerDriver(GenericDriver):
         """Add a new directory to the searching path while linking."""
         dir = ensure_path(dir, True)
         self.link_dir.append(dir)
+        self._gen_link_directory(dir)
+
+    def set_standard(self, standard: str) -> None:
+        """Set the language standard, e.g. c99 or c++11."""
+        self.standard = standard
+        self._gen_standard(standard)
+
+    def use_pch(self, header: Pathlike) -> None:
+        """
+        Include header before every source compiled.
+
+        The header should have a precompiled header built by compile_pch
+        beside it.
+        """
+        self.pch = pathlib.Path(header)
+        self._gen_pch(self.pch)
+
+    def use_linker(self, linker: str) -> None:
+        """Link with linker instead of the default one, e.g. mold or lld."""
+        self.linker = linker
+        self._gen_linker()
+
+    def set_link_threads(self, threads: int) -> None:
+        """Set the number of threads of the linker."""
+        self.link_threads = threads
+        self._gen_linker()
+
+    def set_gdb_index(self, enabled: bool = True) -> None:
+        """Let the linker write a .gdb_index so gdb loads symbols fast."""
+        self.gdb_index = enabled
+        self._gen_debug()
+        self._gen_linker()
+
+    def set_split_dwarf(self, enabled: bool = True) -> None:
+        """Write debug information to .dwo files beside the objects."""
+        self.split_dwarf = enabled
+        self._gen_debug()
+
+    def set_lto(
+        self,
+        mode: str,
+        jobs: Optional[int] = None,
+        cache: Optional[Pathlike] = None,
+    ) -> None:
+        """
+        Set the mode of link time optimization, one of LTO_MODES.
+
+        Args:
+            mode: thin optimizes modules in parallel, with a cache of them
+                where the toolchain supports one. full optimizes the whole
+                program at once.
+            jobs: Number of parallel jobs of the linker optimizing, as many
+                as CPUs if None.
+            cache: The directory of optimized modules, kept across links.
+        """
+        if mode not in LTO_MODES:
+            raise ValueError("Unknown LTO mode {}.".format(mode))
+        self.lto = mode
+        self.lto_jobs = jobs
+        self.lto_cache = pathlib.Path(cache) if cache else None
+        self._gen_lto()
+        self._gen_linker()
+
+    def use_response_files(self, directory: Pathlike) -> None:
+        """
+        Pass long common arguments in response files under directory.
+
+        Arguments shared by every compile, like the include directories, are
+        written to a response file once they exceed RESPONSE_FILE_THRESHOLD
+        bytes, so commands stay far from ARG_MAX.
+        """
+        self.response_dir = pathlib.Path(directory)
+
+    def codegen_args(self) -> List[str]:
+        """
+        Arguments changing code generation other than the standard.
+
+        Workers compile with the default arguments and the standard only,
+        so compiles with any of these are kept local.
+        """
+        raise NotImplementedError
+
+    def freeze(self) -> None:
+        """
+        Compute the arguments shared by every compile now.
+
+        They are computed once anyway, freezing a configured driver before
+        compiling in parallel only does the work up front. Changing the
+        driver afterwards computes them again.
+        """
+
+    def _gen_linker(self) -> None:
+        raise NotImplementedError
+
+    def _gen_debug(self) -> None:
+        raise NotImplementedError
+
+    def _gen_lto(self) -> None:
+        raise NotImplementedError
 
     def _gen_link_directory(self, directory: pathlib.Path) -> None:
         raise NotImplementedError
@@ -132,11 +604,84 @@ class GenericCompilerDriver(GenericDriver):
     def _gen_definition(self, key: str, value: Optional[str]) -> None:
         raise NotImplementedError
 
+    def _gen_standard(self, standard: str) -> None:
+        raise NotImplementedError
+
+    def _gen_pch(self, header: pathlib.Path) -> None:
+        raise NotImplementedError
+
     # Actions
+    def compile_args(
+        self, src: Pathlike, obj: Pathlike, dep: Optional[Pathlike] = None
+    ) -> List[str]:
+        """
+        Arguments to compile src to obj.
+
+        If dep is given, a make-style depfile listing the source and all the
+        included headers is written to dep while compiling.
+        """
+        raise NotImplementedError
+
     def compile_obj(
-        self, src: Pathlike, obj: Pathlike
+        self, src: Pathlike, obj: Pathlike, dep: Optional[Pathlike] = None
     ) -> subprocess.CompletedProcess:
-        """Compile src to obj."""
+        """Compile src to obj, see compile_args for dep."""
+        raise NotImplementedError
+
+    async def compile_obj_async(
+        self, src: Pathlike, obj: Pathlike, dep: Optional[Pathlike] = None
+    ) -> subprocess.CompletedProcess:
+        """Compile src to obj in asyncio, see CLIDriver.run_async."""
+        raise NotImplementedError
+
+    def preprocess(
+        self, src: Pathlike, out: Pathlike, dep: Optional[Pathlike] = None
+    ) -> subprocess.CompletedProcess:
+        """
+        Preprocess src to out, see compile_args for dep.
+
+        Compiling out gives the same object as compiling src.
+        """
+        raise NotImplementedError
+
+    def pch_args(
+        self,
+        header: Pathlike,
+        out: Pathlike,
+        language: str,
+        dep: Optional[Pathlike] = None,
+    ) -> List[str]:
+        """
+        Arguments to precompile header of language to out.
+
+        See compile_args for dep.
+        """
+        raise NotImplementedError
+
+    def compile_pch(
+        self,
+        header: Pathlike,
+        out: Pathlike,
+        language: str,
+        dep: Optional[Pathlike] = None,
+    ) -> subprocess.CompletedProcess:
+        """Precompile header of language to out, see compile_args for dep."""
+        raise NotImplementedError
+
+    async def compile_pch_async(
+        self,
+        header: Pathlike,
+        out: Pathlike,
+        language: str,
+        dep: Optional[Pathlike] = None,
+    ) -> subprocess.CompletedProcess:
+        """Precompile header in asyncio, see CLIDriver.run_async."""
+        raise NotImplementedError
+
+    def link_shared_args(
+        self, objs: List[Pathlike], out: Pathlike
+    ) -> List[str]:
+        """Arguments to link objs to a shared library."""
         raise NotImplementedError
 
     def link_shared(
@@ -145,12 +690,35 @@ class GenericCompilerDriver(GenericDriver):
         """Link objs to a shared library."""
         raise NotImplementedError
 
+    def link_executable_args(
+        self, objs: List[Pathlike], out: Pathlike
+    ) -> List[str]:
+        """Arguments to link objs to an executable."""
+        raise NotImplementedError
+
     def link_executable(
         self, objs: List[Pathlike], out: Pathlike
     ) -> subprocess.CompletedProcess:
         """Link objs to an executable."""
         raise NotImplementedError
 
+    def link_static_args(
+        self, objs: List[Pathlike], out: Pathlike, thin: bool = False
+    ) -> List[str]:
+        """Arguments of the archiver to archive objs to a static library."""
+        raise NotImplementedError
+
+    def link_static(
+        self, objs: List[Pathlike], out: Pathlike, thin: bool = False
+    ) -> subprocess.CompletedProcess:
+        """
+        Archive objs to a static library.
+
+        A thin archive only refers to objs instead of copying them, so it's
+        much faster to create, but objs must be kept.
+        """
+        raise NotImplementedError
+
 
 class GCC(GenericCompilerDriver):
     """GNU Compiler Collection and gcc-style stuff."""
@@ -161,6 +729,14 @@ class GCC(GenericCompilerDriver):
         self._links: List[str] = []
         self._includes: List[str] = []
         self._definitions: List[str] = []
+        self._standard: List[str] = []
+        self._pch: List[str] = []
+        self._linker: List[str] = []
+        self._debug: List[str] = []
+        self._lto: List[str] = []
+        # Arguments shared by compiles, None until computed
+        self._prefix: Optional[Tuple[str, ...]] = None
+        self.archiver: Optional[CLIDriver] = None
 
     def adapts(self, compiler: Pathlike) -> bool:  # noqa: D400
         """$compiler --version"""
@@ -169,13 +745,76 @@ class GCC(GenericCompilerDriver):
         if output.returncode != 0:
             return False
         else:
-            # Clang is GCC-compatitable
-            if "gcc" in output.stdout or "clang version" in output.stdout:
+            # Clang is GCC-compatitable. g++ doesn't say gcc, but names
+            # itself or GCC on the first line, unlike other GNU tools.
+            first = output.stdout.split("\n", 1)[0]
+            if (
+                "gcc" in output.stdout
+                or "g++" in first
+                or "(GCC)" in first
+                or "clang version" in output.stdout
+            ):
                 self.program = driver
+                self.version = output.stdout.strip()
                 return True
             else:
                 return False
 
+    def _gen_linker(self) -> None:
+        self._linker = []
+        if self.linker:
+            self._linker.append("-fuse-ld={}".format(self.linker))
+        if self.link_threads and self.linker in LINKER_THREAD_FLAGS:
+            self._linker.append(
+                LINKER_THREAD_FLAGS[self.linker].format(self.link_threads)
+            )
+        # The default GNU ld can't write it.
+        if self.gdb_index and self.linker in LINKERS:
+            self._linker.append("-Wl,--gdb-index")
+        self._linker.extend(self._lto_link_args())
+
+    def is_clang(self) -> bool:
+        """Check if the adapted compiler is Clang rather than GCC."""
+        return "clang version" in self.version
+
+    def _gen_lto(self) -> None:
+        self._prefix = None
+        self._lto = []
+        if self.lto == "off":
+            return
+        if self.is_clang():
+            self._lto.append("-flto={}".format(self.lto))
+        else:
+            self._lto.append("-flto")
+
+    def _lto_link_args(self) -> List[str]:
+        if self.lto == "off":
+            return []
+        if not self.is_clang():
+            # GCC has no ThinLTO, but partitions the program to optimize
+            # in parallel either way.
+            return ["-flto={}".format(self.lto_jobs or "auto")]
+        args = ["-flto={}".format(self.lto)]
+        if self.lto == "thin":
+            jobs, cache = THINLTO_FLAGS.get(
+                self.linker or "", THINLTO_FLAGS["gold"]
+            )
+            if self.lto_jobs:
+                args.append(jobs.format(self.lto_jobs))
+            if self.lto_cache:
+                args.append(cache.format(self.lto_cache))
+        return args
+
+    def _gen_debug(self) -> None:
+        self._prefix = None
+        self._debug = []
+        if self.split_dwarf:
+            self._debug.append("-g")
+            self._debug.append("-gsplit-dwarf")
+        if self.gdb_index:
+            # The linker builds the index from the public names.
+            self._debug.append("-ggnu-pubnames")
+
     def _gen_link_directory(self, directory: pathlib.Path) -> None:
         self._link_dirs.append("-L{}".format(directory))
 
@@ -183,59 +822,447 @@ class GCC(GenericCompilerDriver):
         self._links.append("-l{}".format(name))
 
     def _gen_include_directory(self, dir: pathlib.Path) -> None:
+        self._prefix = None
         self._includes.append("-I{}".format(dir))
 
     def _gen_definition(self, key: str, value: Optional[str]) -> None:
+        self._prefix = None
         flag = "-D{}".format(key)
         if value:
             flag += "={}".format(value)
         self._definitions.append(flag)
 
-    # Actions
-    def compile_obj(
-        self, src: Pathlike, obj: Pathlike
-    ) -> subprocess.CompletedProcess:  # noqa: D400
-        """$cc -fPIC -Wall -O3 -pthread ... -o obj -c src"""
-        if not self.program:
-            raise RuntimeError("CC hasn't been adapted.")
+    def _gen_standard(self, standard: str) -> None:
+        self._prefix = None
+        self._standard = ["-std={}".format(standard)]
+
+    def _gen_pch(self, header: pathlib.Path) -> None:
+        self._pch = ["-Winvalid-pch", "-include", str(header)]
+
+    def use_response_files(self, directory: Pathlike) -> None:  # noqa: D102
+        super().use_response_files(directory)
+        self._prefix = None
+
+    def codegen_args(self) -> List[str]:  # noqa: D102
+        return self._debug + self._lto
+
+    def freeze(self) -> None:  # noqa: D102
+        if self._prefix is not None:
+            return
         args: List[str] = []
         args.append("-fPIC")
         args.append("-Wall")
         args.append("-O3")
         args.append("-pthread")
+        args.extend(self._standard)
+        args.extend(self.codegen_args())
         args.extend(self._includes)
         args.extend(self._definitions)
+        size = sum(len(x) + 1 for x in args)
+        if self.response_dir and size > RESPONSE_FILE_THRESHOLD:
+            args = [write_response_file(self.response_dir, args)]
+        self._prefix = tuple(args)
+
+    def _common_args(self, dep: Optional[Pathlike]) -> List[str]:
+        self.freeze()
+        assert self._prefix is not None
+        args = list(self._prefix)
+        if dep is not None:
+            args.append("-MMD")
+            args.append("-MF")
+            args.append(str(dep))
+        return args
+
+    def _run(self, args: List[str]) -> subprocess.CompletedProcess:
+        if not self.program:
+            raise RuntimeError("CC hasn't been adapted.")
+        return self.program.run(args, text=True, capture_output=True)
+
+    async def _run_async(self, args: List[str]) -> subprocess.CompletedProcess:
+        if not self.program:
+            raise RuntimeError("CC hasn't been adapted.")
+        return await self.program.run_async(args)
+
+    # Actions
+    def compile_args(
+        self, src: Pathlike, obj: Pathlike, dep: Optional[Pathlike] = None
+    ) -> List[str]:  # noqa: D400
+        """-fPIC -Wall -O3 -pthread ... [-MMD -MF dep] -o obj -c src"""
+        args = self._common_args(dep)
+        args.extend(self._pch)
         args.append("-o")
         args.append(str(obj))
         args.append("-c")
         args.append(str(src))
-        return self.program.run(args, text=True, capture_output=True)
+        return args
 
-    def link_shared(
-        self, objs: List[Pathlike], out: Pathlike
+    def compile_obj(
+        self, src: Pathlike, obj: Pathlike, dep: Optional[Pathlike] = None
     ) -> subprocess.CompletedProcess:  # noqa: D400
-        """$cc -shared -pthread -o out objs"""
-        if not self.program:
-            raise RuntimeError("CC hasn't been adapted.")
+        """$cc -fPIC -Wall -O3 -pthread ... [-MMD -MF dep] -o obj -c src"""
+        return self._run(self.compile_args(src, obj, dep))
+
+    async def compile_obj_async(
+        self, src: Pathlike, obj: Pathlike, dep: Optional[Pathlike] = None
+    ) -> subprocess.CompletedProcess:  # noqa: D102
+        return await self._run_async(self.compile_args(src, obj, dep))
+
+    def preprocess(
+        self, src: Pathlike, out: Pathlike, dep: Optional[Pathlike] = None
+    ) -> subprocess.CompletedProcess:  # noqa: D400
+        """$cc -fPIC -Wall -O3 -pthread ... -o out -E src"""
+        args = self._common_args(dep)
+        args.extend(self._pch)
+        args.append("-o")
+        args.append(str(out))
+        args.append("-E")
+        args.append(str(src))
+        return self._run(args)
+
+    def pch_args(
+        self,
+        header: Pathlike,
+        out: Pathlike,
+        language: str,
+        dep: Optional[Pathlike] = None,
+    ) -> List[str]:  # noqa: D400
+        """-fPIC -Wall -O3 -pthread ... -x $language-header -o out header"""
+        args = self._common_args(dep)
+        args.append("-x")
+        args.append("{}-header".format(language))
+        args.append("-o")
+        args.append(str(out))
+        args.append(str(header))
+        return args
+
+    def compile_pch(
+        self,
+        header: Pathlike,
+        out: Pathlike,
+        language: str,
+        dep: Optional[Pathlike] = None,
+    ) -> subprocess.CompletedProcess:  # noqa: D400
+        """$cc -fPIC ... -x $language-header -o out header"""
+        return self._run(self.pch_args(header, out, language, dep))
+
+    async def compile_pch_async(
+        self,
+        header: Pathlike,
+        out: Pathlike,
+        language: str,
+        dep: Optional[Pathlike] = None,
+    ) -> subprocess.CompletedProcess:  # noqa: D102
+        return await self._run_async(
+            self.pch_args(header, out, language, dep)
+        )
+
+    def link_shared_args(
+        self, objs: List[Pathlike], out: Pathlike
+    ) -> List[str]:  # noqa: D400
+        """-shared -pthread -o out objs"""
         args: List[str] = []
+        args.extend(self._linker)
         args.append("-shared")
-        args.append("-o")
         args.append("-pthread")
+        args.append("-o")
         args.append(str(out))
         args.extend(map(str, objs))
-        return self.program.run(args, text=True, capture_output=True)
+        return args
 
-    def link_executable(
+    def link_shared(
         self, objs: List[Pathlike], out: Pathlike
     ) -> subprocess.CompletedProcess:  # noqa: D400
-        """$cc -pthread ... -o out objs"""
-        if not self.program:
-            raise RuntimeError("CC hasn't been adapted.")
+        """$cc -shared -pthread -o out objs"""
+        return self._run(self.link_shared_args(objs, out))
+
+    def link_executable_args(
+        self, objs: List[Pathlike], out: Pathlike
+    ) -> List[str]:  # noqa: D400
+        """-pthread ... -o out objs"""
         args: List[str] = []
+        args.extend(self._linker)
         args.append("-pthread")
         args.extend(self._link_dirs)
         args.extend(self._links)
         args.append("-o")
         args.append(str(out))
         args.extend(map(str, objs))
-        return self.program.run(args, text=True, capture_output=True)
+        return args
+
+    def link_executable(
+        self, objs: List[Pathlike], out: Pathlike
+    ) -> subprocess.CompletedProcess:  # noqa: D400
+        """$cc -pthread ... -o out objs"""
+        return self._run(self.link_executable_args(objs, out))
+
+    def link_static_args(
+        self, objs: List[Pathlike], out: Pathlike, thin: bool = False
+    ) -> List[str]:  # noqa: D400
+        """rcs[T] out objs"""
+        # s writes the symbol index like ranlib does.
+        args: List[str] = ["rcsT" if thin else "rcs", str(out)]
+        args.extend(map(str, objs))
+        return args
+
+    def link_static(
+        self, objs: List[Pathlike], out: Pathlike, thin: bool = False
+    ) -> subprocess.CompletedProcess:  # noqa: D400
+        """$AR rcs[T] out objs"""
+        if self.archiver is None:
+            self.archiver = CLIDriver(os.environ.get("AR", "ar"))
+        # ar adds to an existing archive, so objects of removed sources would
+        # be kept. Archive to a new file and replace out instead.
+        out = pathlib.Path(out)
+        tmp = out.with_name(out.name + ".tmp")
+        if tmp.exists():
+            tmp.unlink()
+        result = self.archiver.run(
+            self.link_static_args(objs, tmp, thin),
+            text=True,
+            capture_output=True,
+        )
+        if result.returncode == 0:
+            os.replace(tmp, out)
+        return result
+
+
+# Fast linkers in the order of preference, used with -fuse-ld
+LINKERS: List[str] = ["mold", "lld", "gold"]
+
+# Linker flags setting the number of threads of each linker
+LINKER_THREAD_FLAGS: Dict[str, str] = {
+    "mold": "-Wl,--thread-count={}",
+    "lld": "-Wl,--threads={}",
+    "gold": "-Wl,--threads,--thread-count={}",
+}
+
+# Modes of link time optimization
+LTO_MODES: List[str] = ["off", "thin", "full"]
+
+# Linker flags of ThinLTO with Clang, the number of jobs and the cache
+# directory. The gold ones are of the LLVM plugin, also used by GNU ld.
+THINLTO_FLAGS: Dict[str, Tuple[str, str]] = {
+    "lld": ("-Wl,--thinlto-jobs={}", "-Wl,--thinlto-cache-dir={}"),
+    "mold": ("-Wl,--plugin-opt=jobs={}", "-Wl,--plugin-opt=cache-dir={}"),
+    "gold": ("-Wl,-plugin-opt,jobs={}", "-Wl,-plugin-opt,cache-dir={}"),
+}
+
+# Environment variables and default programs for compilers of each language
+COMPILERS: Dict[str, List[str]] = {
+    "c": ["CC", "gcc"],
+    "c++": ["CXX", "g++"],
+}
+
+# Compiler drivers, tried in order when adapting a compiler.
+COMPILER_DRIVERS: List[Type[GenericCompilerDriver]] = [GCC]
+
+
+class ProbeCache:
+    """
+    A persistent cache of program lookups and driver probes.
+
+    Lookups in PATH are keyed by PATH and the program name. Probes are keyed
+    by the resolved path, and invalidated when the mtime, inode or size of
+    the executable changes.
+    """
+
+    def __init__(self, path: Optional[Pathlike] = None):
+        """
+        Load the cache from path.
+
+        If path is None, the cache only lives in memory.
+        """
+        self.path = pathlib.Path(path) if path else None
+        # PATH -> name -> resolved path
+        self.lookups: Dict[str, Dict[str, str]] = {}
+        # resolved path or key -> {"stat": [...], "driver": name, ...}
+        self.probes: Dict[str, Dict] = {}
+        self.changed = False
+        self._lock = threading.Lock()
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.lookups = dict(data["lookups"])
+            self.probes = dict(data["probes"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug("Ignored broken {}: {}".format(self.path, e))
+
+    def save(self) -> None:
+        """Write the cache to its file if anything changed."""
+        if not self.path or not self.changed:
+            return
+        with self._lock:
+            content = json.dumps(
+                {"lookups": self.lookups, "probes": self.probes}
+            )
+            self.changed = False
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, self.path)
+
+    def which(self, program: Pathlike) -> str:
+        """Resolve program to an absolute path, looking up PATH if needed."""
+        if "/" in str(program) or "\\" in str(program):
+            return str(ensure_path(program))
+        env_path = os.environ.get("PATH", "")
+        with self._lock:
+            cached = self.lookups.get(env_path, {}).get(str(program))
+        if cached and os.path.isfile(cached):
+            return cached
+        resolved = find_program(str(program))
+        with self._lock:
+            self.lookups.setdefault(env_path, {})[str(program)] = resolved
+            self.changed = True
+        return resolved
+
+    @staticmethod
+    def _stat(path: str) -> List[int]:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_ino, st.st_size]
+
+    def get(
+        self, path: str, key: Optional[str] = None
+    ) -> Optional[Tuple[str, str]]:
+        """
+        Get the driver name and version of path if probed.
+
+        Probes depending on more than path, like a linker used by a
+        compiler, are stored under a key of their own, which defaults to
+        path. They're invalidated by changes of path all the same.
+        """
+        with self._lock:
+            probe = self.probes.get(key or path)
+        if probe and probe["stat"] == self._stat(path):
+            return (probe["driver"], probe["version"])
+        return None
+
+    def put(
+        self, path: str, driver: str, version: str, key: Optional[str] = None
+    ) -> None:
+        """Record path is adapted by the driver named driver, see get."""
+        with self._lock:
+            self.probes[key or path] = {
+                "stat": self._stat(path),
+                "driver": driver,
+                "version": version,
+            }
+            self.changed = True
+
+
+def adapt_compiler(
+    compiler: Pathlike, probes: Optional[ProbeCache] = None
+) -> Optional[GenericCompilerDriver]:
+    """
+    Create a driver adapting compiler from COMPILER_DRIVERS.
+
+    If probes is given, the compiler is not run when it has been probed.
+
+    Returns: The adapted driver, or None if no driver supports compiler.
+        Raise a RuntimeError if compiler is not found.
+    """
+    if probes is None:
+        probes = ProbeCache()
+    path = probes.which(compiler)
+    drivers = {x.__name__: x for x in COMPILER_DRIVERS}
+    probe = probes.get(path)
+    if probe and probe[0] in drivers:
+        logger.debug("Adapted {} with {} (cached).".format(path, probe[0]))
+        driver = drivers[probe[0]]()
+        driver.program = CLIDriver(path)
+        driver.version = probe[1]
+        return driver
+    with tracer.span("probe {}".format(path), "probe"):
+        for driver_type in COMPILER_DRIVERS:
+            driver = driver_type()
+            if driver.adapts(path):
+                probes.put(path, driver_type.__name__, driver.version)
+                return driver
+    return None
+
+
+def probe_linker(
+    driver: GenericCompilerDriver,
+    linker: str,
+    probes: Optional[ProbeCache] = None,
+) -> Optional[str]:
+    """
+    Check if the compiler of driver can link with -fuse-ld=linker.
+
+    The probe is cached in probes by the identity of the compiler and the
+    path of ld.<linker>, like the probes of compilers. Linkers that can't
+    be used are cached too.
+
+    Returns: The version of the linker, or None if it can't be used.
+    """
+    if probes is None:
+        probes = ProbeCache()
+    if not driver.program:
+        raise RuntimeError("CC hasn't been adapted.")
+    try:
+        path = probes.which("ld.{}".format(linker))
+    except RuntimeError:
+        return None
+    key = "linker\n{}\n{}".format(driver.identity(), path)
+    probe = probes.get(path, key)
+    if probe and probe[0] == "linker":
+        return probe[1] or None
+    with tracer.span("probe {}".format(path), "probe"):
+        result = driver.program.run(
+            ["-fuse-ld={}".format(linker), "-Wl,--version"],
+            text=True,
+            capture_output=True,
+        )
+    version = _linker_version(result.stdout)
+    if result.returncode != 0 or not version:
+        logger.debug(
+            "{} can't link with {}.".format(driver.program.program, path)
+        )
+        version = ""
+    probes.put(path, "linker", version, key)
+    return version or None
+
+
+def _linker_version(output: str) -> str:
+    """Find the version line of the linker in the output of --version."""
+    for line in output.splitlines():
+        line = line.strip()
+        # Lines of the compiler driver, not the linker: the version of
+        # collect2 and the command line of the linker, with -v or similar.
+        if not line or line.startswith("collect2 version"):
+            continue
+        if os.path.isabs(line.split()[0]):
+            continue
+        return line
+    return ""
+
+
+def select_linker(
+    driver: GenericCompilerDriver,
+    linker: str = "auto",
+    probes: Optional[ProbeCache] = None,
+) -> Optional[str]:
+    """
+    Select the linker of driver.
+
+    Args:
+        linker: "auto" for the first one available in LINKERS, "default" for
+            the default linker of the compiler, or the name of a linker.
+
+    Returns: The selected linker, None for the default one. Raise a
+        RuntimeError if the requested linker can't be used.
+    """
+    if linker == "default":
+        return None
+    if linker != "auto":
+        if not probe_linker(driver, linker, probes):
+            raise RuntimeError("Linker {} is not available.".format(linker))
+        return linker
+    for name in LINKERS:
+        if probe_linker(driver, name, probes):
+            return name
+    return None
@@ -1,8 +1,34 @@
 """Logging utilities for cfpm."""
 
 import click
+import contextlib
+import contextvars
+import copy
+import json
 import logging
-from typing import Callable, Optional
+import re
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+if TYPE_CHECKING:
+    import logging.handlers
+
+# Formats of the logs written by cfpm
+LOG_FORMATS = ["text", "json"]
+
+# The first line of a diagnostic of GCC or Clang
+_DIAGNOSTIC = re.compile(r"^\S.*?:\d+:(\d+:)? (warning|error|fatal error): ")
+
+# Lines of the context leading a diagnostic, like the include stack
+_CONTEXT = re.compile(r"^(In file included from |\S[^:]*: In )")
 
 
 # Originally comes from click-log
@@ -60,6 +86,236 @@ class ColorFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
+class JSONFormatter(logging.Formatter):
+    """Formatter writing a JSON object per record, for log aggregation."""
+
+    def format(self, record):
+        """Format the specified record as a line of JSON."""
+        entry = {
+            "time": record.created,
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+            "job": getattr(record, "job", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _QueueHandler(logging.Handler):
+    """
+    Put records into a queue, like logging.handlers.QueueHandler.
+
+    The arguments are merged into the message before the record is queued,
+    but exc_info is kept, which QueueHandler would fold into the message,
+    so formatters like JSONFormatter still see the exception.
+    """
+
+    def __init__(self, records) -> None:
+        super().__init__()
+        self.records = records
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+            self.records.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class LogPipeline:
+    """
+    Format and write the records of a logger on a background thread.
+
+    The handlers of the logger are moved behind a queue handler, so threads
+    logging only put the records into a queue, and a QueueListener formats
+    and writes them in order.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        """Initialize the pipeline of logger, it's started by start."""
+        self.logger = logger
+        self.handlers: List[logging.Handler] = []
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        """Start the listener and route the logger through the queue."""
+        # Imported here since it's slow to import.
+        import logging.handlers
+        import queue
+
+        if self.listener:
+            return
+        records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self.handlers = list(self.logger.handlers)
+        self.listener = logging.handlers.QueueListener(
+            records, *self.handlers, respect_handler_level=True
+        )
+        self.listener.start()
+        self.logger.handlers = [_QueueHandler(records)]
+
+    def stop(self) -> None:
+        """Write the queued records and restore the handlers."""
+        if not self.listener:
+            return
+        self.logger.handlers = self.handlers
+        self.listener.stop()
+        self.listener = None
+
+
+class _Group:
+    """Warnings and errors logged by a job, written when it's done."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.records: List[logging.LogRecord] = []
+
+
+_current_group: "contextvars.ContextVar[Optional[_Group]]" = (
+    contextvars.ContextVar("current_group", default=None)
+)
+
+# Serializes the records of groups, so they aren't interleaved
+_group_lock = threading.Lock()
+
+
+class _Duplicates:
+    """Keys of the diagnostics written in a scope."""
+
+    def __init__(self) -> None:
+        self.seen: Set[str] = set()
+        self.suppressed = 0
+
+
+_duplicates: Optional[_Duplicates] = None
+_duplicates_lock = threading.Lock()
+
+
+def _group_filter(record: logging.LogRecord) -> bool:
+    """Hold warnings and errors logged in a group back, see job_output."""
+    group = _current_group.get()
+    if group is None or record.levelno < logging.WARNING:
+        return True
+    group.records.append(record)
+    return False
+
+
+def split_diagnostics(text: str) -> List[Tuple[str, str]]:
+    """
+    Split the output of a compiler into diagnostics.
+
+    Returns: (key, text) of each diagnostic. The key leaves out the context
+        leading the diagnostic, so a warning in a header included by many
+        sources has the same key every time.
+    """
+    blocks: List[List[str]] = []
+    diagnosed = False  # If the last block has a diagnostic line
+    for line in text.splitlines():
+        starts = _CONTEXT.match(line) or _DIAGNOSTIC.match(line)
+        if not blocks or (starts and diagnosed):
+            blocks.append([])
+            diagnosed = False
+        blocks[-1].append(line)
+        if _DIAGNOSTIC.match(line):
+            diagnosed = True
+    result: List[Tuple[str, str]] = []
+    for block in blocks:
+        start = next(
+            (i for (i, x) in enumerate(block) if _DIAGNOSTIC.match(x)), 0
+        )
+        result.append(("\n".join(block[start:]), "\n".join(block)))
+    return result
+
+
+def _deduplicate(message: str) -> str:
+    """Drop the diagnostics of message already written in the scope."""
+    with _duplicates_lock:
+        if _duplicates is None:
+            return message
+        kept: List[str] = []
+        for (key, text) in split_diagnostics(message):
+            if key in _duplicates.seen:
+                _duplicates.suppressed += 1
+            else:
+                _duplicates.seen.add(key)
+                kept.append(text)
+        return "\n".join(kept)
+
+
+@contextlib.contextmanager
+def deduplicate_warnings() -> Iterator[None]:
+    """
+    Write each warning of jobs once in the scope.
+
+    Warnings repeated by jobs, like those of a header included by many
+    sources, are only written by the first job. Errors are always written.
+    A nested scope is part of the outer one.
+    """
+    global _duplicates
+    with _duplicates_lock:
+        if _duplicates is not None:
+            outer = True
+        else:
+            outer = False
+            _duplicates = _Duplicates()
+    if outer:
+        yield
+        return
+    try:
+        yield
+    finally:
+        with _duplicates_lock:
+            suppressed = _duplicates.suppressed
+            _duplicates = None
+        if suppressed:
+            logger.info(
+                "Suppressed {} duplicate warning(s).".format(suppressed)
+            )
+
+
+@contextlib.contextmanager
+def job_output(name: str) -> Iterator[None]:
+    """
+    Group the output of a job in the current thread or task.
+
+    Warnings and errors logged in the scope are held back, and written
+    together when it ends, so lines of jobs running in parallel don't
+    interleave. Consecutive records of the same level are merged, tagged
+    with the name of the job. Lower levels like progress are written as
+    they come.
+    """
+    group = _Group(name)
+    token = _current_group.set(group)
+    try:
+        yield
+    finally:
+        _current_group.reset(token)
+        _flush(group)
+
+
+def _flush(group: _Group) -> None:
+    merged: List[logging.LogRecord] = []
+    for record in group.records:
+        message = record.getMessage()
+        if merged and merged[-1].levelno == record.levelno:
+            merged[-1].msg += "\n" + message
+            continue
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = message
+        record.args = None
+        record.job = group.name
+        merged.append(record)
+    with _group_lock:
+        for record in merged:
+            if record.levelno == logging.WARNING:
+                record.msg = _deduplicate(record.msg)
+                if not record.msg:
+                    continue
+            logger.handle(record)
+
+
 def simple_verbosity_option(
     logger: Optional[logging.Logger] = None, *names: str, **kwargs
 ) -> Callable:
@@ -96,11 +352,21 @@ def simple_verbosity_option(
     return decorator
 
 
-def logger_basic_config(logger: logging.Logger) -> None:
-    """Configure a basic colored logger to stderr."""
+def logger_basic_config(logger: logging.Logger, format: str = "text") -> None:
+    """
+    Configure a basic colored logger to stderr.
+
+    Args:
+        format: One of LOG_FORMATS, json writes a JSON object per record.
+    """
     handler = ClickHandler()
-    handler.setFormatter(ColorFormatter())
+    if format == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(ColorFormatter())
     logger.handlers = [handler]
+    if _group_filter not in logger.filters:
+        logger.addFilter(_group_filter)
 
 
 logger = logging.getLogger("cfpm")
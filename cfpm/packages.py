@@ -0,0 +1,703 @@
+"""Resolution and fetching of package dependencies."""
+
+import errno
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+import semver
+from .config import parse_toml, parse_toml_text
+from .exceptions import BadConfigurationError, ExternalProgramError
+from .logging import logger
+from .utils import Pathlike, vaild_name
+
+if TYPE_CHECKING:
+    import git
+
+# Name of the lockfile beside cfpm.toml
+LOCKFILE = "cfpm.lock"
+
+# Bump this when the format of the lockfile changes.
+LOCKFILE_VERSION = 1
+
+# Maximum number of repositories fetched in parallel
+MAX_FETCH_JOBS = 8
+
+# Versions in git tags, like v1.2.3 or 1.2.3
+vaild_tag = re.compile(r"^v?(\d+\.\d+\.\d+(?:[-+].*)?)$")
+
+# A clause of a version constraint, like ^1.2, ~1.2.3, >=1.0 or 1.*
+vaild_clause = re.compile(
+    r"^(\^|~|>=|<=|>|<|==|=|!=)?\s*"
+    r"(\d+|\*)(?:\.(\d+|\*))?(?:\.(\d+|\*))?(-[0-9A-Za-z.-]+)?$"
+)
+
+Version = semver.VersionInfo
+
+
+def parse_version(text: str) -> Version:
+    """Parse a version like 1.2.3, raise a ValueError if malformed."""
+    return Version.parse(text)
+
+
+class Constraint:
+    """
+    A semver constraint, clauses separated by commas must all match.
+
+    Clauses are like Cargo's: ^1.2 allows >=1.2.0 and <2.0.0, ~1.2 allows
+    >=1.2.0 and <1.3.0, 1.2.* allows any 1.2.x, and a bare 1.2 is ^1.2.
+    Comparisons with >=, <=, >, <, = and != are supported too. Pre-releases
+    only match if a clause has a pre-release.
+    """
+
+    def __init__(self, text: str):
+        """Parse text, raise a ValueError if malformed."""
+        self.text = text.strip() or "*"
+        # (operator, version)
+        self.clauses: List[Tuple[str, Version]] = []
+        self.prerelease = False
+        for clause in self.text.split(","):
+            self._parse_clause(clause.strip())
+
+    def _parse_clause(self, clause: str) -> None:
+        match = vaild_clause.match(clause)
+        if not match:
+            raise ValueError("Bad version constraint {}.".format(clause))
+        op, *parts, pre = match.groups()
+        # Parts after a wildcard or missing are free.
+        known: List[int] = []
+        for part in parts:
+            if part is None or part == "*":
+                break
+            known.append(int(part))
+        if "*" in parts:
+            if op or pre:
+                raise ValueError("Bad version constraint {}.".format(clause))
+            if known:  # 1.* is ~1 and 1.2.* is ~1.2
+                self._tilde(
+                    Version(*(known + [0] * (3 - len(known)))), len(known)
+                )
+            return
+        if pre:
+            self.prerelease = True
+        major, minor, patch = known + [0] * (3 - len(known))
+        version = Version(major, minor, patch, pre[1:] if pre else None)
+        if op in (None, "^"):
+            self._caret(version, len(known))
+        elif op == "~" or (op in ("=", "==") and len(known) < 3):
+            self._tilde(version, len(known))
+        elif op == "=":
+            self.clauses.append(("==", version))
+        else:
+            self.clauses.append((op, version))
+
+    def _caret(self, version: Version, known: int) -> None:
+        self.clauses.append((">=", version))
+        if version.major or known == 1:
+            upper = Version(version.major + 1, 0, 0)
+        elif version.minor or known == 2:
+            upper = Version(0, version.minor + 1, 0)
+        else:
+            upper = Version(0, 0, version.patch + 1)
+        self.clauses.append(("<", upper))
+
+    def _tilde(self, version: Version, known: int) -> None:
+        self.clauses.append((">=", version))
+        if known == 1:
+            upper = Version(version.major + 1, 0, 0)
+        else:
+            upper = Version(version.major, version.minor + 1, 0)
+        self.clauses.append(("<", upper))
+
+    def allows(self, version: Version) -> bool:
+        """Check if version matches all the clauses."""
+        if version.prerelease and not self.prerelease:
+            return False
+        for (op, bound) in self.clauses:
+            if op == ">=" and not version >= bound:
+                return False
+            if op == "<=" and not version <= bound:
+                return False
+            if op == ">" and not version > bound:
+                return False
+            if op == "<" and not version < bound:
+                return False
+            if op == "==" and version != bound:
+                return False
+            if op == "!=" and version == bound:
+                return False
+        return True
+
+    def __str__(self) -> str:  # noqa: D105
+        return self.text
+
+
+class Requirement(NamedTuple):
+    """A dependency on a package of a git repository."""
+
+    name: str
+    git: str
+    constraint: Constraint
+    # Name of the package requiring it, empty for the root package
+    requirer: str
+
+
+class LockedPackage(NamedTuple):
+    """A package resolved to a version and a commit."""
+
+    name: str
+    version: str
+    git: str
+    commit: str
+    dependencies: List[str]
+
+
+def parse_dependencies(config: Dict, requirer: str = "") -> List[Requirement]:
+    """
+    Parse [dependencies] of a package configuration.
+
+    Each dependency is a table like {git = "url", version = "^1.0"}, the
+    version defaults to any. Raise a BadConfigurationError if malformed.
+    """
+    where = "package {}".format(requirer) if requirer else "cfpm.toml"
+    dependencies = config.get("dependencies", {})
+    if not isinstance(dependencies, dict):
+        raise BadConfigurationError(
+            "[dependencies] of {} should be a table.".format(where)
+        )
+    requirements: List[Requirement] = []
+    for (name, spec) in dependencies.items():
+        if not vaild_name.match(name):
+            raise BadConfigurationError(
+                "Bad dependency name {} in {}.".format(name, where)
+            )
+        if not isinstance(spec, dict) or "git" not in spec:
+            raise BadConfigurationError(
+                "Dependency {} in {} should have a git url.".format(
+                    name, where
+                )
+            )
+        try:
+            constraint = Constraint(str(spec.get("version", "*")))
+        except ValueError as e:
+            raise BadConfigurationError(
+                "Bad dependency {} in {}: {}".format(name, where, e)
+            )
+        requirements.append(
+            Requirement(name, str(spec["git"]), constraint, requirer)
+        )
+    return requirements
+
+
+class Mirror:
+    """A bare mirror of a git repository, safe to use from threads."""
+
+    def __init__(self, url: str, repo: "git.Repo"):
+        """Wrap repo, a mirror of url."""
+        self.url = url
+        self.repo = repo
+        self._lock = threading.Lock()
+        self._manifests: Dict[str, Dict] = {}
+
+    def versions(self) -> List[Tuple[Version, str]]:
+        """List versions in tags and their commits, the newest first."""
+        with self._lock:
+            output = self.repo.git.for_each_ref(
+                "--format=%(objectname) %(*objectname) %(refname:strip=2)",
+                "refs/tags",
+            )
+        versions: List[Tuple[Version, str]] = []
+        for line in output.splitlines():
+            # Lightweight tags have no peeled object.
+            fields = line.split()
+            match = vaild_tag.match(fields[-1])
+            if not match:
+                continue
+            try:
+                version = parse_version(match.group(1))
+            except ValueError:
+                continue
+            commit = fields[1] if len(fields) == 3 else fields[0]
+            versions.append((version, commit))
+        return sorted(versions, key=lambda x: x[0], reverse=True)
+
+    def has(self, commit: str) -> bool:
+        """Check if commit is in the mirror."""
+        import git
+
+        with self._lock:
+            try:
+                self.repo.git.cat_file("-e", commit + "^{commit}")
+                return True
+            except git.GitCommandError:
+                return False
+
+    def manifest(self, commit: str) -> Dict:
+        """Parse cfpm.toml of the package at commit, empty if missing."""
+        import git
+
+        if commit not in self._manifests:
+            with self._lock:
+                try:
+                    content = self.repo.git.show(commit + ":cfpm.toml")
+                except git.GitCommandError:
+                    content = ""
+            try:
+                self._manifests[commit] = parse_toml_text(content)
+            except ValueError as e:
+                raise BadConfigurationError(
+                    "Bad cfpm.toml of {} at {}: {}".format(
+                        self.url, commit, e
+                    )
+                )
+        return self._manifests[commit]
+
+    def files(self, commit: str) -> Iterator[Tuple[str, int, str, bytes]]:
+        """Iterate over paths, modes, blob ids and contents at commit."""
+        import git
+
+        with self._lock:
+            for item in self.repo.commit(commit).tree.traverse():
+                if not isinstance(item, git.Blob):
+                    continue
+                yield (
+                    str(item.path),
+                    item.mode,
+                    item.hexsha,
+                    item.data_stream.read(),
+                )
+
+
+class PackageStore:
+    """
+    A content-addressed store of packages shared by all the projects.
+
+    Every git repository has a bare mirror under git/. Files of packages
+    are stored once under objects/, keyed by their git blob ids, and the
+    file list of every commit under trees/. Packages are installed into
+    projects as hardlinks to the objects, so the same file takes space
+    once however many projects use it. Objects are read-only, since
+    editing an installed file edits it everywhere.
+    """
+
+    def __init__(self, directory: Pathlike, jobs: Optional[int] = None):
+        """
+        Initialize the store in directory, created when needed.
+
+        Args:
+            directory: The directory of the store.
+            jobs: Number of repositories fetched in parallel.
+        """
+        self.directory = pathlib.Path(directory)
+        self.jobs = jobs or MAX_FETCH_JOBS
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._lock = threading.Lock()
+        self._fetched: Dict[str, Future] = {}
+        self._opened: Dict[str, Mirror] = {}
+        self._url_locks: Dict[str, threading.Lock] = {}
+
+    def close(self) -> None:
+        """Wait for all the fetching and stop the threads."""
+        self._executor.shutdown()
+
+    def _mirror_path(self, url: str) -> pathlib.Path:
+        digest = hashlib.sha256(url.encode()).hexdigest()[:24]
+        return self.directory / "git" / (digest + ".git")
+
+    def _open(self, url: str, fetch: bool) -> Mirror:
+        import git
+
+        with self._lock:
+            lock = self._url_locks.setdefault(url, threading.Lock())
+        with lock:
+            path = self._mirror_path(url)
+            try:
+                if path.exists():
+                    repo = git.Repo(path)
+                    if fetch:
+                        logger.info("Fetching {}.".format(url))
+                        repo.git.fetch("--prune", "--quiet")
+                else:
+                    logger.info("Cloning {}.".format(url))
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = pathlib.Path(
+                        tempfile.mkdtemp(dir=path.parent, suffix=".tmp")
+                    )
+                    try:
+                        git.Repo.clone_from(url, tmp, mirror=True)
+                        os.rename(tmp, path)
+                    finally:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                    repo = git.Repo(path)
+            except (git.GitError, OSError) as e:
+                raise ExternalProgramError(
+                    "Failed to fetch {}: {}".format(url, e)
+                )
+            with self._lock:
+                mirror = self._opened.setdefault(url, Mirror(url, repo))
+            return mirror
+
+    def prefetch(self, url: str) -> None:
+        """Start fetching url in the background, once per store."""
+        with self._lock:
+            if url not in self._fetched:
+                self._fetched[url] = self._executor.submit(
+                    self._open, url, True
+                )
+
+    def mirror(self, url: str, fetch: bool = True) -> Mirror:
+        """
+        Get the mirror of url, raise an ExternalProgramError if failed.
+
+        If fetch is False, an existing mirror is used as is.
+        """
+        if not fetch:
+            with self._lock:
+                if url in self._opened:
+                    return self._opened[url]
+                future = self._fetched.get(url)
+            if future is None:
+                return self._open(url, False)
+        else:
+            self.prefetch(url)
+            with self._lock:
+                future = self._fetched[url]
+        return future.result()
+
+    def _object_path(self, key: str) -> pathlib.Path:
+        return self.directory / "objects" / key[:2] / key[2:]
+
+    def _tree_path(self, commit: str) -> pathlib.Path:
+        return self.directory / "trees" / (commit + ".json")
+
+    def _load_tree(self, commit: str) -> Optional[Dict]:
+        path = self._tree_path(commit)
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.debug("Ignored broken {}: {}".format(path, e))
+        return None
+
+    def tree(self, mirror: Mirror, commit: str) -> Dict:
+        """
+        Store the files of mirror at commit, returns the file list.
+
+        The file list has paths and keys of objects as "files", and paths
+        and targets of symbolic links as "links".
+        """
+        cached = self._load_tree(commit)
+        if cached is not None:
+            return cached
+        path = self._tree_path(commit)
+        tree: Dict[str, List[List[str]]] = {"files": [], "links": []}
+        for (name, mode, blob, data) in mirror.files(commit):
+            if mode & 0o170000 == 0o120000:
+                tree["links"].append([name, data.decode()])
+                continue
+            executable = bool(mode & 0o111)
+            # Modes are shared by hardlinks, so they're part of the key.
+            key = blob + ("x" if executable else "")
+            tree["files"].append([name, key])
+            obj = self._object_path(key)
+            if obj.exists():
+                continue
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=obj.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, 0o555 if executable else 0o444)
+            os.replace(tmp, obj)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(tree, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        return tree
+
+    def install(self, package: LockedPackage, dest: pathlib.Path) -> None:
+        """
+        Install package into dest as hardlinks to the store.
+
+        Files are copied if the store is on another file system. Raise an
+        ExternalProgramError if failed.
+        """
+        import git
+
+        tree = self._load_tree(package.commit)
+        if tree is None:
+            mirror = self.mirror(package.git, fetch=False)
+            if not mirror.has(package.commit):
+                mirror = self.mirror(package.git)
+            try:
+                tree = self.tree(mirror, package.commit)
+            except (git.GitError, ValueError) as e:
+                raise ExternalProgramError(
+                    "Failed to check out {}: {}".format(package.name, e)
+                )
+        tmp = dest.with_name("." + dest.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        for (name, key) in tree["files"]:
+            target = tmp / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(self._object_path(key), target)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copy2(self._object_path(key), target)
+        for (name, link) in tree["links"]:
+            target = tmp / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.symlink(link, target)
+        tmp.mkdir(parents=True, exist_ok=True)  # An empty package
+        shutil.rmtree(dest, ignore_errors=True)
+        os.rename(tmp, dest)
+
+
+class Resolver:
+    """
+    Resolve dependencies to versions by backtracking.
+
+    The newest versions are tried first, except locked versions, which are
+    kept as long as they still match, without fetching their repositories
+    if their commits are already in the mirrors.
+    """
+
+    def __init__(
+        self,
+        store: PackageStore,
+        locked: Optional[Dict[str, LockedPackage]] = None,
+    ):
+        """Initialize the resolver with the locked packages."""
+        self.store = store
+        self.locked = locked or {}
+        self.failure = ""
+
+    def _candidates(
+        self, name: str, url: str, constraints: List[Constraint]
+    ) -> Iterator[Tuple[Version, str]]:
+        def allowed(version: Version) -> bool:
+            return all(x.allows(version) for x in constraints)
+
+        locked = self.locked.get(name)
+        if locked and locked.git == url:
+            version = parse_version(locked.version)
+            if allowed(version) and self.store.mirror(url, False).has(
+                locked.commit
+            ):
+                yield (version, locked.commit)
+        for (version, commit) in self.store.mirror(url).versions():
+            if allowed(version) and not (locked and locked.commit == commit):
+                yield (version, commit)
+
+    def resolve(self, requirements: List[Requirement]) -> List[LockedPackage]:
+        """
+        Resolve requirements and all their dependencies.
+
+        Returns: The packages sorted by name. Raise a BadConfigurationError
+            if no versions match all the constraints.
+        """
+        for requirement in requirements:
+            if requirement.name not in self.locked:
+                self.store.prefetch(requirement.git)
+        result = self._search({}, list(requirements))
+        if result is None:
+            raise BadConfigurationError(self.failure)
+        return sorted(result.values(), key=lambda x: x.name)
+
+    def _search(
+        self,
+        selected: Dict[str, LockedPackage],
+        requirements: List[Requirement],
+    ) -> Optional[Dict[str, LockedPackage]]:
+        urls: Dict[str, str] = {}
+        for requirement in requirements:
+            url = urls.setdefault(requirement.name, requirement.git)
+            if url != requirement.git:
+                raise BadConfigurationError(
+                    "Package {} is required from both {} and {}.".format(
+                        requirement.name, url, requirement.git
+                    )
+                )
+        pending = [x for x in urls if x not in selected]
+        if not pending:
+            return selected
+        name = pending[0]
+        relevant = [x for x in requirements if x.name == name]
+        constraints = [x.constraint for x in relevant]
+        for (version, commit) in self._candidates(
+            name, urls[name], constraints
+        ):
+            mirror = self.store.mirror(urls[name], fetch=False)
+            deps = parse_dependencies(mirror.manifest(commit), name)
+            conflict = False
+            for dep in deps:
+                if dep.name in selected:
+                    chosen = parse_version(selected[dep.name].version)
+                    conflict = conflict or not dep.constraint.allows(chosen)
+                elif dep.name not in self.locked:
+                    self.store.prefetch(dep.git)
+            if conflict:
+                continue
+            package = LockedPackage(
+                name,
+                str(version),
+                urls[name],
+                commit,
+                sorted(x.name for x in deps),
+            )
+            result = self._search(
+                dict(selected, **{name: package}), requirements + deps
+            )
+            if result is not None:
+                return result
+        if not self.failure:
+            self.failure = "No version of {} matches {}.".format(
+                name,
+                ", ".join(
+                    "{} (required by {})".format(
+                        x.constraint, x.requirer or "cfpm.toml"
+                    )
+                    for x in relevant
+                ),
+            )
+        return None
+
+
+def read_lockfile(root: pathlib.Path) -> Dict[str, LockedPackage]:
+    """Read the lockfile of the project at root, empty if missing."""
+    path = root / LOCKFILE
+    if not path.exists():
+        return {}
+    try:
+        data = parse_toml(path)
+        if data.get("version") != LOCKFILE_VERSION:
+            logger.warning("Ignored {} of another version.".format(path))
+            return {}
+        return {
+            str(x["name"]): LockedPackage(
+                str(x["name"]),
+                str(x["version"]),
+                str(x["git"]),
+                str(x["commit"]),
+                [str(y) for y in x.get("dependencies", [])],
+            )
+            for x in data.get("package", [])
+        }
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise BadConfigurationError("Bad {}: {}".format(path, e))
+
+
+def write_lockfile(root: pathlib.Path, packages: List[LockedPackage]) -> None:
+    """Write the lockfile of the project at root if it changed."""
+    import tomlkit
+
+    document = tomlkit.document()
+    document.add(tomlkit.comment("Generated by cfpm, don't edit it by hand."))
+    document.add("version", LOCKFILE_VERSION)
+    tables = tomlkit.aot()
+    for package in packages:
+        table = tomlkit.table()
+        table.add("name", package.name)
+        table.add("version", package.version)
+        table.add("git", package.git)
+        table.add("commit", package.commit)
+        table.add("dependencies", package.dependencies)
+        tables.append(table)
+    document.add("package", tables)
+    content = tomlkit.dumps(document)
+    path = root / LOCKFILE
+    if path.exists() and path.read_text() == content:
+        return
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(content)
+    os.replace(tmp, path)
+    logger.debug("Wrote {}.".format(path))
+
+
+def fetch_dependencies(
+    root: pathlib.Path,
+    config: Dict,
+    store: PackageStore,
+    update: bool = False,
+    on_installed: Optional[Callable[[LockedPackage], None]] = None,
+) -> List[LockedPackage]:
+    """
+    Resolve, lock and install the dependencies of the project at root.
+
+    Packages are installed into build/deps/<name>, in parallel. Packages
+    already installed at the same commit are left alone.
+
+    Args:
+        root: The root of the project.
+        config: The configuration of the project.
+        store: The package store to fetch into.
+        update: Resolve again to the newest versions, ignoring the lockfile.
+        on_installed: Called with every package installed.
+
+    Returns: The resolved packages. Raise a BadConfigurationError if the
+        dependencies can't be resolved, or an ExternalProgramError if
+        fetching failed.
+    """
+    requirements = parse_dependencies(config)
+    locked = {} if update else read_lockfile(root)
+    packages = Resolver(store, locked).resolve(requirements)
+    write_lockfile(root, packages)
+    deps_dir = root / "build" / "deps"
+    installed_path = deps_dir / "installed.json"
+    installed: Dict[str, str] = {}
+    try:
+        with open(installed_path, "r") as f:
+            installed = dict(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, TypeError) as e:
+        logger.debug("Ignored broken {}: {}".format(installed_path, e))
+    deps_dir.mkdir(parents=True, exist_ok=True)
+    names: Set[str] = set(x.name for x in packages)
+    for name in set(installed) - names:
+        shutil.rmtree(deps_dir / name, ignore_errors=True)
+        del installed[name]
+
+    def install(package: LockedPackage) -> None:
+        dest = deps_dir / package.name
+        if installed.get(package.name) == package.commit and dest.exists():
+            return
+        store.install(package, dest)
+        if on_installed:
+            on_installed(package)
+
+    with ThreadPoolExecutor(max_workers=store.jobs) as executor:
+        futures = [executor.submit(install, x) for x in packages]
+        try:
+            for future in futures:
+                future.result()
+        except OSError as e:
+            raise ExternalProgramError(
+                "Failed to install packages: {}".format(e)
+            )
+    installed = {x.name: x.commit for x in packages}
+    tmp = installed_path.with_name(installed_path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(installed, f)
+    os.replace(tmp, installed_path)
+    return packages
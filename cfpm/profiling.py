@@ -0,0 +1,126 @@
+"""Timing of build phases and Chrome trace export."""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+from .utils import Pathlike
+
+# The lane, a row in the trace viewer, of the current thread or task. Lane 0
+# is the main thread, the scheduler runs jobs in slot + 1.
+current_lane: "contextvars.ContextVar[int]" = contextvars.ContextVar(
+    "current_lane", default=0
+)
+
+
+class Tracer:
+    """
+    Collect timed slices of the build with a monotonic clock.
+
+    Recording is disabled until enable is called, so the instrumentation
+    costs nearly nothing by default.
+    """
+
+    def __init__(self) -> None:
+        """Initialize a disabled tracer."""
+        self.enabled = False
+        self.events: List[Dict] = []
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        """Start recording, forgetting everything recorded."""
+        with self._lock:
+            self.enabled = True
+            self.events = []
+            self._start = time.monotonic()
+
+    def disable(self) -> None:
+        """Stop recording, the recorded slices are kept."""
+        self.enabled = False
+
+    def add(
+        self, name: str, category: str, start: float, end: float, **args
+    ) -> None:
+        """
+        Record a slice in the current lane.
+
+        Args:
+            name: Name of the slice.
+            category: Category of the slice, like job or process.
+            start: Start time from time.monotonic.
+            end: End time from time.monotonic.
+            args: Extra information shown with the slice.
+        """
+        if not self.enabled:
+            return
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self._start) * 1e6),
+            "dur": round((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": current_lane.get(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "cfpm", **args) -> Iterator:
+        """Record the time spent in the with block as a slice."""
+        if not self.enabled:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.monotonic(), **args)
+
+    def slowest(self, category: str, n: int) -> List[Tuple[str, float]]:
+        """List names and seconds of the n slowest slices of category."""
+        with self._lock:
+            slices = [
+                (x["name"], x["dur"] / 1e6)
+                for x in self.events
+                if x["cat"] == category
+            ]
+        return sorted(slices, key=lambda x: x[1], reverse=True)[:n]
+
+    def write(self, path: Pathlike) -> None:
+        """Write a Chrome trace event file, which Perfetto opens too."""
+        with self._lock:
+            events = list(self.events)
+        pid = os.getpid()
+        lanes = sorted(set(x["tid"] for x in events) | {0})
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": lane,
+                "args": {"name": "worker {}".format(lane) if lane else "main"},
+            }
+            for lane in lanes
+        ]
+        metadata.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "args": {"name": "cfpm"},
+            }
+        )
+        with open(path, "w") as f:
+            json.dump(
+                {"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f
+            )
+
+
+# The tracer used by all of cfpm
+tracer = Tracer()
@@ -1,33 +1,1218 @@
 """Object representing projects and targets."""
 
-from typing import Dict, List
+import asyncio
+import os
+import pathlib
+import subprocess
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Type
+from .cache import ObjectCache, command_digest
+from .artifacts import ArtifactCache, artifact_key
+from .compdb import COMPDB_FILE, CompilationDatabase
+from .config import load_config
+from .depgraph import DependencyGraph, parse_depfile
+from .remote import WorkerPool
+from .drivers import (
+    COMPILERS,
+    LINKERS,
+    LTO_MODES,
+    GenericCompilerDriver,
+    MeasuredProcess,
+    ProbeCache,
+    adapt_compiler,
+    select_linker,
+)
+from .exceptions import BadConfigurationError, ExternalProgramError
+from .logging import logger
+from .packages import LockedPackage, parse_dependencies, read_lockfile
+from .profiling import tracer
+from .scheduler import DurationHistory, Job, ResourceHistory, Scheduler
+from .sources import SourceFinder
+from .utils import ensure_path, vaild_name, Pathlike
+
+# Source file suffixes and their languages
+SOURCE_SUFFIXES: Dict[str, str] = {
+    ".c": "c",
+    ".cc": "c++",
+    ".cpp": "c++",
+    ".cxx": "c++",
+    ".c++": "c++",
+    ".C": "c++",
+}
+
+# Suffixes of generated unity sources of each language
+UNITY_SUFFIXES: Dict[str, str] = {"c": ".c", "c++": ".cpp"}
+
+# Default number of sources included by a unity source
+DEFAULT_UNITY_BATCH = 8
+
+
+def write_include_source(
+    path: pathlib.Path, sources: List[pathlib.Path]
+) -> None:
+    """Write a file including all the sources, kept if not changed."""
+    content = "".join(
+        '#include "{}"\n'.format(x.as_posix()) for x in sources
+    )
+    try:
+        if path.read_text() == content:
+            return
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def find_sources(
+    directory: pathlib.Path,
+    paths: List[str],
+    exclude: Sequence[str] = (),
+    finder: Optional[SourceFinder] = None,
+) -> List[pathlib.Path]:
+    """
+    Find source files from paths relative to directory.
+
+    Directories are searched recursively and glob patterns are matched for
+    files with suffixes in SOURCE_SUFFIXES, leaving out those matching any
+    pattern in exclude. See SourceFinder.find.
+    """
+    finder = finder or SourceFinder()
+    return finder.find(directory, paths, SOURCE_SUFFIXES, exclude)
+
+
+class GenericTarget:
+    """An abstract class representing a target."""
+
+    # If link_inputs of dependencies are linked into the output
+    links_dependencies = True
+
+    def __init__(
+        self,
+        name: str,
+        directory: pathlib.Path,
+        config: Dict,
+        finder: Optional[SourceFinder] = None,
+    ):
+        """
+        Initialize the target.
+
+        Args:
+            name: The name of the target.
+            directory: The directory containing the target configuration, all
+                the paths in config are relative to it.
+            config: The [target] table of the target configuration.
+            finder: The finder of sources, which may have an index.
+        """
+        self.name = name
+        self.directory = directory
+        try:
+            self.headers: List[pathlib.Path] = [
+                ensure_path(directory / h, is_dir=True)
+                for h in config.get("headers", [])
+            ]
+            self.sources = find_sources(
+                directory,
+                config.get("sources", []),
+                config.get("exclude", []),
+                finder,
+            )
+            self.unity_exclude = set(
+                find_sources(
+                    directory, config.get("unity_exclude", []), (), finder
+                )
+            )
+        except RuntimeError as e:
+            raise BadConfigurationError(
+                "Bad paths in target {}: {}".format(name, e)
+            )
+        self.definitions: Dict[str, Optional[str]] = dict(
+            config.get("definitions", {})
+        )
+        self.links: List[str] = list(config.get("links", []))
+        pch = config.get("pch", {})
+        if isinstance(pch, str):
+            pch = {x: pch for x in self.languages()}
+        try:
+            self.pch: Dict[str, pathlib.Path] = {
+                str(k): ensure_path(directory / v) for (k, v) in pch.items()
+            }
+        except RuntimeError as e:
+            raise BadConfigurationError(
+                "Bad pch of target {}: {}".format(name, e)
+            )
+        self.unity = bool(config.get("unity", False))
+        self.unity_batch = int(config.get("unity_batch", DEFAULT_UNITY_BATCH))
+        if self.unity_batch < 1:
+            raise BadConfigurationError(
+                "unity_batch of target {} should be positive.".format(name)
+            )
+        # Names of targets this target depends on
+        self.deps: List[str] = [str(x) for x in config.get("deps", [])]
+
+    def units(
+        self, obj_dir: pathlib.Path
+    ) -> List[Tuple[str, pathlib.Path, pathlib.Path]]:
+        """
+        List the translation units of the target.
+
+        In unity mode, sources not in unity_exclude are amalgamated into
+        unity sources including unity_batch sources each, which are written
+        to obj_dir / "unity".
+
+        Returns: A list of names, sources and objects of the units.
+        """
+        units = []
+        batches: Dict[str, List[pathlib.Path]] = {}
+        for src in self.sources:
+            if self.unity and src not in self.unity_exclude:
+                batches.setdefault(SOURCE_SUFFIXES[src.suffix], []).append(src)
+                continue
+            rel = src.relative_to(self.directory).as_posix()
+            units.append((rel, src, obj_dir / (rel + ".o")))
+        for (language, sources) in sorted(batches.items()):
+            for i in range(0, len(sources), self.unity_batch):
+                unity = obj_dir / "unity" / "unity_{}_{}{}".format(
+                    language.replace("+", "p"),
+                    i // self.unity_batch,
+                    UNITY_SUFFIXES[language],
+                )
+                write_include_source(unity, sources[i:i + self.unity_batch])
+                units.append((unity.name, unity, unity.with_suffix(".o")))
+        return units
+
+    def languages(self) -> List[str]:
+        """Languages of all the sources."""
+        return sorted(set(SOURCE_SUFFIXES[x.suffix] for x in self.sources))
+
+    def output(self, build_dir: pathlib.Path) -> pathlib.Path:
+        """Path of the output file."""
+        raise NotImplementedError
+
+    def link_inputs(self, build_dir: pathlib.Path) -> List[pathlib.Path]:
+        """Files linked into the targets depending on this target."""
+        return []
+
+    def link_args(
+        self,
+        driver: GenericCompilerDriver,
+        objs: List[pathlib.Path],
+        out: pathlib.Path,
+    ) -> List[str]:
+        """Arguments to link objs to out with driver."""
+        raise NotImplementedError
+
+    def link(
+        self,
+        driver: GenericCompilerDriver,
+        objs: List[pathlib.Path],
+        out: pathlib.Path,
+    ) -> subprocess.CompletedProcess:
+        """Link objs to out with driver."""
+        raise NotImplementedError
+
+
+class ExecutableTarget(GenericTarget):
+    """A target building an executable."""
+
+    def output(self, build_dir: pathlib.Path) -> pathlib.Path:  # noqa: D102
+        return build_dir / self.name
+
+    def link_args(self, driver, objs, out):  # noqa: D102
+        return driver.link_executable_args(objs, out)
+
+    def link(self, driver, objs, out):  # noqa: D102
+        return driver.link_executable(objs, out)
+
+
+class TestTarget(ExecutableTarget):
+    """
+    A target building an executable run by cfpm test.
+
+    The test passes if it exits with 0. It's run in the directory of the
+    target configuration with args, and killed after timeout seconds.
+    """
+
+    def __init__(self, name, directory, config, finder=None):  # noqa: D107
+        super().__init__(name, directory, config, finder)
+        self.args = [str(x) for x in config.get("args", [])]
+        try:
+            self.timeout = (
+                float(config["timeout"]) if "timeout" in config else None
+            )
+        except (TypeError, ValueError):
+            raise BadConfigurationError(
+                "timeout of target {} should be a number.".format(name)
+            )
+        if self.timeout is not None and self.timeout <= 0:
+            raise BadConfigurationError(
+                "timeout of target {} should be positive.".format(name)
+            )
+
+
+class SharedLibraryTarget(GenericTarget):
+    """A target building a shared library."""
+
+    def output(self, build_dir: pathlib.Path) -> pathlib.Path:  # noqa: D102
+        return build_dir / "lib{}.so".format(self.name)
+
+    def link_inputs(self, build_dir):  # noqa: D102
+        return [self.output(build_dir)]
+
+    def link_args(self, driver, objs, out):  # noqa: D102
+        return driver.link_shared_args(objs, out)
+
+    def link(self, driver, objs, out):  # noqa: D102
+        return driver.link_shared(objs, out)
+
+
+class StaticLibraryTarget(GenericTarget):
+    """
+    A target building a static library.
+
+    With thin = true in the target configuration, a thin archive referring
+    to the objects is created instead of copying them.
+    """
+
+    # An archive only has its own objects, dependents link the rest.
+    links_dependencies = False
+
+    def __init__(self, name, directory, config, finder=None):  # noqa: D107
+        super().__init__(name, directory, config, finder)
+        self.thin = bool(config.get("thin", False))
+
+    def output(self, build_dir: pathlib.Path) -> pathlib.Path:  # noqa: D102
+        return build_dir / "lib{}.a".format(self.name)
+
+    def link_inputs(self, build_dir):  # noqa: D102
+        return [self.output(build_dir)]
+
+    def link_args(self, driver, objs, out):  # noqa: D102
+        return driver.link_static_args(objs, out, self.thin)
+
+    def link(self, driver, objs, out):  # noqa: D102
+        return driver.link_static(objs, out, self.thin)
+
+
+# Target types in the target configuration
+TARGET_TYPES: Dict[str, Type[GenericTarget]] = {
+    "bin": ExecutableTarget,
+    "lib": StaticLibraryTarget,
+    "shared": SharedLibraryTarget,
+    "test": TestTarget,
+}
+
+
+def create_target(
+    root: pathlib.Path, entry: Dict, finder: Optional[SourceFinder] = None
+) -> GenericTarget:
+    """
+    Create a target from an entry of [[targets]].
+
+    The entry should have the [target] table of the target configuration
+    merged in as entry["target"]. Sources are found by finder.
+    """
+    try:
+        name = str(entry["name"])
+        directory = root / str(entry["dir"])
+        config = entry["target"]
+        target_type = str(config["type"])
+    except KeyError as e:
+        raise BadConfigurationError("Missing key {} in target.".format(e))
+    if not vaild_name.match(name):
+        raise BadConfigurationError(
+            "Target name {} should contain only alphanumeric characters and "
+            "underscores.".format(name)
+        )
+    if target_type not in TARGET_TYPES:
+        raise BadConfigurationError(
+            "Unknown type {} of target {}.".format(target_type, name)
+        )
+    return TARGET_TYPES[target_type](name, directory, config, finder)
+
+
+class PackageTarget(GenericTarget):
+    """
+    A dependency package fetched by cfpm fetch, seen as a target.
+
+    Targets list the package in deps like other targets, to use its headers
+    and link its libraries. Nothing of it is compiled by the build of the
+    project, the package is built by a build of its own in its build
+    directory before that, and only its libraries are built.
+    """
+
+    # The libraries of the package are linked by the targets using it.
+    links_dependencies = False
+
+    def __init__(
+        self,
+        package: LockedPackage,
+        directory: pathlib.Path,
+        finder: Optional[SourceFinder] = None,
+    ):
+        """
+        Initialize the target of package installed in directory.
+
+        Raise a BadConfigurationError if the package is not installed or
+        its configuration is bad.
+        """
+        if not directory.is_dir():
+            raise BadConfigurationError(
+                "Package {} is not fetched, run cfpm fetch.".format(
+                    package.name
+                )
+            )
+        self.package = package
+        self.config = load_config(directory)
+        self.build_dir = directory / "build"
+        project = Project()
+        for entry in self.config.get("targets", []):
+            project.add_target(create_target(directory, entry, finder))
+        # Each library comes before the libraries it depends on.
+        self.libraries = [
+            x
+            for x in reversed(project.topological())
+            if x.link_inputs(self.build_dir)
+        ]
+        headers = [str(h) for x in self.libraries for h in x.headers]
+        super().__init__(
+            package.name,
+            directory,
+            {"headers": headers, "deps": package.dependencies},
+            finder,
+        )
+
+    def output(self, build_dir: pathlib.Path) -> pathlib.Path:  # noqa: D102
+        return self.build_dir
+
+    def link_inputs(self, build_dir):  # noqa: D102
+        return [
+            x
+            for library in self.libraries
+            for x in library.link_inputs(self.build_dir)
+        ]
+
+
+def load_packages(
+    root: pathlib.Path, config: Dict, finder: Optional[SourceFinder] = None
+) -> List[PackageTarget]:
+    """
+    Create targets of all the packages in the lockfile of the project.
+
+    Raise a BadConfigurationError if any of [dependencies] is not fetched.
+    """
+    locked = read_lockfile(root)
+    for requirement in parse_dependencies(config):
+        if requirement.name not in locked:
+            raise BadConfigurationError(
+                "Package {} is not fetched, run cfpm fetch.".format(
+                    requirement.name
+                )
+            )
+    return [
+        PackageTarget(x, root / "build" / "deps" / x.name, finder)
+        for x in locked.values()
+    ]
+
+
+def _report(result: subprocess.CompletedProcess, failed: bool) -> None:
+    """Log the output of an external program."""
+    output = "".join(x for x in (result.stdout, result.stderr) if x).rstrip()
+    if output:
+        (logger.error if failed else logger.warning)(output)
+
+
+def _record_usage(
+    resources: Optional[ResourceHistory],
+    key: str,
+    result: subprocess.CompletedProcess,
+) -> None:
+    """Record the resource usage of result if it was measured."""
+    if resources is None or not isinstance(result, MeasuredProcess):
+        return
+    if result.usage:
+        resources.record(key, result.usage.max_rss, result.usage.cpu_seconds)
+
+
+class CompileAction:
+    """
+    The action compiling src to obj, raise an ExternalProgramError if failed.
+
+    Nothing is done if graph says obj is up to date. If cache is given, the
+    object is fetched from the cache if possible, and stored into the cache
+    after compiled. Call it to compile in the current thread, or await
+    run_async to compile in asyncio with the output streamed to the logger.
+    """
+
+    def __init__(
+        self,
+        driver: GenericCompilerDriver,
+        src: pathlib.Path,
+        obj: pathlib.Path,
+        graph: DependencyGraph,
+        cache: Optional[ObjectCache] = None,
+        extra_inputs: List[pathlib.Path] = [],
+        remote: Optional[WorkerPool] = None,
+        resources: Optional[ResourceHistory] = None,
+    ):
+        """
+        Initialize the action, see the class docstring.
+
+        Args:
+            extra_inputs: Inputs not in the depfile, like the precompiled
+                header.
+            remote: Workers to compile on, src is compiled locally if None or
+                they are all busy.
+            resources: The history recording the memory and CPU time of
+                local compiles, keyed by obj.
+        """
+        self.driver = driver
+        self.src = src
+        self.obj = obj
+        self.dep = obj.with_suffix(obj.suffix + ".d")
+        self.graph = graph
+        self.extra_inputs = [str(x) for x in extra_inputs]
+        # Objects with split DWARF refer to their .dwo files by path, which
+        # are neither cached nor sent back by workers.
+        self.cache = None if driver.split_dwarf else cache
+        # Workers only know the language standard, objects compiled with
+        # other flags there would be cached under the local command.
+        self.remote = None if driver.codegen_args() else remote
+        self.resources = resources
+        self.title = "Compiling {}".format(src)
+        self.key = ""
+        self.args = ""
+
+    def _args(self, dep: Optional[pathlib.Path] = None) -> List[str]:
+        return self.driver.compile_args(self.src, self.obj, dep)
+
+    def _compile(self) -> subprocess.CompletedProcess:
+        if self.remote:
+            result = self.remote.compile(
+                self.driver,
+                SOURCE_SUFFIXES[self.src.suffix],
+                self.src,
+                self.obj,
+                self.dep,
+            )
+            if result:
+                return result
+        return self.driver.compile_obj(self.src, self.obj, self.dep)
+
+    async def _compile_async(self) -> subprocess.CompletedProcess:
+        if self.remote:  # Remote compiling is blocking.
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._compile)
+        return await self.driver.compile_obj_async(
+            self.src, self.obj, self.dep
+        )
+
+    def _prepare(self) -> bool:
+        """Check the graph and the cache, returns if compiling is needed."""
+        self.args = command_digest(self.driver, self._args(), self.obj)
+        if self.graph.up_to_date(self.obj, self.args):
+            logger.debug("{} is up to date.".format(self.obj))
+            return False
+        self.obj.parent.mkdir(parents=True, exist_ok=True)
+        if self.cache:
+            self.key = self.cache.key(self.args, self.src)
+            inputs = self.cache.fetch(self.key, self.obj, self.graph.digest)
+            if inputs is not None:
+                logger.info("{} (cached).".format(self.title))
+                digest = str(self.graph.digest(inputs))
+                self.graph.record(self.obj, self.args, inputs, digest)
+                return False
+        logger.info("{}.".format(self.title))
+        return True
+
+    def _finish(self, result: subprocess.CompletedProcess) -> None:
+        """Check the result and record the inputs of the object."""
+        _record_usage(self.resources, str(self.obj), result)
+        _report(result, result.returncode != 0)
+        if result.returncode != 0:
+            raise ExternalProgramError(
+                "Failed to compile {}.".format(self.src)
+            )
+        try:
+            inputs = [os.path.abspath(x) for x in parse_depfile(self.dep)]
+        except ValueError as e:
+            raise ExternalProgramError(e)
+        inputs.extend(self.extra_inputs)
+        digest = self.graph.digest(inputs)
+        if digest is None:  # Inputs are removed while compiling.
+            return
+        self.graph.record(self.obj, self.args, inputs, digest)
+        if self.cache:
+            self.cache.store(self.key, self.obj, inputs, digest)
+
+    def __call__(self) -> bool:  # noqa: D102
+        if not self._prepare():
+            return False
+        self._finish(self._compile())
+        return True
+
+    async def run_async(self) -> bool:  # noqa: D102
+        if not self._prepare():
+            return False
+        self._finish(await self._compile_async())
+        return True
+
+
+class PCHAction(CompileAction):
+    """
+    The action precompiling a header of language, like CompileAction.
+
+    The precompiled header is written beside obj, which is a stub header
+    including src, so compilers can fall back to src if the precompiled
+    header is not usable.
+    """
+
+    def __init__(
+        self,
+        driver: GenericCompilerDriver,
+        src: pathlib.Path,
+        obj: pathlib.Path,
+        language: str,
+        graph: DependencyGraph,
+        cache: Optional[ObjectCache] = None,
+        resources: Optional[ResourceHistory] = None,
+    ):
+        """Initialize the action, see the class docstring."""
+        gch = obj.with_name(obj.name + ".gch")
+        super().__init__(driver, src, gch, graph, cache, resources=resources)
+        self.stub = obj
+        self.language = language
+        self.title = "Precompiling {} for {}".format(src, language)
+
+    def _args(self, dep: Optional[pathlib.Path] = None) -> List[str]:
+        return self.driver.pch_args(self.src, self.obj, self.language, dep)
+
+    def _compile(self) -> subprocess.CompletedProcess:
+        return self.driver.compile_pch(
+            self.src, self.obj, self.language, self.dep
+        )
+
+    async def _compile_async(self) -> subprocess.CompletedProcess:
+        return await self.driver.compile_pch_async(
+            self.src, self.obj, self.language, self.dep
+        )
+
+    def _prepare(self) -> bool:
+        write_include_source(self.stub, [self.src])
+        return super()._prepare()
+
+
+def _pch_stub(
+    obj_dir: pathlib.Path, language: str, header: pathlib.Path
+) -> pathlib.Path:
+    """Path of the stub of a precompiled header of language."""
+    return obj_dir / "pch" / UNITY_SUFFIXES[language][1:] / header.name
+
+
+def link_target(
+    target: GenericTarget,
+    driver: GenericCompilerDriver,
+    objs: List[pathlib.Path],
+    out: pathlib.Path,
+    graph: Optional[DependencyGraph] = None,
+    resources: Optional[ResourceHistory] = None,
+) -> bool:
+    """
+    Link target with driver, raise an ExternalProgramError if failed.
+
+    If graph is given, linking is skipped if out is newer than all of objs
+    and linked with the same arguments. Returns if out is linked. The usage
+    of the linker is recorded into resources if given.
+    """
+    args = command_digest(driver, target.link_args(driver, objs, out), out)
+    inputs = [str(x) for x in objs]
+    if graph and graph.output_up_to_date(out, args, inputs):
+        logger.debug("{} is up to date.".format(out))
+        return False
+    logger.info("Linking {}.".format(out))
+    try:
+        result = target.link(driver, objs, out)
+    except RuntimeError as e:
+        raise ExternalProgramError(
+            "Failed to link {}: {}".format(target.name, e)
+        )
+    _record_usage(resources, str(out), result)
+    _report(result, result.returncode != 0)
+    if result.returncode != 0:
+        raise ExternalProgramError("Failed to link {}.".format(target.name))
+    if graph:
+        graph.record(out, args, inputs, None)
+    return True
 
 
 class Build:
     """The object representing a build."""
 
-    def __init__(self, config: Dict):
-        """Initialize the build with all the configurations."""
-        pass
+    def __init__(
+        self,
+        config: Dict,
+        root: Pathlike = ".",
+        jobs: Optional[int] = None,
+        keep_going: bool = False,
+        use_asyncio: bool = False,
+        cache: Optional[ObjectCache] = None,
+        probes: Optional[ProbeCache] = None,
+        workers: Optional[WorkerPool] = None,
+        graph: Optional[DependencyGraph] = None,
+        finder: Optional[SourceFinder] = None,
+        history: Optional[DurationHistory] = None,
+        artifacts: Optional[ArtifactCache] = None,
+        packages: Optional[List[PackageTarget]] = None,
+        libraries_only: bool = False,
+        resources: Optional[ResourceHistory] = None,
+        mem_limit: Optional[int] = None,
+        load_limit: Optional[float] = None,
+        lto_cache: Optional[pathlib.Path] = None,
+        targets: Optional[List[str]] = None,
+    ):
+        """
+        Initialize the build with all the configurations.
+
+        Args:
+            config: The package configuration, with the configuration of each
+                target merged into its entry of [[targets]] as "target".
+            root: The root directory of the package.
+            jobs: Number of jobs running in parallel, defaults to the number
+                of CPUs.
+            keep_going: Keep building other targets after a failure.
+            use_asyncio: Run compilers in an asyncio event loop with their
+                output streamed, instead of a thread per compiler.
+            cache: The object cache to use, objects are not cached if None.
+            probes: The cache of compiler probes.
+            workers: Remote workers to compile on. Their slots are added to
+                the default number of jobs.
+            graph: The dependency graph kept in memory by a daemon, loaded
+                from the build directory if None.
+            finder: The source finder kept in memory by a daemon, loaded
+                from the build directory if None.
+            history: Durations of past jobs, used to start the longest
+                chains of jobs first.
+            artifacts: The cache of prebuilt packages, packages are always
+                built if None.
+            packages: Dependency packages usable by the targets, loaded
+                from the lockfile if None.
+            libraries_only: Only build targets used by other targets, like
+                when building a dependency package.
+            resources: Peak memory and CPU time of past compiles and links,
+                recorded by this build.
+            mem_limit: Bytes of memory predicted for the running jobs, new
+                jobs wait while it would be exceeded.
+            load_limit: New jobs wait while the load average is at least
+                the limit.
+            lto_cache: The directory of modules optimized by ThinLTO, kept
+                across links.
+            targets: Names of the targets to build, with the targets they
+                depend on. All the targets are built if None.
+        """
+        self.root = ensure_path(root, is_dir=True)
+        self.build_dir = self.root / "build"
+        self.graph = graph or DependencyGraph(self.build_dir / "deps.json")
+        self.workers = workers
+        if jobs is None and workers:
+            jobs = (os.cpu_count() or 1) + workers.capacity()
+        self.history = history or DurationHistory()
+        self.resources = resources or ResourceHistory()
+        self.scheduler = Scheduler(
+            jobs,
+            keep_going,
+            use_asyncio,
+            self.history,
+            self.resources,
+            mem_limit,
+            load_limit,
+        )
+        self.cache = cache
+        self.probes = probes or ProbeCache()
+        package = config.get("package", {})
+        self.standards: Dict[str, str] = {}
+        if "c_standard" in package:
+            self.standards["c"] = "c{}".format(package["c_standard"])
+        if "cpp_standard" in package:
+            self.standards["c++"] = "c++{}".format(package["cpp_standard"])
+        self.linker = str(package.get("linker", "auto"))
+        if self.linker not in ["auto", "default", "bfd"] + LINKERS:
+            raise BadConfigurationError(
+                "Unknown linker {}.".format(self.linker)
+            )
+        # true means as many threads as jobs
+        threads = package.get("link_threads", False)
+        self.link_threads: Optional[int] = self.scheduler.jobs
+        try:
+            if threads is not True:
+                self.link_threads = int(threads) or None
+        except (TypeError, ValueError):
+            raise BadConfigurationError(
+                "link_threads should be a number or a boolean."
+            )
+        self.gdb_index = bool(package.get("gdb_index", False))
+        self.split_dwarf = bool(package.get("split_dwarf", False))
+        self.lto = str(package.get("lto", "off"))
+        if self.lto not in LTO_MODES:
+            raise BadConfigurationError(
+                "lto should be one of {}, not {}.".format(
+                    ", ".join(LTO_MODES), self.lto
+                )
+            )
+        self.lto_cache = lto_cache
+        # compiler -> selected linker
+        self.linkers: Dict[str, Optional[str]] = {}
+        self.finder = finder or SourceFinder(self.build_dir / "sources.json")
+        self.artifacts = artifacts
+        self.libraries_only = libraries_only
+        self.project = Project()
+        with tracer.span("find sources", "config"):
+            if packages is None and config.get("dependencies"):
+                packages = load_packages(self.root, config, self.finder)
+            for package in packages or []:
+                self.project.add_target(package)
+            for entry in config.get("targets", []):
+                target = create_target(self.root, entry, self.finder)
+                self.project.add_target(target)
+        # Fail early on unknown dependencies and cycles.
+        self.project.topological()
+        self.selected = set(self.project.targets)
+        if targets is not None:
+            self.selected = set()
+            for name in targets:
+                target = self.project.target(name)
+                self.selected.add(target)
+                self.selected.update(self.project.closure(target))
+
+    def driver(
+        self, target: GenericTarget, language: str
+    ) -> GenericCompilerDriver:
+        """Create a compiler driver of language for target."""
+        env, default = COMPILERS[language]
+        compiler = os.environ.get(env, default)
+        try:
+            driver = adapt_compiler(compiler, self.probes)
+        except RuntimeError as e:
+            raise BadConfigurationError(e)
+        if not driver:
+            raise BadConfigurationError(
+                "Compiler {} is not supported.".format(compiler)
+            )
+        driver.use_response_files(self.build_dir / "rsp")
+        if language in self.standards:
+            driver.set_standard(self.standards[language])
+        self._setup_linker(driver)
+        for header in target.headers:
+            driver.add_include_directory(header)
+        # Headers of dependencies are usable too.
+        for dep in self.project.closure(target):
+            for header in dep.headers:
+                driver.add_include_directory(header)
+        for (key, value) in target.definitions.items():
+            driver.add_definition(key, value)
+        for name in target.links:
+            driver.add_link_library(name)
+        # The arguments shared by the compiles of target are fixed now.
+        driver.freeze()
+        return driver
+
+    def _setup_linker(self, driver: GenericCompilerDriver) -> None:
+        assert driver.program
+        compiler = driver.program.program
+        if compiler not in self.linkers:
+            try:
+                linker = select_linker(driver, self.linker, self.probes)
+            except RuntimeError as e:
+                raise BadConfigurationError(e)
+            logger.debug(
+                "Linking with {} for {}.".format(linker or "default", compiler)
+            )
+            self.linkers[compiler] = linker
+        linker = self.linkers[compiler]
+        if linker:
+            driver.use_linker(linker)
+        if self.link_threads:
+            driver.set_link_threads(self.link_threads)
+        if self.gdb_index:
+            if linker not in LINKERS:
+                logger.warning("gdb_index needs mold, lld or gold.")
+            driver.set_gdb_index()
+        if self.split_dwarf:
+            driver.set_split_dwarf()
+        if self.lto != "off":
+            # Optimizing at link time takes the whole core budget, like the
+            # threads of the linker.
+            driver.set_lto(self.lto, self.scheduler.jobs, self.lto_cache)
+
+    def jobs(
+        self, target: GenericTarget, link_jobs: Dict[str, Job] = {}
+    ) -> List[Job]:
+        """
+        Create the compile jobs and the link job of target.
+
+        Args:
+            link_jobs: Link jobs of other targets by name, the link job of
+                target waits for those of its dependencies.
+        """
+        drivers = {x: self.driver(target, x) for x in target.languages()}
+        if not drivers:
+            raise BadConfigurationError(
+                "Target {} has no sources.".format(target.name)
+            )
+        obj_dir = self.build_dir / "obj" / target.name
+        pch_jobs: Dict[str, Job] = {}
+        gch: Dict[str, List[pathlib.Path]] = {}
+        for (language, header) in target.pch.items():
+            if language not in drivers:
+                continue
+            stub = _pch_stub(obj_dir, language, header)
+            pch = PCHAction(
+                drivers[language],
+                header,
+                stub,
+                language,
+                self.graph,
+                self.cache,
+                self.resources,
+            )
+            # The stub is included by every source after precompiled.
+            drivers[language].use_pch(stub)
+            gch[language] = [pch.obj]
+            pch_jobs[language] = Job(
+                "precompile {}".format(header.name),
+                pch,
+                (),
+                pch.run_async,
+                str(pch.obj),
+            )
+        compile_jobs: List[Job] = []
+        objs: List[pathlib.Path] = []
+        for (name, src, obj) in target.units(obj_dir):
+            objs.append(obj)
+            language = SOURCE_SUFFIXES[src.suffix]
+            action = CompileAction(
+                drivers[language],
+                src,
+                obj,
+                self.graph,
+                self.cache,
+                gch.get(language, []),
+                self.workers,
+                self.resources,
+            )
+            compile_jobs.append(
+                Job(
+                    "compile {}".format(name),
+                    action,
+                    [pch_jobs[language]] if language in pch_jobs else [],
+                    action.run_async,
+                    str(obj),
+                )
+            )
+        link_deps = list(compile_jobs)
+        for dep in self.project.closure(target):
+            if dep.name in link_jobs:
+                link_deps.append(link_jobs[dep.name])
+            if target.links_dependencies:
+                objs.extend(dep.link_inputs(self.build_dir))
+        # C++ objects needs the C++ runtime to link.
+        link_driver = drivers["c++"] if "c++" in drivers else drivers["c"]
+        out = target.output(self.build_dir)
+        link_job = Job(
+            "link {}".format(target.name),
+            partial(
+                link_target,
+                target,
+                link_driver,
+                objs,
+                out,
+                self.graph,
+                self.resources,
+            ),
+            link_deps,
+            key=str(out),
+        )
+        return list(pch_jobs.values()) + compile_jobs + [link_job]
+
+    def compile_commands(self) -> List[Dict]:
+        """
+        Entries of the compilation database of all the targets.
+
+        Each source has the arguments it's compiled with outside of unity
+        builds, so tools see the real sources. Nothing is compiled.
+        """
+        entries: List[Dict] = []
+        for target in self.project.topological():
+            drivers = {x: self.driver(target, x) for x in target.languages()}
+            obj_dir = self.build_dir / "obj" / target.name
+            for (language, header) in target.pch.items():
+                if language in drivers:
+                    stub = _pch_stub(obj_dir, language, header)
+                    drivers[language].use_pch(stub)
+            for src in target.sources:
+                driver = drivers[SOURCE_SUFFIXES[src.suffix]]
+                assert driver.program
+                rel = src.relative_to(target.directory).as_posix()
+                obj = obj_dir / (rel + ".o")
+                entries.append(
+                    {
+                        "directory": str(self.root),
+                        "arguments": [driver.program.program]
+                        + driver.compile_args(src, obj),
+                        "file": str(src),
+                        "output": str(obj),
+                    }
+                )
+        return entries
+
+    def write_compdb(self) -> None:
+        """Write the compilation database to the build directory."""
+        with tracer.span("compdb", "build"):
+            try:
+                database = CompilationDatabase(self.build_dir / COMPDB_FILE)
+                changed = database.update(self.compile_commands())
+            finally:
+                self.probes.save()
+                self.finder.save()
+        logger.debug(
+            "Updated {} entries of {}.".format(changed, database.path)
+        )
 
     def build(self) -> None:
-        """Acturally build the project."""
-        pass
+        """
+        Acturally build the project.
 
+        Raise an ExternalProgramError if any of the jobs failed.
+        """
+        with tracer.span("build", "build"):
+            self._build()
 
-class GenericTarget:
-    """An abstract class representing a target."""
+    def _package_key(self, target: PackageTarget) -> str:
+        """Key of the prebuilt libraries of a package."""
+        package = target.package
+        parts = [package.name, package.version, package.commit]
+        for dep in self.project.dependencies(target):
+            if isinstance(dep, PackageTarget):
+                parts.append(self._package_key(dep))
+        # The compilers and the flags cfpm compiles with
+        for language in sorted(COMPILERS):
+            env, default = COMPILERS[language]
+            try:
+                driver = adapt_compiler(
+                    os.environ.get(env, default), self.probes
+                )
+            except RuntimeError:
+                continue
+            if driver:
+                parts.append(driver.identity())
+                parts.extend(driver.compile_args("src", "obj"))
+        return artifact_key(*parts)
+
+    def _fetch_prebuilt(
+        self, key: str, build_dir: pathlib.Path, files: List[str]
+    ) -> bool:
+        if not self.artifacts:
+            return False
+        try:
+            return self.artifacts.fetch(key, build_dir, files)
+        except OSError as e:
+            logger.warning("Failed to fetch prebuilt {}: {}".format(key, e))
+            return False
 
-    pass
+    def build_package(self, target: PackageTarget) -> None:
+        """
+        Build the libraries of a dependency package.
+
+        The libraries are taken from the artifact cache if possible, and
+        stored into it after built. Nothing is done if they are built with
+        the same key already.
+        """
+        key = self._package_key(target)
+        build_dir = target.build_dir
+        files = [
+            x.relative_to(build_dir).as_posix()
+            for x in target.link_inputs(build_dir)
+        ]
+        marker = build_dir / "artifact.key"
+        try:
+            if marker.read_text() == key and all(
+                (build_dir / x).exists() for x in files
+            ):
+                return
+        except FileNotFoundError:
+            pass
+        title = "{} {}".format(target.name, target.package.version)
+        if self._fetch_prebuilt(key, build_dir, files):
+            logger.info("Using prebuilt {}.".format(title))
+        else:
+            logger.info("Building package {}.".format(title))
+            # Outputs may be hardlinks to the cache, never write into them.
+            for name in files:
+                if os.path.lexists(build_dir / name):
+                    os.unlink(build_dir / name)
+            build = Build(
+                target.config,
+                target.directory,
+                jobs=self.scheduler.jobs,
+                keep_going=self.scheduler.keep_going,
+                cache=self.cache,
+                probes=self.probes,
+                workers=self.workers,
+                history=self.history,
+                artifacts=self.artifacts,
+                packages=[
+                    x
+                    for x in self.project.closure(target)
+                    if isinstance(x, PackageTarget)
+                ],
+                libraries_only=True,
+                resources=self.resources,
+                mem_limit=self.scheduler.mem_limit,
+                load_limit=self.scheduler.load_limit,
+                lto_cache=self.lto_cache,
+            )
+            build.build()
+            if self.artifacts:
+                try:
+                    self.artifacts.store(key, build_dir, files)
+                except OSError as e:
+                    logger.warning("Failed to store {}: {}".format(title, e))
+        build_dir.mkdir(parents=True, exist_ok=True)
+        marker.write_text(key)
+
+    def _build(self) -> None:
+        self.graph.refresh()
+        with tracer.span("packages", "build"):
+            for target in self.project.topological():
+                if (
+                    isinstance(target, PackageTarget)
+                    and target in self.selected
+                ):
+                    self.build_package(target)
+        jobs: List[Job] = []
+        try:
+            with tracer.span("plan", "build"):
+                link_jobs: Dict[str, Job] = {}
+                for target in self.project.topological():
+                    if (
+                        isinstance(target, PackageTarget)
+                        or target not in self.selected
+                    ):
+                        continue
+                    if self.libraries_only and not target.link_inputs(
+                        self.build_dir
+                    ):
+                        continue
+                    target_jobs = self.jobs(target, link_jobs)
+                    link_jobs[target.name] = target_jobs[-1]
+                    jobs.extend(target_jobs)
+        finally:
+            self.probes.save()
+            self.finder.save()
+        self.build_dir.mkdir(exist_ok=True)
+        try:
+            failed = self.scheduler.run(jobs)
+        finally:
+            self.graph.save()
+            self.history.save()
+            self.resources.save()
+            if self.cache:
+                self.cache.flush()
+        if failed:
+            raise ExternalProgramError(
+                "Build failed, {} job(s) failed.".format(len(failed))
+            )
+        logger.info("Built {} target(s).".format(len(link_jobs)))
 
 
 class Project:
-    """The object representing a project."""
+    """
+    The object representing a project.
+
+    Targets and their deps form a DAG, which is checked by topological.
+    """
 
     def __init__(self) -> None:
         """Initialize the project."""
         self.targets: List[GenericTarget] = []
+        self._names: Dict[str, GenericTarget] = {}
 
     def add_target(self, target: GenericTarget):
         """Add a target to the project."""
+        if target.name in self._names:
+            raise BadConfigurationError(
+                "Duplicated target {}.".format(target.name)
+            )
         self.targets.append(target)
+        self._names[target.name] = target
+
+    def target(self, name: str) -> GenericTarget:
+        """Get a target by name, raise a BadConfigurationError if unknown."""
+        if name not in self._names:
+            raise BadConfigurationError("Unknown target {}.".format(name))
+        return self._names[name]
+
+    def dependencies(self, target: GenericTarget) -> List[GenericTarget]:
+        """
+        Direct dependencies of target.
+
+        Raise a BadConfigurationError if any of them doesn't exist.
+        """
+        result = []
+        for name in target.deps:
+            if name not in self._names:
+                raise BadConfigurationError(
+                    "Target {} depends on unknown target {}.".format(
+                        target.name, name
+                    )
+                )
+            result.append(self._names[name])
+        return result
+
+    def topological(self) -> List[GenericTarget]:
+        """
+        List all the targets, each after all its dependencies.
+
+        Raise a BadConfigurationError if there's a dependency cycle.
+        """
+        result: List[GenericTarget] = []
+        done: Set[str] = set()
+        # Targets being visited, from the first to the current one
+        path: List[GenericTarget] = []
+        for root in self.targets:
+            if root.name in done:
+                continue
+            stack = [iter([root])]
+            while stack:
+                target = next(stack[-1], None)
+                if target is None:
+                    stack.pop()
+                    if path:
+                        done.add(path[-1].name)
+                        result.append(path.pop())
+                    continue
+                if target.name in done:
+                    continue
+                if target in path:
+                    cycle = path[path.index(target):] + [target]
+                    raise BadConfigurationError(
+                        "Dependency cycle of targets: {}.".format(
+                            " -> ".join(x.name for x in cycle)
+                        )
+                    )
+                path.append(target)
+                stack.append(iter(self.dependencies(target)))
+        return result
+
+    def closure(self, target: GenericTarget) -> List[GenericTarget]:
+        """
+        All the targets target depends on, directly or not.
+
+        Each target comes before its own dependencies, the order linkers
+        need for static libraries.
+        """
+        deps: Set[str] = set()
+        stack = [target]
+        while stack:
+            for dep in self.dependencies(stack.pop()):
+                if dep.name not in deps:
+                    deps.add(dep.name)
+                    stack.append(dep)
+        return [x for x in reversed(self.topological()) if x.name in deps]
@@ -0,0 +1,417 @@
+"""Distributed compiling on remote workers."""
+
+import json
+import os
+import pathlib
+import re
+import socket
+import socketserver
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
+from .drivers import (
+    COMPILERS,
+    GenericCompilerDriver,
+    ProbeCache,
+    adapt_compiler,
+)
+from .logging import logger
+
+# Address of a TCP socket or the path of a Unix socket
+Address = Union[Tuple[str, int], str]
+
+# Default address the worker listens on
+DEFAULT_WORKER_ADDRESS = "127.0.0.1:3633"
+
+# Suffixes of preprocessed sources of each language
+PREPROCESSED_SUFFIXES: Dict[str, str] = {"c": ".i", "c++": ".ii"}
+
+# Language standards shipped to workers, e.g. c99 or gnu++17
+valid_standard = re.compile(r"^[A-Za-z0-9+]+$")
+
+# Seconds to wait for a worker before falling back to compile locally
+CONNECT_TIMEOUT = 5.0
+
+# Seconds the load of other clients reported by a worker is trusted, so a
+# worker reported busy is tried again even if nothing refreshed it
+LOAD_TTL = 2.0
+
+
+def parse_address(address: str) -> Address:
+    """
+    Parse host:port as a TCP address, or unix:path as a Unix socket.
+
+    Raise a ValueError if address is malformed.
+    """
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    host, sep, port = address.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError("Bad address {}.".format(address))
+    return (host.strip("[]"), int(port))
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks: List[bytes] = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(
+    sock: socket.socket, header: Dict, payload: bytes = b""
+) -> None:
+    """
+    Send a message of a JSON header and a binary payload.
+
+    The header is prefixed by its length as a 32-bit big-endian integer, and
+    has the size of the payload as "size".
+    """
+    data = json.dumps(dict(header, size=len(payload))).encode()
+    sock.sendall(struct.pack("!I", len(data)) + data + payload)
+
+
+def recv_message(sock: socket.socket) -> Tuple[Dict, bytes]:
+    """Receive a message sent by send_message."""
+    (length,) = struct.unpack("!I", _recv_exactly(sock, 4))
+    header = json.loads(_recv_exactly(sock, length).decode())
+    return (header, _recv_exactly(sock, int(header.get("size", 0))))
+
+
+class Worker:
+    """
+    A worker compiling preprocessed sources for remote clients.
+
+    Clients ship the language, the standard and the preprocessed source, and
+    receive the object. The compilers are adapted once with the same drivers
+    as local builds, from the environment variables in COMPILERS.
+    """
+
+    def __init__(self, jobs: Optional[int] = None):
+        """
+        Initialize the worker and adapt the compilers.
+
+        Args:
+            jobs: Number of compilers running in parallel. Defaults to the
+                number of CPUs.
+        """
+        self.jobs = jobs or os.cpu_count() or 1
+        self.running = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(self.jobs)
+        self._probes = ProbeCache()
+        self.versions: Dict[str, str] = {}
+        for (language, (env, default)) in COMPILERS.items():
+            try:
+                driver = adapt_compiler(
+                    os.environ.get(env, default), self._probes
+                )
+            except RuntimeError as e:
+                logger.warning(e)
+                continue
+            if driver:
+                self.versions[language] = driver.version
+
+    def _driver(self, language: str) -> GenericCompilerDriver:
+        env, default = COMPILERS[language]
+        driver = adapt_compiler(os.environ.get(env, default), self._probes)
+        if not driver:
+            raise RuntimeError("Compiler of {} is gone.".format(language))
+        return driver
+
+    def hello(self) -> Dict:
+        """Describe the worker and its load."""
+        with self._lock:
+            running = self.running
+        return {
+            "capacity": self.jobs,
+            "running": running,
+            "versions": self.versions,
+        }
+
+    def compile(self, header: Dict, source: bytes) -> Tuple[Dict, bytes]:
+        """Compile a preprocessed source, returns the response."""
+        language = header.get("language")
+        standard = header.get("standard")
+        if language not in self.versions:
+            error = "Unsupported language {}.".format(language)
+            return ({"error": error}, b"")
+        if standard is not None and not valid_standard.match(standard):
+            return ({"error": "Bad standard {}.".format(standard)}, b"")
+        driver = self._driver(language)
+        if standard:
+            driver.set_standard(standard)
+        with self._slots:
+            with self._lock:
+                self.running += 1
+            try:
+                with tempfile.TemporaryDirectory(prefix="cfpm-") as tmp:
+                    src = pathlib.Path(tmp) / (
+                        "source" + PREPROCESSED_SUFFIXES[language]
+                    )
+                    obj = pathlib.Path(tmp) / "source.o"
+                    src.write_bytes(source)
+                    result = driver.compile_obj(src, obj)
+                    output = (result.stdout or "") + (result.stderr or "")
+                    data = obj.read_bytes() if result.returncode == 0 else b""
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    running = self.running
+        # The load lets clients balance with the compiles of other clients.
+        return (
+            {
+                "returncode": result.returncode,
+                "output": output,
+                "running": running,
+            },
+            data,
+        )
+
+    def handle(self, header: Dict, payload: bytes) -> Tuple[Dict, bytes]:
+        """Handle a request, returns the response."""
+        op = header.get("op")
+        try:
+            if op == "hello":
+                return (self.hello(), b"")
+            elif op == "compile":
+                return self.compile(header, payload)
+        except (OSError, RuntimeError) as e:
+            logger.error(e)
+            return ({"error": str(e)}, b"")
+        return ({"error": "Unknown op {}.".format(op)}, b"")
+
+    def server(self, address: Address) -> socketserver.BaseServer:
+        """Create a server of the worker listening on address."""
+        worker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        header, payload = recv_message(self.request)
+                    except (ConnectionError, struct.error):
+                        return
+                    send_message(self.request, *worker.handle(header, payload))
+
+        server: socketserver.ThreadingMixIn
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        else:
+            server = socketserver.ThreadingTCPServer(address, Handler)
+        server.daemon_threads = True
+        return server  # type: ignore
+
+
+class RemoteWorker:
+    """A connection pool to a worker."""
+
+    def __init__(self, address: str):
+        """
+        Initialize the pool, nothing is connected yet.
+
+        Raise a ValueError if address is malformed.
+        """
+        self.name = address
+        self.address = parse_address(address)
+        self.capacity = 0
+        # Compiles of this client running on the worker
+        self.running = 0
+        # Compiles of other clients, as last reported by the worker
+        self.others = 0
+        self.reported = 0.0
+        self.versions: Dict[str, str] = {}
+        self.alive = True
+        self._idle: List[socket.socket] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(self.address)
+        else:
+            sock = socket.create_connection(self.address, CONNECT_TIMEOUT)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Compiling may take a long time.
+        sock.settimeout(None)
+        return sock
+
+    def request(
+        self, header: Dict, payload: bytes = b""
+    ) -> Tuple[Dict, bytes]:
+        """Send a request and wait for the response."""
+        with self._lock:
+            sock = self._idle.pop() if self._idle else None
+        if sock is None:
+            sock = self._connect()
+        try:
+            send_message(sock, header, payload)
+            response = recv_message(sock)
+        except BaseException:
+            sock.close()
+            raise
+        with self._lock:
+            self._idle.append(sock)
+        return response
+
+    def hello(self) -> None:
+        """Ask for the capacity and the compilers of the worker."""
+        header, _ = self.request({"op": "hello"})
+        self.capacity = int(header["capacity"])
+        self.versions = dict(header["versions"])
+        self.report(int(header["running"]))
+
+    def report(self, running: int) -> None:
+        """Record the number of compiles the worker reported running."""
+        self.others = max(0, running - self.running)
+        self.reported = time.monotonic()
+
+    def load(self) -> int:
+        """Estimate the number of compiles running on the worker."""
+        if time.monotonic() - self.reported > LOAD_TTL:
+            return self.running
+        return self.running + self.others
+
+    def close(self) -> None:
+        """Close all the idle connections."""
+        with self._lock:
+            for sock in self._idle:
+                sock.close()
+            self._idle = []
+
+
+class WorkerPool:
+    """
+    Remote workers shared by compile actions.
+
+    A source is sent to the least loaded worker with the same compiler, and
+    compiled locally if all the workers are busy or down. The load counts
+    the compiles of this client and those of other clients, which workers
+    report in every response.
+    """
+
+    def __init__(self, addresses: List[str]):
+        """
+        Connect to the workers at addresses.
+
+        Workers not reachable are ignored with a warning. Raise a ValueError
+        if any of addresses is malformed.
+        """
+        self.workers: List[RemoteWorker] = []
+        self._lock = threading.Lock()
+        for address in addresses:
+            worker = RemoteWorker(address)
+            try:
+                worker.hello()
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Worker {} is down: {}".format(address, e))
+                continue
+            logger.debug(
+                "Worker {} has {} slots.".format(address, worker.capacity)
+            )
+            self.workers.append(worker)
+
+    def capacity(self) -> int:
+        """Total number of slots of the alive workers."""
+        return sum(x.capacity for x in self.workers if x.alive)
+
+    def _acquire(self, language: str, version: str) -> Optional[RemoteWorker]:
+        with self._lock:
+            candidates = [
+                x
+                for x in self.workers
+                if x.alive
+                and x.load() < x.capacity
+                and x.versions.get(language) == version
+            ]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda x: x.load() / x.capacity)
+            worker.running += 1
+            return worker
+
+    def _release(
+        self, worker: RemoteWorker, running: Optional[int] = None
+    ) -> None:
+        with self._lock:
+            worker.running -= 1
+            if running is not None:
+                worker.report(running)
+
+    def compile(
+        self,
+        driver: GenericCompilerDriver,
+        language: str,
+        src: pathlib.Path,
+        obj: pathlib.Path,
+        dep: Optional[pathlib.Path] = None,
+    ) -> Optional[subprocess.CompletedProcess]:
+        """
+        Preprocess src locally and compile it to obj on a worker.
+
+        Returns: The result like GenericCompilerDriver.compile_obj, or None if
+            no worker can compile it and it should be compiled locally.
+        """
+        worker = self._acquire(language, driver.version)
+        if worker is None:
+            return None
+        header: Dict = {}
+        try:
+            pre = obj.with_suffix(obj.suffix + PREPROCESSED_SUFFIXES[language])
+            result = driver.preprocess(src, pre, dep)
+            if result.returncode != 0:
+                return result
+            try:
+                header, data = worker.request(
+                    {
+                        "op": "compile",
+                        "language": language,
+                        "standard": driver.standard,
+                    },
+                    pre.read_bytes(),
+                )
+            except (OSError, ValueError) as e:
+                logger.warning(
+                    "Worker {} is down: {}".format(worker.name, e)
+                )
+                worker.alive = False
+                worker.close()
+                return None
+            finally:
+                pre.unlink()
+        finally:
+            running = header.get("running")
+            if not isinstance(running, int):
+                running = None
+            self._release(worker, running)
+        if "error" in header:
+            logger.warning(
+                "Worker {}: {}".format(worker.name, header["error"])
+            )
+            return None
+        logger.debug("Compiled {} on {}.".format(src, worker.name))
+        if header["returncode"] == 0:
+            tmp = obj.with_name(obj.name + ".remote")
+            tmp.write_bytes(data)
+            os.replace(tmp, obj)
+        return subprocess.CompletedProcess(
+            [str(src)],
+            header["returncode"],
+            (result.stdout or "") + (result.stderr or "") + header["output"],
+            "",
+        )
+
+    def close(self) -> None:
+        """Close all the connections."""
+        for worker in self.workers:
+            worker.close()
@@ -0,0 +1,493 @@
+"""Job scheduling for builds."""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    Future,
+    wait,
+    FIRST_COMPLETED,
+)
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from .exceptions import ExternalProgramError
+from .logging import deduplicate_warnings, job_output, logger
+from .profiling import current_lane, tracer
+from .utils import Pathlike
+
+# Estimated seconds of a job never run before, if nothing is known at all
+DEFAULT_DURATION = 1.0
+
+# Weight of the latest duration in the moving average of a job
+HISTORY_WEIGHT = 0.5
+
+
+class _History:
+    """A JSON file of per-job values kept in memory, keyed by Job.key."""
+
+    def __init__(self, path: Optional[Pathlike] = None):
+        """
+        Load the history from path.
+
+        If path is None, the history only lives in memory. A missing or
+        broken file is treated as an empty history.
+        """
+        self.path = pathlib.Path(path) if path else None
+        self._lock = threading.Lock()
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as f:
+                self._load(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.debug("Ignored broken {}: {}".format(self.path, e))
+
+    def _load(self, data) -> None:
+        raise NotImplementedError
+
+    def _dump(self):
+        raise NotImplementedError
+
+    def save(self) -> None:
+        """Write the history to its file."""
+        if not self.path:
+            return
+        with self._lock:
+            content = json.dumps(self._dump(), separators=(",", ":"))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, self.path)
+
+
+class DurationHistory(_History):
+    """
+    Durations of jobs in past builds, keyed by Job.key.
+
+    Each job keeps an exponential moving average of its durations, so one
+    slow run on a busy machine doesn't dominate the estimate.
+    """
+
+    def __init__(self, path: Optional[Pathlike] = None):  # noqa: D107
+        self.durations: Dict[str, float] = {}
+        super().__init__(path)
+
+    def _load(self, data) -> None:
+        self.durations = {str(k): float(v) for (k, v) in data.items()}
+
+    def _dump(self):
+        return self.durations
+
+    def estimate(self, key: str) -> float:
+        """Estimate the duration of a job, the mean of all if unknown."""
+        with self._lock:
+            if key in self.durations:
+                return self.durations[key]
+            if self.durations:
+                return sum(self.durations.values()) / len(self.durations)
+        return DEFAULT_DURATION
+
+    def record(self, key: str, seconds: float) -> None:
+        """Record a duration of a job."""
+        with self._lock:
+            if key in self.durations:
+                seconds = (
+                    HISTORY_WEIGHT * seconds
+                    + (1 - HISTORY_WEIGHT) * self.durations[key]
+                )
+            self.durations[key] = seconds
+
+
+class ResourceHistory(_History):
+    """
+    Peak memory and CPU time of compilers in past builds, keyed by Job.key.
+
+    The peak memory of a job is the largest of its recent runs, decayed by
+    HISTORY_WEIGHT, so admitting jobs by it errs on the safe side. The CPU
+    time is a moving average like DurationHistory.
+    """
+
+    def __init__(self, path: Optional[Pathlike] = None):  # noqa: D107
+        # key -> [peak resident set size in bytes, CPU seconds]
+        self.usages: Dict[str, List[float]] = {}
+        super().__init__(path)
+
+    def _load(self, data) -> None:
+        self.usages = {
+            str(k): [int(v[0]), float(v[1])] for (k, v) in data.items()
+        }
+
+    def _dump(self):
+        return self.usages
+
+    def predict(self, key: str) -> int:
+        """
+        Predict the peak memory of a job in bytes.
+
+        Unknown jobs are predicted as the mean of all, or 0 if nothing is
+        known.
+        """
+        with self._lock:
+            if key in self.usages:
+                return int(self.usages[key][0])
+            if self.usages:
+                total = sum(x[0] for x in self.usages.values())
+                return int(total / len(self.usages))
+        return 0
+
+    def record(self, key: str, max_rss: int, cpu_seconds: float) -> None:
+        """Record the peak memory in bytes and the CPU time of a job."""
+        with self._lock:
+            if key in self.usages:
+                (old_rss, old_cpu) = self.usages[key]
+                decayed = HISTORY_WEIGHT * max_rss + (
+                    1 - HISTORY_WEIGHT
+                ) * int(old_rss)
+                max_rss = max(max_rss, int(decayed))
+                cpu_seconds = (
+                    HISTORY_WEIGHT * cpu_seconds
+                    + (1 - HISTORY_WEIGHT) * old_cpu
+                )
+            self.usages[key] = [max_rss, cpu_seconds]
+
+
+class Job:
+    """A unit of work that can be scheduled after all its dependencies."""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    def __init__(
+        self,
+        name: str,
+        action: Callable[[], Optional[bool]],
+        deps: Iterable["Job"] = (),
+        async_action: Optional[Callable[[], Awaitable[Optional[bool]]]] = None,
+        key: Optional[str] = None,
+    ):
+        """
+        Initialize the job.
+
+        Args:
+            name: A human readable name used in messages.
+            action: A callable doing the actual work. It should raise an
+                ExternalProgramError or an OSError when the job fails, and
+                may return False if nothing needed to be done, so the
+                duration is not recorded.
+            deps: Jobs that must be done before this job starts.
+            async_action: An optional coroutine function doing the same work
+                as action, used by the asyncio scheduler.
+            key: A key identifying the job across builds, like the path of
+                its output. Defaults to name.
+        """
+        self.name = name
+        self.key = key or name
+        self.action = action
+        self.async_action = async_action
+        self.deps: List[Job] = list(deps)
+        self.state = Job.PENDING
+        self.error: Optional[Exception] = None
+
+    def __repr__(self) -> str:  # noqa: D105
+        return "<Job {} ({})>".format(self.name, self.state)
+
+
+class _Progress:
+    """Bookkeeping of a run, shared by the schedulers."""
+
+    def __init__(
+        self,
+        jobs: List[Job],
+        keep_going: bool,
+        history: Optional[DurationHistory] = None,
+    ):
+        self.jobs = jobs
+        self.keep_going = keep_going
+        self.waiting: Dict[Job, int] = {job: len(job.deps) for job in jobs}
+        self.dependents: Dict[Job, List[Job]] = {job: [] for job in jobs}
+        for job in jobs:
+            for dep in job.deps:
+                self.dependents[dep].append(job)
+        self.priority = self._critical_paths(history or DurationHistory())
+        # A heap of (-priority, order, job), the longest chain first
+        self._order = itertools.count()
+        self.ready: List[Tuple[float, int, Job]] = []
+        for job in jobs:
+            if not job.deps:
+                self._push(job)
+        self.failed: List[Job] = []
+        self.stopping = False
+
+    def _critical_paths(self, history: DurationHistory) -> Dict[Job, float]:
+        """Estimate the longest chain of durations from each job to the end."""
+        waiting = {job: len(self.dependents[job]) for job in self.jobs}
+        stack = [job for job in self.jobs if not waiting[job]]
+        priority: Dict[Job, float] = {}
+        while stack:
+            job = stack.pop()
+            priority[job] = history.estimate(job.key) + max(
+                (priority[x] for x in self.dependents[job]), default=0.0
+            )
+            for dep in job.deps:
+                waiting[dep] -= 1
+                if not waiting[dep]:
+                    stack.append(dep)
+        # Jobs in a cycle never become ready anyway.
+        return priority
+
+    def _push(self, job: Job) -> None:
+        priority = self.priority.get(job, 0.0)
+        heapq.heappush(self.ready, (-priority, next(self._order), job))
+
+    def next(
+        self, admit: Callable[[Job], bool] = lambda job: True
+    ) -> Optional[Job]:
+        """
+        Pop the next job to start, or None if no job can be started.
+
+        Jobs admit returns False for are left for later, and the next job
+        admitted is started instead.
+        """
+        if not self.ready or self.stopping:
+            return None
+        if admit(self.ready[0][2]):
+            _, _, job = heapq.heappop(self.ready)
+        else:
+            entry = next((x for x in sorted(self.ready) if admit(x[2])), None)
+            if entry is None:
+                return None
+            self.ready.remove(entry)
+            heapq.heapify(self.ready)
+            job = entry[2]
+        job.state = Job.RUNNING
+        logger.debug("Started job {}.".format(job.name))
+        return job
+
+    def finish(self, job: Job, error: Optional[BaseException]) -> None:
+        """Mark job as finished, error is raised by the job if failed."""
+        if error is None:
+            job.state = Job.DONE
+            logger.debug("Finished job {}.".format(job.name))
+            for dependent in self.dependents[job]:
+                self.waiting[dependent] -= 1
+                if self.waiting[dependent] == 0:
+                    self._push(dependent)
+            return
+        if not isinstance(error, (ExternalProgramError, OSError)):
+            raise error
+        job.state = Job.FAILED
+        job.error = error
+        self.failed.append(job)
+        logger.error(error)
+        # Skip everything depending on the failed job.
+        stack = list(self.dependents[job])
+        while stack:
+            dependent = stack.pop()
+            if dependent.state == Job.PENDING:
+                dependent.state = Job.SKIPPED
+                stack.extend(self.dependents[dependent])
+        if not self.keep_going:
+            self.stopping = True
+
+    def result(self) -> List[Job]:
+        """Mark jobs never started as skipped, returns failed jobs."""
+        for job in self.jobs:
+            if job.state == Job.PENDING:
+                job.state = Job.SKIPPED
+        return self.failed
+
+
+class Scheduler:
+    """
+    Run jobs on a bounded pool of workers.
+
+    The jobs of cfpm are mostly external programs. By default the workers are
+    threads waiting for the compiler processes. With use_asyncio, a single
+    event loop supervises the async actions of jobs, and jobs without one are
+    run in threads of the loop. Either way, at most `jobs` jobs run at the
+    same time, and a job is only started after all its dependencies are
+    done.
+
+    Ready jobs are started by critical path, the longest estimated chain of
+    jobs from them to the end first, so the workers don't idle at the end
+    waiting for a long chain started late.
+
+    With a memory limit, a job is only started if the peak memory predicted
+    for it and the running jobs fits, otherwise the next job that fits is
+    started. Like the -l option of make, no job is started while the load
+    average is too high. A job is always started if nothing is running.
+    """
+
+    def __init__(
+        self,
+        jobs: Optional[int] = None,
+        keep_going: bool = False,
+        use_asyncio: bool = False,
+        history: Optional[DurationHistory] = None,
+        resources: Optional[ResourceHistory] = None,
+        mem_limit: Optional[int] = None,
+        load_limit: Optional[float] = None,
+    ):
+        """
+        Initialize the scheduler.
+
+        Args:
+            jobs: The maximum number of jobs running in parallel. Defaults to
+                the number of CPUs.
+            keep_going: If set to True, jobs that don't depend on a failed job
+                are still run after a failure.
+            use_asyncio: Run the jobs in an asyncio event loop.
+            history: Durations of past jobs, to estimate critical paths and
+                record the durations of this run. Kept in memory if None.
+            resources: Peak memory of past jobs, to predict the memory of
+                running jobs. Kept in memory if None.
+            mem_limit: Don't start a job if the memory predicted for it and
+                the running jobs exceeds the limit in bytes.
+            load_limit: Don't start a job while the load average of the
+                last minute is at least the limit.
+        """
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs < 1:
+            raise ValueError(
+                "Number of jobs should be positive, not {}.".format(jobs)
+            )
+        self.jobs = jobs
+        self.keep_going = keep_going
+        self.use_asyncio = use_asyncio
+        self.history = history or DurationHistory()
+        self.resources = resources or ResourceHistory()
+        self.mem_limit = mem_limit
+        self.load_limit = load_limit
+        if load_limit and not hasattr(os, "getloadavg"):
+            logger.warning("Load average is not supported, ignored the limit.")
+            self.load_limit = None
+
+    def _loaded(self, running: int) -> bool:
+        """Check if the system is too loaded to start another job."""
+        if not running or not self.load_limit:
+            return False
+        return os.getloadavg()[0] >= self.load_limit
+
+    def _fits(self, job: Job, running: List[Job]) -> bool:
+        """Check if the memory of job fits besides the running jobs."""
+        if not running or not self.mem_limit:
+            return True
+        predicted = sum(self.resources.predict(x.key) for x in running)
+        return predicted + self.resources.predict(job.key) <= self.mem_limit
+
+    def run(self, jobs: Iterable[Job]) -> List[Job]:
+        """
+        Run all the jobs and wait for them.
+
+        Warnings and errors of each job are written together after it's
+        done, and warnings repeated by jobs are only written once.
+
+        Returns: A list of failed jobs, empty if everything is done.
+        """
+        progress = _Progress(list(jobs), self.keep_going, self.history)
+        with deduplicate_warnings():
+            if self.use_asyncio:
+                asyncio.run(self._run_asyncio(progress))
+            else:
+                self._run_threads(progress)
+        return progress.result()
+
+    def _traced(self, job: Job, slot: int) -> None:
+        """Run the action of job in the lane of slot."""
+        current_lane.set(slot + 1)
+        start = time.monotonic()
+        with tracer.span(job.name, job.name.split()[0], slot=slot):
+            with job_output(job.name):
+                worked = job.action()
+        if worked is not False:
+            self.history.record(job.key, time.monotonic() - start)
+
+    async def _traced_async(self, job: Job, slot: int) -> None:
+        """Await the async action of job in the lane of slot."""
+        assert job.async_action
+        current_lane.set(slot + 1)
+        start = time.monotonic()
+        with tracer.span(job.name, job.name.split()[0], slot=slot):
+            with job_output(job.name):
+                worked = await job.async_action()
+        if worked is not False:
+            self.history.record(job.key, time.monotonic() - start)
+
+    def _run_threads(self, progress: _Progress) -> None:
+        running: Dict[Future, Tuple[Job, int]] = {}
+
+        def admit(job: Job) -> bool:
+            return self._fits(job, [x for (x, _) in running.values()])
+
+        slots = list(range(self.jobs))  # A heap of free slots
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                while slots and not self._loaded(len(running)):
+                    job = progress.next(admit)
+                    if job is None:
+                        break
+                    slot = heapq.heappop(slots)
+                    future = executor.submit(self._traced, job, slot)
+                    running[future] = (job, slot)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, slot = running.pop(future)
+                    heapq.heappush(slots, slot)
+                    progress.finish(job, future.exception())
+
+    async def _run_asyncio(self, progress: _Progress) -> None:
+        loop = asyncio.get_running_loop()
+        running: Dict[asyncio.Future, Tuple[Job, int]] = {}
+
+        def admit(job: Job) -> bool:
+            return self._fits(job, [x for (x, _) in running.values()])
+
+        slots = list(range(self.jobs))  # A heap of free slots
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                while slots and not self._loaded(len(running)):
+                    job = progress.next(admit)
+                    if job is None:
+                        break
+                    slot = heapq.heappop(slots)
+                    future: asyncio.Future
+                    if job.async_action:
+                        future = asyncio.ensure_future(
+                            self._traced_async(job, slot)
+                        )
+                    else:
+                        future = loop.run_in_executor(
+                            executor, self._traced, job, slot
+                        )
+                    running[future] = (job, slot)
+                if not running:
+                    break
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    job, slot = running.pop(future)
+                    heapq.heappush(slots, slot)
+                    progress.finish(job, future.exception())
@@ -0,0 +1,258 @@
+"""Discovery of source files with globs and a directory index."""
+
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import (
+    Callable,
+    Container,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+)
+from .logging import logger
+from .utils import Pathlike, ensure_path
+
+# Bump this when the format of the index file changes.
+INDEX_VERSION = 1
+
+# Directories modified this recently, in nanoseconds, are not indexed, since
+# another change within the resolution of their mtime would go unnoticed.
+RACY_NS = 2 * 10 ** 9
+
+# Maximum number of threads scanning directories
+MAX_SCAN_JOBS = 8
+
+# Characters making a path a glob pattern
+GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+def glob_regex(pattern: str) -> Pattern:
+    """
+    Translate a glob pattern of a relative posix path to a regex.
+
+    "*" and "?" don't match "/", "**" matches any number of directories and
+    "[...]" is a character class, negated by a leading "!".
+    """
+    parts: List[str] = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1:end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            parts.append("[{}]".format(chars))
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile("".join(parts) + r"\Z")
+
+
+class SourceFinder:
+    """
+    Find source files of targets, optionally with a persistent index.
+
+    Directory trees are scanned with os.scandir by a thread pool, one
+    directory per task. The index records the entries of every directory
+    with its mtime, so a directory not changed since the last build costs a
+    single stat instead of a listing and a stat per file. Only the entries
+    of a directory change its mtime, so subdirectories are still checked.
+    """
+
+    def __init__(
+        self, path: Optional[Pathlike] = None, jobs: Optional[int] = None
+    ):
+        """
+        Load the index from path.
+
+        Args:
+            path: The index file, nothing is persisted if None. A missing or
+                broken file is treated as an empty index.
+            jobs: Number of threads scanning directories.
+        """
+        self.path = pathlib.Path(path) if path else None
+        self.jobs = jobs or min(MAX_SCAN_JOBS, os.cpu_count() or 1)
+        # directory -> (mtime_ns, files, subdirectories)
+        self.index: Dict[str, Tuple[int, List[str], List[str]]] = {}
+        self._lock = threading.Lock()
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data["version"] == INDEX_VERSION:
+                self.index = {
+                    k: (int(v[0]), list(v[1]), list(v[2]))
+                    for (k, v) in data["directories"].items()
+                }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.debug("Ignored broken {}: {}".format(self.path, e))
+
+    def save(self) -> None:
+        """Write the index to its file."""
+        if self.path is None:
+            return
+        with self._lock:
+            data = {"version": INDEX_VERSION, "directories": self.index}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def scan(self, directory: str) -> Tuple[List[str], List[str]]:
+        """List names of files and subdirectories in directory."""
+        st = os.stat(directory)
+        with self._lock:
+            record = self.index.get(directory)
+        if record and record[0] == st.st_mtime_ns:
+            return (record[1], record[2])
+        files: List[str] = []
+        subdirs: List[str] = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                # Symbolic links to directories are not followed, like rglob.
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+        with self._lock:
+            if time.time_ns() - st.st_mtime_ns > RACY_NS:
+                self.index[directory] = (st.st_mtime_ns, files, subdirs)
+            else:
+                self.index.pop(directory, None)
+        return (files, subdirs)
+
+    def walk(
+        self,
+        top: pathlib.Path,
+        prune: Optional[Callable[[str], bool]] = None,
+    ) -> List[str]:
+        """
+        List all the files under top in parallel.
+
+        Args:
+            top: The directory to walk.
+            prune: A function checking if a directory shouldn't be walked
+                into, given its posix path relative to top.
+
+        Returns: Posix paths of the files relative to top.
+        """
+        result: List[str] = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            running: Dict[Future, str] = {
+                executor.submit(self.scan, str(top)): ""
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rel = running.pop(future)
+                    files, subdirs = future.result()
+                    prefix = rel + "/" if rel else ""
+                    result.extend(prefix + x for x in files)
+                    for name in subdirs:
+                        sub = prefix + name
+                        if prune and prune(sub):
+                            continue
+                        path = os.path.join(str(top), sub)
+                        running[executor.submit(self.scan, path)] = sub
+        return result
+
+    def find(
+        self,
+        directory: pathlib.Path,
+        paths: List[str],
+        suffixes: Container[str],
+        exclude: Sequence[str] = (),
+    ) -> List[pathlib.Path]:
+        """
+        Find source files from paths relative to directory.
+
+        Args:
+            directory: The directory paths and exclude are relative to.
+            paths: Files, directories searched recursively, or glob patterns
+                like "src/**/*.c".
+            suffixes: Suffixes of source files found in directories or by
+                patterns. Files listed explicitly are always sources.
+            exclude: Glob patterns of files and directories to leave out.
+
+        Returns: Absolute paths of the sources, sorted by each of paths.
+            Raise a RuntimeError if a file or directory doesn't exist.
+        """
+        directory = directory.absolute()
+        excluded = [glob_regex(x.strip("/")) for x in exclude]
+
+        def is_excluded(rel: str) -> bool:
+            parts = rel.split("/")
+            return any(
+                x.match("/".join(parts[:i]))
+                for x in excluded
+                for i in range(1, len(parts) + 1)
+            )
+
+        sources: List[pathlib.Path] = []
+        for p in paths:
+            pattern = None
+            if GLOB_MAGIC.search(p):
+                pattern = glob_regex(pathlib.PurePath(p).as_posix())
+                parts = pathlib.PurePath(p).parts
+                base = directory.joinpath(
+                    *next(
+                        parts[:i]
+                        for i in range(len(parts))
+                        if GLOB_MAGIC.search(parts[i])
+                    )
+                )
+                if not base.is_dir():
+                    continue
+            else:
+                base = (directory / p).absolute()
+                if not base.is_dir():
+                    path = ensure_path(base)
+                    rel = os.path.relpath(path, directory)
+                    if not is_excluded(pathlib.PurePath(rel).as_posix()):
+                        sources.append(path)
+                    continue
+            prefix = os.path.relpath(base, directory).replace(os.sep, "/")
+            prefix = "" if prefix == "." else prefix + "/"
+            found = []
+            for name in self.walk(base, lambda x: is_excluded(prefix + x)):
+                rel = prefix + name
+                if os.path.splitext(name)[1] not in suffixes:
+                    continue
+                if pattern and not pattern.match(rel):
+                    continue
+                if is_excluded(rel):
+                    continue
+                found.append(directory / rel)
+            sources.extend(sorted(found))
+        # The same source may be found by more than one of paths.
+        return list(dict.fromkeys(sources))
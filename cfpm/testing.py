@@ -0,0 +1,264 @@
+"""Running the test targets of a package."""
+
+import os
+import pathlib
+import re
+import signal
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from .logging import logger
+from .scheduler import DurationHistory
+from .utils import Pathlike
+
+# Seconds a test may run if neither the target nor the command sets it
+DEFAULT_TEST_TIMEOUT = 300.0
+
+# Outcomes of tests
+PASSED = "passed"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+# Tests are run in sessions of their own, so their children are killed
+# with them on timeout.
+KILL_GROUP = hasattr(os, "killpg")
+
+# Characters not allowed in XML 1.0
+_invalid_xml = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+class TestCase(NamedTuple):
+    """A test executable to run."""
+
+    name: str
+    program: pathlib.Path
+    args: List[str]
+    cwd: pathlib.Path
+    timeout: float
+
+
+class TestResult(NamedTuple):
+    """The outcome of a run of a test."""
+
+    name: str
+    # One of PASSED, FAILED and TIMEOUT
+    outcome: str
+    seconds: float
+    # Stdout and stderr of the test, interleaved
+    output: str
+    returncode: Optional[int] = None
+
+    @property
+    def failed(self) -> bool:
+        """Check if the test didn't pass."""
+        return self.outcome != PASSED
+
+
+class TestHistory(DurationHistory):
+    """
+    Durations of tests in past runs, and which of them failed last time.
+
+    Tests failed last time run first, since they are the most likely to fail
+    again, and the rest run longest first, so a long test started last
+    doesn't leave the other cores idle at the end.
+    """
+
+    def __init__(self, path: Optional[Pathlike] = None):  # noqa: D107
+        self.failures: Dict[str, int] = {}
+        super().__init__(path)
+
+    def _load(self, data) -> None:
+        super()._load(data.get("durations", {}))
+        self.failures = {
+            str(k): int(v) for (k, v) in data.get("failures", {}).items()
+        }
+
+    def _dump(self):
+        return {"durations": self.durations, "failures": self.failures}
+
+    def record_result(self, result: TestResult) -> None:
+        """Record the duration and the outcome of a test."""
+        self.record(result.name, result.seconds)
+        with self._lock:
+            if result.failed:
+                self.failures[result.name] = (
+                    self.failures.get(result.name, 0) + 1
+                )
+            else:
+                self.failures.pop(result.name, None)
+
+    def order(self, names: List[str]) -> List[str]:
+        """Sort names of tests in the order they should be started."""
+        return sorted(
+            names,
+            key=lambda x: (
+                -self.failures.get(x, 0),
+                -self.estimate(x),
+                x,
+            ),
+        )
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """
+    Parse a shard like 2/4, the second of four.
+
+    Returns: The index from 1 and the number of shards. Raise a ValueError
+        if text is malformed.
+    """
+    try:
+        index, count = (int(x) for x in text.split("/"))
+    except ValueError:
+        raise ValueError("Bad shard {}, should be like 1/4.".format(text))
+    if not 1 <= index <= count:
+        raise ValueError(
+            "Shard {} should be between 1 and {}.".format(index, count)
+        )
+    return (index, count)
+
+
+def shard(names: List[str], index: int, count: int) -> List[str]:
+    """
+    Select the tests of shard index of count.
+
+    Tests are dealt to shards by sorted names, so every machine selects the
+    same tests regardless of its own history.
+    """
+    return sorted(names)[index - 1::count]
+
+
+def run_test(case: TestCase) -> TestResult:
+    """Run a test and wait for it, killing it on timeout."""
+    start = time.monotonic()
+    try:
+        process = subprocess.Popen(
+            [str(case.program)] + case.args,
+            cwd=str(case.cwd),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=KILL_GROUP,
+        )
+    except OSError as e:
+        return TestResult(case.name, FAILED, 0.0, str(e))
+    outcome = PASSED
+    try:
+        output, _ = process.communicate(timeout=case.timeout)
+    except subprocess.TimeoutExpired:
+        outcome = TIMEOUT
+        if KILL_GROUP:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            process.kill()
+        output, _ = process.communicate()
+    seconds = time.monotonic() - start
+    if outcome == PASSED and process.returncode != 0:
+        outcome = FAILED
+    return TestResult(
+        case.name,
+        outcome,
+        seconds,
+        output.decode(errors="replace"),
+        process.returncode,
+    )
+
+
+def _describe(result: TestResult) -> str:
+    if result.outcome == TIMEOUT:
+        return "Timed out after {:.1f}s.".format(result.seconds)
+    if result.returncode is None:
+        return "Failed to start."
+    if result.returncode < 0:
+        return "Killed by signal {}.".format(-result.returncode)
+    return "Exited with {}.".format(result.returncode)
+
+
+def run_tests(
+    cases: List[TestCase],
+    jobs: Optional[int] = None,
+    history: Optional[TestHistory] = None,
+) -> List[TestResult]:
+    """
+    Run tests in parallel and log their results as they finish.
+
+    Args:
+        cases: The tests to run, started in the order of history.
+        jobs: Number of tests running in parallel, defaults to the number of
+            CPUs.
+        history: Past runs of the tests, this run is recorded into it.
+
+    Returns: Results of the tests, in the order of cases.
+    """
+    history = history or TestHistory()
+    by_name = {x.name: x for x in cases}
+    ordered = [by_name[x] for x in history.order(list(by_name))]
+    results: Dict[str, TestResult] = {}
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(run_test, x) for x in ordered]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result.name] = result
+            history.record_result(result)
+            if result.failed:
+                logger.error(
+                    "FAIL {} ({:.3f}s) {}".format(
+                        result.name, result.seconds, _describe(result)
+                    )
+                )
+                if result.output.strip():
+                    logger.error(result.output.rstrip())
+            else:
+                logger.info(
+                    "PASS {} ({:.3f}s)".format(result.name, result.seconds)
+                )
+    return [results[x.name] for x in cases]
+
+
+def write_junit(
+    path: Pathlike, suite: str, results: List[TestResult]
+) -> None:
+    """
+    Write results as a JUnit XML report, read by most CI systems.
+
+    The tests are testcases of one testsuite named suite. Failed tests have
+    a failure with the outcome as its type, and the output of every test is
+    in its system-out.
+    """
+    root = ET.Element("testsuites")
+    element = ET.SubElement(
+        root,
+        "testsuite",
+        name=suite,
+        tests=str(len(results)),
+        failures=str(sum(x.failed for x in results)),
+        errors="0",
+        skipped="0",
+        time="{:.3f}".format(sum(x.seconds for x in results)),
+    )
+    for result in results:
+        case = ET.SubElement(
+            element,
+            "testcase",
+            name=result.name,
+            classname=suite,
+            time="{:.3f}".format(result.seconds),
+        )
+        output = _invalid_xml.sub("\ufffd", result.output)
+        if result.failed:
+            ET.SubElement(
+                case,
+                "failure",
+                type=result.outcome,
+                message=_describe(result),
+            )
+        if output:
+            ET.SubElement(case, "system-out").text = output
+    path = pathlib.Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    ET.ElementTree(root).write(tmp, encoding="utf-8", xml_declaration=True)
+    os.replace(tmp, path)
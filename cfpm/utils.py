@@ -14,6 +14,9 @@ Pathlike = Union[str, pathlib.Path]
 # Check if name only contains A-Z, a-z, 0-9 and underscore
 vaild_name = re.compile(r"^[A-Za-z0-9_]+$")
 
+# Sizes like 512, 100K, 10M or 5G
+valid_size = re.compile(r"^([0-9]+)([KMG]?)$", re.IGNORECASE)
+
 
 def error_exit() -> NoReturn:
     """Exit with return code 1."""
@@ -49,6 +52,23 @@ def ensure_path(
     return path
 
 
+def parse_size(size: str) -> int:
+    """
+    Parse a human readable size into bytes.
+
+    Args:
+        size: A number optionally followed by K, M or G.
+
+    Returns:
+        The size in bytes. Raise a ValueError if size is malformed.
+    """
+    match = valid_size.match(size.strip())
+    if not match:
+        raise ValueError("Bad size {}.".format(size))
+    unit = "_KMG".index(match.group(2).upper() or "_")
+    return int(match.group(1)) * 1024 ** unit
+
+
 def error(e: Exception) -> NoReturn:
     """Report an error."""
     logger.error(e)
@@ -57,7 +77,7 @@ def error(e: Exception) -> NoReturn:
 
 def handle(
     func: Callable,
-    exception_type: Union[Type[Exception], Tuple[Type[Exception]]],
+    exception_type: Union[Type[Exception], Tuple[Type[Exception], ...]],
     *args,
     **kwargs
 ):
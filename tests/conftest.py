@@ -0,0 +1,14 @@
+import pytest
+from cfpm import console
+from click.testing import CliRunner
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    """Create a new package named demo and change into it."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CFPM_HOME", str(tmp_path / "home"))
+    result = CliRunner().invoke(console.cli, ["new", "demo"])
+    assert result.exit_code == 0
+    monkeypatch.chdir(tmp_path / "demo")
+    return tmp_path / "demo"
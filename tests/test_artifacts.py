@@ -0,0 +1,102 @@
+import http.server
+import io
+import os
+import tarfile
+import threading
+import pytest
+from cfpm.artifacts import ARCHIVE_SUFFIX, ArtifactCache, artifact_key
+
+
+@pytest.fixture
+def http_remote():
+    """An HTTP server storing PUT bodies in memory."""
+    files = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in files:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(files[self.path])))
+            self.end_headers()
+            self.wfile.write(files[self.path])
+
+        def do_PUT(self):
+            length = int(self.headers["Content-Length"])
+            files[self.path] = self.rfile.read(length)
+            self.send_response(201)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}/artifacts".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_artifact_cache(tmp_path, http_remote):
+    key = artifact_key("base", "1.0.0")
+    assert key != artifact_key("base", "1.0.1")
+    built = tmp_path / "built"
+    (built / "lib").mkdir(parents=True)
+    (built / "lib" / "libbase.a").write_bytes(b"!<arch>\n")
+    first = ArtifactCache(tmp_path / "first", http_remote)
+    assert not first.fetch(key, built, ["lib/libbase.a"])
+    first.store(key, built, ["lib/libbase.a"])
+
+    # Another machine gets it from the remote.
+    second = ArtifactCache(tmp_path / "second", http_remote)
+    dest = tmp_path / "dest"
+    assert second.fetch(key, dest, ["lib/libbase.a"])
+    assert (dest / "lib" / "libbase.a").read_bytes() == b"!<arch>\n"
+    assert (dest / "lib" / "libbase.a").stat().st_nlink == 2
+    assert not second.fetch(key, dest, ["lib/other.a"])
+    assert not second.fetch(artifact_key("other"), dest, [])
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["lib/../../../../outside/escaped.txt", "/tmp/escaped.txt", "lib/.."],
+)
+def test_bad_archive(tmp_path, name):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    key = artifact_key("evil")
+    # Members named as is, tar.add would strip leading slashes.
+    member = tarfile.TarInfo(name)
+    member.size = 4
+    with tarfile.open(remote / (key + ARCHIVE_SUFFIX), "w:gz") as tar:
+        tar.addfile(member, io.BytesIO(b"evil"))
+    cache = ArtifactCache(tmp_path / "cache", str(remote))
+    assert not cache.fetch(key, tmp_path / "dest", ["escaped.txt"])
+    assert not (tmp_path / "outside").exists()
+    assert not (tmp_path.parent / "outside").exists()
+    assert not (tmp_path / "cache" / "unpacked" / key).exists()
+
+
+def test_evict(tmp_path):
+    built = tmp_path / "built"
+    built.mkdir()
+    (built / "libx.a").write_bytes(b"x" * 1000)
+    cache = ArtifactCache(tmp_path / "cache", max_size=10 ** 6)
+    keys = [artifact_key(str(i)) for i in range(3)]
+    for (i, key) in enumerate(keys):
+        cache.store(key, built, ["libx.a"])
+        assert cache.fetch(key, tmp_path / key, ["libx.a"])
+        os.utime(cache._archive(key), (i, i))
+    stats = cache.stats()
+    assert stats["entries"] == 3
+    # Now keys[0] is the most recently used.
+    assert cache.fetch(keys[0], tmp_path / "dest", ["libx.a"])
+    assert cache._archive(keys[0]).stat().st_mtime > 2
+    assert cache.evict(stats["size"] * 2 // 3) == 2
+    assert [x[2] for x in cache.entries()] == [keys[0]]
+    assert not (tmp_path / "cache" / "unpacked" / keys[1]).exists()
+    # Files linked into builds stay.
+    assert (tmp_path / keys[1] / "libx.a").read_bytes() == b"x" * 1000
+    cache.clean()
+    assert cache.stats()["entries"] == 0
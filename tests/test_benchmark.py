@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+from cfpm import console
+from cfpm.benchmark import SCENARIOS, compare, measure_build, measure_spawns
+from cfpm.exceptions import ExternalProgramError
+from click.testing import CliRunner
+
+needs_gcc = pytest.mark.skipif(
+    shutil.which("gcc") is None or sys.platform == "win32",
+    reason="needs gcc",
+)
+
+
+@needs_gcc
+def test_synthetic(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("CFPM_HOME", str(tmp_path / "home"))
+    runner = CliRunner()
+    result = runner.invoke(
+        console.cli,
+        ["new", "big", "--synthetic", "--targets", "3", "--sources", "5"],
+    )
+    assert result.exit_code == 0, result.output
+    package = tmp_path / "big"
+    assert len(list(package.glob("t*/s*.c"))) == 15
+    monkeypatch.chdir(package)
+    result = runner.invoke(console.cli, ["build", "--no-daemon"])
+    assert result.exit_code == 0, result.output
+    app = subprocess.run([str(package / "build" / "app")])
+    assert app.returncode == 0
+
+
+@needs_gcc
+def test_benchmark(tmp_path):
+    output = tmp_path / "results.json"
+    args = ["--targets", "1", "--sources", "2", "--repeat", "1"]
+    result = CliRunner().invoke(
+        console.cli, ["benchmark", "-o", str(output)] + args
+    )
+    assert result.exit_code == 0, result.output
+    results = json.loads(output.read_text())
+    assert set(results["results"]) == set(SCENARIOS)
+    assert all(x["max_rss_kib"] > 0 for x in results["results"].values())
+
+    # Compared with itself, nothing regresses.
+    result = CliRunner().invoke(
+        console.cli,
+        ["benchmark", "--baseline", str(output), "--tolerance", "100"] + args,
+    )
+    assert result.exit_code == 0, result.output
+
+
+def test_failed_build(package):
+    config = (package / "cfpm.toml").read_text()
+    (package / "cfpm.toml").write_text(
+        config.replace("[package]\n", '[package]\nlinker = "nope"\n')
+    )
+    with pytest.raises(ExternalProgramError, match=r"\(exit code 1\)"):
+        measure_build(package, [], dict(os.environ))
+
+
+def test_compare():
+    def results(seconds, max_rss):
+        result = {"median": seconds, "max_rss_kib": max_rss}
+        return {"version": 1, "results": {x: result for x in SCENARIOS}}
+
+    assert compare(results(1.05, 1000), results(1.0, 1000)) == []
+    regressions = compare(results(1.5, 1000), results(1.0, 1000))
+    assert len(regressions) == len(SCENARIOS)
+    assert "clean median 1.500s > baseline 1.000s" in regressions
+    assert compare(results(1.0, 2000), results(1.0, 1000), tolerance=1.5) == []
+    with pytest.raises(ValueError):
+        compare(results(1.0, 1000), {"version": 0})
+    with pytest.raises(ValueError):
+        compare(results(1.0, 1000), {"version": 1, "results": {"clean": {}}})
+
+
+@pytest.mark.skipif(shutil.which("true") is None, reason="needs true")
+def test_spawns():
+    rates = measure_spawns(5)
+    assert set(rates) == {"cfpm", "subprocess"}
+    assert all(x > 0 for x in rates.values())
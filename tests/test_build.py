@@ -0,0 +1,299 @@
+import io
+import json
+import logging
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+from cfpm import console, drivers
+from cfpm.logging import JSONFormatter, LogPipeline
+from click.testing import CliRunner
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("gcc") is None, reason="gcc is not found"
+)
+
+
+@pytest.mark.parametrize(
+    "args", [[], ["--asyncio"], ["--mem-limit", "16G", "--load-limit", "64"]]
+)
+def test_build(package, args):
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build", "-j", "2"] + args)
+    assert result.exit_code == 0, result.output
+    output = subprocess.run(
+        [str(package / "build" / "hello")], capture_output=True, text=True
+    )
+    assert output.stdout == "Hello there!"
+    resources = json.loads(
+        (package.parent / "home" / "resources.json").read_text()
+    )
+    assert resources[str(package / "build" / "hello")][0] > 0
+
+
+def test_build_failure(package):
+    runner = CliRunner()
+    (package / "src" / "bad.c").write_text("int x = ;\n")
+    result = runner.invoke(console.cli, ["build", "-j", "1"])
+    assert result.exit_code == 1
+    assert "Failed to compile" in result.output
+    assert not (package / "build" / "hello").exists()
+
+    result = runner.invoke(console.cli, ["build", "-j", "1", "--keep-going"])
+    assert result.exit_code == 1
+    assert (package / "build" / "obj" / "hello" / "main.cpp.o").exists()
+    assert not (package / "build" / "hello").exists()
+
+
+def test_build_failure_asyncio(package):
+    runner = CliRunner()
+    (package / "src" / "bad.c").write_text("int x = ;\n")
+    result = runner.invoke(
+        console.cli, ["build", "--asyncio", "--keep-going", "--no-cache"]
+    )
+    assert result.exit_code == 1
+    assert "error: expected expression" in result.output
+    assert "Failed to compile" in result.output
+    assert (package / "build" / "obj" / "hello" / "main.cpp.o").exists()
+
+
+def test_unity_build(package):
+    src = package / "src"
+    (src / "one.c").write_text("int one() { return 1; }\n")
+    (src / "two.c").write_text('#include "hello.h"\nint two() { return 2; }\n')
+    (src / "static.c").write_text("static int x;\n")
+    (src / "static2.c").write_text("static int x;\n")
+    with open(src / "hello.toml", "a") as f:
+        f.write("unity = true\nunity_batch = 2\n")
+        f.write('unity_exclude = ["static2.c"]\n')
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    assert result.output.count("Compiling") == 4
+    assert "unity_c_0.c" in result.output
+    assert "unity_c_1.c" in result.output
+    assert "unity_cpp_0.cpp" in result.output
+    assert "static2.c" in result.output
+    output = subprocess.run(
+        [str(package / "build" / "hello")], capture_output=True, text=True
+    )
+    assert output.stdout == "Hello there!"
+
+
+def test_pch(package):
+    with open(package / "src" / "hello.toml", "a") as f:
+        f.write('pch = { "c++" = "hello.h" }\n')
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    assert "Precompiling" in result.output
+    pch = package / "build" / "obj" / "hello" / "pch" / "cpp"
+    assert (pch / "hello.h.gch").exists()
+
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert "Compiling" not in result.output
+
+    # Changes of the header invalidate the precompiled header.
+    header = package / "src" / "hello.h"
+    header.write_text(header.read_text() + "\n")
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    assert "Precompiling" in result.output
+    assert result.output.count("Compiling") == 2
+
+
+@pytest.mark.parametrize("thin", [False, True])
+def test_static_library(package, thin):
+    (package / "lib").mkdir()
+    (package / "lib" / "util.c").write_text("int util() { return 1; }\n")
+    (package / "lib" / "util.toml").write_text(
+        '[target]\ntype = "lib"\nsources = ["."]\nthin = {}\n'.format(
+            "true" if thin else "false"
+        )
+    )
+    with open(package / "cfpm.toml", "a") as f:
+        f.write('\n[[targets]]\ndir = "lib"\nname = "util"\n')
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    archive = package / "build" / "libutil.a"
+    assert archive.read_bytes().startswith(b"!<thin>" if thin else b"!<arch>")
+    members = subprocess.run(
+        ["ar", "t", str(archive)], capture_output=True, text=True
+    ).stdout
+    assert "util.c.o" in members
+
+
+def test_target_dependencies(package):
+    (package / "util").mkdir()
+    (package / "util" / "util.h").write_text("int util(void);\n")
+    (package / "util" / "util.c").write_text("int util(void) { return 7; }\n")
+    (package / "util" / "util.toml").write_text(
+        '[target]\ntype = "lib"\nsources = ["util.c"]\nheaders = ["."]\n'
+    )
+    (package / "src" / "main.cpp").write_text(
+        'extern "C" {\n#include "util.h"\n}\n'
+        "int main() { return util(); }\n"
+    )
+    with open(package / "cfpm.toml", "a") as f:
+        f.write('\n[[targets]]\ndir = "util"\nname = "util"\n')
+    with open(package / "src" / "hello.toml", "a") as f:
+        f.write('deps = ["util"]\n')
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    assert result.output.index("libutil.a") < result.output.index(
+        "Linking {}".format(package / "build" / "hello")
+    )
+    assert subprocess.run([str(package / "build" / "hello")]).returncode == 7
+
+    (package / "util" / "util.toml").write_text(
+        '[target]\ntype = "lib"\nsources = ["util.c"]\ndeps = ["hello"]\n'
+    )
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code != 0
+    assert "cycle" in result.output
+
+
+def test_relink_skipped(package):
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.output.count("Linking") == 1
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert result.exit_code == 0, result.output
+    assert "Linking" not in result.output
+
+    (package / "build" / "hello").unlink()
+    result = runner.invoke(console.cli, ["build", "--no-cache"])
+    assert "Compiling" not in result.output
+    assert result.output.count("Linking") == 1
+
+
+@pytest.mark.skipif(shutil.which("ld.gold") is None, reason="needs gold")
+def test_linker(package):
+    with open(package / "cfpm.toml", "r+") as f:
+        content = f.read().replace(
+            "[package]\n",
+            '[package]\nlinker = "gold"\nlink_threads = 2\n'
+            "gdb_index = true\nsplit_dwarf = true\n",
+        )
+        f.seek(0)
+        f.write(content)
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["-v", "DEBUG", "build"])
+    assert result.exit_code == 0, result.output
+    assert "-fuse-ld=gold" in result.output
+    assert (package / "build" / "obj" / "hello" / "main.cpp.dwo").exists()
+    sections = subprocess.run(
+        ["readelf", "-S", str(package / "build" / "hello")],
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert ".gdb_index" in sections
+
+
+def test_compdb(package):
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["compdb"])
+    assert result.exit_code == 0, result.output
+    path = package / "build" / "compile_commands.json"
+    entries = json.loads(path.read_text())
+    assert sorted(Path(x["file"]).name for x in entries) == [
+        "hello.c",
+        "main.cpp",
+    ]
+    assert all("-c" in x["arguments"] for x in entries)
+    assert not (package / "build" / "hello").exists()
+
+    mtime = path.stat().st_mtime_ns
+    result = runner.invoke(console.cli, ["compdb"])
+    assert path.stat().st_mtime_ns == mtime
+
+    (package / "src" / "extra.c").write_text("int extra() { return 0; }\n")
+    result = runner.invoke(console.cli, ["build", "--compdb", "--no-daemon"])
+    assert result.exit_code == 0, result.output
+    entries = json.loads(path.read_text())
+    assert len(entries) == 3
+    assert (package / "build" / "hello").exists()
+
+
+@pytest.mark.parametrize("args", [[], ["--asyncio"]])
+def test_duplicate_warnings(package, args):
+    (package / "src" / "warn.h").write_text(
+        "static inline int warn(void) { int unused; return 0; }\n"
+    )
+    for name in ("a.c", "b.c", "c.c"):
+        (package / "src" / name).write_text('#include "warn.h"\n')
+    result = CliRunner().invoke(
+        console.cli, ["build", "--no-daemon", "--no-cache", "-j", "3"] + args
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.count("unused variable") == 1
+    assert "Suppressed 2 duplicate warning(s)." in result.output
+
+
+def test_json_logs(package):
+    with open(package / "src" / "hello.c", "a") as f:
+        f.write("int no_return(void) {}\n")
+    result = CliRunner().invoke(
+        console.cli, ["--log-format", "json", "build", "--no-daemon"]
+    )
+    entries = [json.loads(x) for x in result.output.splitlines()]
+    warnings = [x for x in entries if x["level"] == "warning"]
+    assert len(warnings) == 1
+    assert warnings[0]["job"] == "compile hello.c"
+    assert "-Wreturn-type" in warnings[0]["message"]
+    assert entries[-1]["message"] == "Built 1 target(s)."
+
+    # Exceptions keep their own key through the log pipeline.
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JSONFormatter())
+    json_logger = logging.getLogger("cfpm.test_json_logs")
+    json_logger.propagate = False
+    json_logger.handlers = [handler]
+    pipeline = LogPipeline(json_logger)
+    pipeline.start()
+    try:
+        raise ValueError("broken")
+    except ValueError:
+        json_logger.exception("Failed %s.", "here")
+    pipeline.stop()
+    entry = json.loads(stream.getvalue())
+    assert entry["message"] == "Failed here."
+    assert "ValueError: broken" in entry["exception"]
+
+
+def test_response_files(package, monkeypatch):
+    monkeypatch.setattr(drivers, "RESPONSE_FILE_THRESHOLD", 0)
+    result = CliRunner().invoke(console.cli, ["build", "--no-daemon"])
+    assert result.exit_code == 0, result.output
+    assert list((package / "build" / "rsp").glob("*.rsp"))
+    hello = subprocess.run([str(package / "build" / "hello")])
+    assert hello.returncode == 0
+
+
+@pytest.mark.parametrize("mode", ["thin", "full"])
+def test_lto(package, mode):
+    config = (package / "cfpm.toml").read_text()
+    (package / "cfpm.toml").write_text(
+        config.replace("[package]\n", '[package]\nlto = "{}"\n'.format(mode))
+    )
+    result = CliRunner().invoke(console.cli, ["build", "--no-daemon"])
+    assert result.exit_code == 0, result.output
+    # GCC intermediate code, or LLVM bitcode of Clang
+    for obj in (package / "build" / "obj" / "hello").glob("*.o"):
+        content = obj.read_bytes()
+        assert b".gnu.lto_" in content or content.startswith(b"BC\xc0\xde")
+    hello = subprocess.run([str(package / "build" / "hello")])
+    assert hello.returncode == 0
+
+
+def test_bad_lto(package):
+    config = (package / "cfpm.toml").read_text()
+    (package / "cfpm.toml").write_text(
+        config.replace("[package]\n", '[package]\nlto = "fat"\n')
+    )
+    result = CliRunner().invoke(console.cli, ["build", "--no-daemon"])
+    assert result.exit_code != 0
+    assert "lto should be one of" in result.output
@@ -0,0 +1,57 @@
+import os
+import shutil
+import pytest
+from cfpm import console
+from cfpm.cache import ObjectCache
+from click.testing import CliRunner
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="gcc is not found")
+def test_cached_build(package):
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["build"])
+    assert result.exit_code == 0, result.output
+    assert "(cached)" not in result.output
+    shutil.rmtree(package / "build")
+
+    result = runner.invoke(console.cli, ["build"])
+    assert result.exit_code == 0, result.output
+    assert result.output.count("(cached)") == 2
+    assert (package / "build" / "hello").exists()
+
+    result = runner.invoke(console.cli, ["cache", "stats"])
+    assert "Objects          2" in result.output
+    assert "Hits             2 / 4" in result.output
+
+    result = runner.invoke(console.cli, ["cache", "clean"])
+    assert result.exit_code == 0
+    result = runner.invoke(console.cli, ["cache", "stats"])
+    assert "Objects          0" in result.output
+    assert "Prebuilt         0" in result.output
+
+
+def test_headers(tmp_path):
+    cache = ObjectCache(tmp_path / "cache")
+    obj = tmp_path / "a.o"
+    obj.write_bytes(b"x")
+    cache.store("aa1", obj, ["a.c", "a.h"], "d1")
+    assert cache.fetch("aa1", obj, lambda x: "d1") == ["a.c", "a.h"]
+    assert cache.fetch("aa1", obj, lambda x: "d2") is None
+    assert cache.fetch("aa1", obj, lambda x: None) is None
+    assert cache.fetch("bb2", obj, lambda x: "d1") is None
+
+
+def test_evict(tmp_path):
+    cache = ObjectCache(tmp_path / "cache", max_size=250)
+    obj = tmp_path / "a.o"
+    for (i, key) in enumerate(["aa1", "bb2", "cc3"]):
+        obj.write_bytes(b"x" * 100)
+        cache.store(key, obj, [], "")
+        os.utime(cache._path(cache._combine(key, "")), (i, i))
+        os.utime(cache._path(key, ".json"), (i, i))
+    # Now aa1 is the most recently used.
+    assert cache.fetch("aa1", obj, lambda x: "") == []
+    assert cache.evict() == 2
+    assert cache.fetch("bb2", obj, lambda x: "") is None
+    assert cache.fetch("aa1", obj, lambda x: "") == []
+    assert cache.fetch("cc3", obj, lambda x: "") == []
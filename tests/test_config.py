@@ -0,0 +1,35 @@
+import os
+import pytest
+from cfpm import config as config_module
+from cfpm.config import ConfigCache, load_config
+
+
+def test_config_cache(package, tmp_path, monkeypatch):
+    cache = ConfigCache(tmp_path / "configs")
+    config = load_config(package, cache)
+    assert config["targets"][0]["target"]["type"] == "bin"
+
+    def fail(path):
+        pytest.fail("parsed {}".format(path))
+
+    monkeypatch.setattr(config_module, "parse_toml", fail)
+    assert load_config(package, ConfigCache(tmp_path / "configs")) == config
+
+    # Touched only, still cached
+    toml = package / "src" / "hello.toml"
+    os.utime(toml, ns=(0, 0))
+    assert cache.load(package) == config
+
+    toml.write_text(toml.read_text().replace('"bin"', '"shared"'))
+    assert cache.load(package) is None
+    monkeypatch.undo()
+    config = load_config(package, cache)
+    assert config["targets"][0]["target"]["type"] == "shared"
+
+
+def test_config_cache_broken(package, tmp_path):
+    cache = ConfigCache(tmp_path / "configs")
+    load_config(package, cache)
+    for path in (tmp_path / "configs").iterdir():
+        path.write_bytes(b"broken")
+    assert cache.load(package) is None
@@ -0,0 +1,126 @@
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from cfpm import console
+from cfpm.daemon import Daemon, PollingWatcher, create_watcher
+from click.testing import CliRunner
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32" or shutil.which("gcc") is None,
+    reason="needs Unix sockets and gcc",
+)
+
+
+def run_hello(package):
+    try:
+        return subprocess.run(
+            [str(package / "build" / "hello")], capture_output=True, text=True
+        ).stdout
+    except OSError:  # Being linked
+        return None
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.parametrize("polling", [True, False])
+def test_watcher(tmp_path, polling):
+    (tmp_path / "build").mkdir()
+    watcher = create_watcher(
+        tmp_path, lambda x: x.endswith("build"), polling
+    )
+    assert isinstance(watcher, PollingWatcher) == (
+        polling or not sys.platform.startswith("linux")
+    )
+    try:
+        assert watcher.wait(0.1) == []
+        (tmp_path / "build" / "ignored.c").write_text("")
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "a.c").write_text("")
+        changed = watcher.wait(2.0) + watcher.wait(0.6)
+        assert str(tmp_path / "sub" / "a.c") in changed
+        assert str(tmp_path / "build" / "ignored.c") not in changed
+    finally:
+        watcher.close()
+
+
+def test_daemon(package, tmp_path):
+    daemon = Daemon(package, tmp_path / "home")
+    server = daemon.server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        runner = CliRunner()
+        result = runner.invoke(console.cli, ["build"])
+        assert result.exit_code == 0, result.output
+        assert "Compiling" in result.output
+        assert run_hello(package) == "Hello there!"
+
+        # Added sources are found again by the daemon.
+        (package / "src" / "hello.c").unlink()
+        (package / "src" / "hello2.c").write_text(
+            '#include <hello.h>\nvoid hello() { printf("Hi!"); }\n'
+        )
+        result = runner.invoke(console.cli, ["build"])
+        assert result.exit_code == 0, result.output
+        assert run_hello(package) == "Hi!"
+
+        (package / "src" / "hello2.c").write_text("int x = ;\n")
+        result = runner.invoke(console.cli, ["build"])
+        assert result.exit_code == 1
+        assert "Failed to compile" in result.output
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_watch(package, tmp_path):
+    daemon = Daemon(package, tmp_path / "home")
+    assert daemon.build()
+    stop = threading.Event()
+    thread = threading.Thread(target=daemon.watch, args=(stop,))
+    thread.start()
+    try:
+        time.sleep(0.2)
+        (package / "src" / "hello.c").write_text(
+            '#include <hello.h>\nvoid hello() { printf("Watched!"); }\n'
+        )
+        assert wait_for(lambda: run_hello(package) == "Watched!")
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_build_watch(package, monkeypatch):
+    runner = CliRunner()
+    for option in [
+        ["--asyncio"],
+        ["--trace", "trace.json"],
+        ["--timings", "3"],
+        ["--mem-limit", "1G"],
+        ["--load-limit", "4"],
+    ]:
+        result = runner.invoke(console.cli, ["build", "--watch"] + option)
+        assert result.exit_code == 2
+        assert "{} can't be used with --watch.".format(option[0]) in (
+            result.output
+        )
+
+    # Stop watching right after the first build.
+    def interrupt(self, *args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(Daemon, "watch", interrupt)
+    result = runner.invoke(console.cli, ["build", "--watch", "--compdb"])
+    assert result.exit_code == 0, result.output
+    assert "Stopped." in result.output
+    assert (package / "build" / "compile_commands.json").exists()
+    assert run_hello(package) == "Hello there!"
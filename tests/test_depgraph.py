@@ -0,0 +1,43 @@
+import os
+import shutil
+import pytest
+from cfpm import console
+from cfpm.depgraph import parse_depfile
+from click.testing import CliRunner
+
+
+def test_parse_depfile(tmp_path):
+    dep = tmp_path / "a.d"
+    dep.write_text(
+        "build/a.o: src/a.c include/a\\ b.h \\\n  include/$$c.h\n"
+        "include/a\\ b.h:\n"
+    )
+    assert parse_depfile(dep) == ["src/a.c", "include/a b.h", "include/$c.h"]
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="gcc is not found")
+def test_incremental_build(package):
+    runner = CliRunner()
+    args = ["build", "--no-cache"]
+    result = runner.invoke(console.cli, args)
+    assert result.output.count("Compiling") == 2
+
+    result = runner.invoke(console.cli, args)
+    assert result.exit_code == 0, result.output
+    assert "Compiling" not in result.output
+
+    # Touching without changes doesn't rebuild anything.
+    header = package / "src" / "hello.h"
+    os.utime(header)
+    result = runner.invoke(console.cli, args)
+    assert "Compiling" not in result.output
+
+    header.write_text(header.read_text() + "\n")
+    result = runner.invoke(console.cli, args)
+    assert result.output.count("Compiling") == 2
+
+    (package / "src" / "main.cpp").write_text(
+        '#include "hello.h"\nint main() { hello(); }\n'
+    )
+    result = runner.invoke(console.cli, args)
+    assert result.output.count("Compiling") == 1
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import sys
+import pytest
+from cfpm.drivers import (
+    GCC,
+    MEASURED,
+    RESPONSE_FILE_THRESHOLD,
+    CLIDriver,
+    ProbeCache,
+    adapt_compiler,
+    probe_linker,
+    select_linker,
+)
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="needs a shell script as the compiler"
+)
+
+
+@pytest.fixture
+def fake_gcc(tmp_path, monkeypatch):
+    """A fake gcc in PATH counting how many times it's probed."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "fake-gcc"
+    script.write_text(
+        "#!/bin/sh\necho probed >> {}\necho 'fake-gcc (GCC) 1.0 gcc'\n".format(
+            tmp_path / "count"
+        )
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir))
+    return script
+
+
+def probes_count(fake_gcc):
+    count = fake_gcc.parent.parent / "count"
+    return len(count.read_text().splitlines()) if count.exists() else 0
+
+
+def test_probe_cache(tmp_path, fake_gcc):
+    path = tmp_path / "probes.json"
+    probes = ProbeCache(path)
+    driver = adapt_compiler("fake-gcc", probes)
+    assert isinstance(driver, GCC)
+    assert driver.program.program == str(fake_gcc)
+    probes.save()
+    assert probes_count(fake_gcc) == 1
+
+    driver = adapt_compiler("fake-gcc", ProbeCache(path))
+    assert isinstance(driver, GCC)
+    assert driver.version == "fake-gcc (GCC) 1.0 gcc"
+    assert probes_count(fake_gcc) == 1
+
+    # Changing the compiler invalidates the probe.
+    fake_gcc.write_text(fake_gcc.read_text() + "\n")
+    os.utime(fake_gcc, ns=(0, 0))
+    driver = adapt_compiler("fake-gcc", ProbeCache(path))
+    assert probes_count(fake_gcc) == 2
+
+
+def test_select_linker(fake_gcc):
+    (fake_gcc.parent / "ld.gold").write_text("")
+    probes = ProbeCache()
+    driver = adapt_compiler("fake-gcc", probes)
+    assert probes_count(fake_gcc) == 1
+    assert select_linker(driver, "auto", probes) == "gold"
+    assert probes_count(fake_gcc) == 2
+    assert probe_linker(driver, "gold", probes) == "fake-gcc (GCC) 1.0 gcc"
+    assert probe_linker(driver, "mold", probes) is None
+    assert probes_count(fake_gcc) == 2
+    assert select_linker(driver, "default", probes) is None
+    with pytest.raises(RuntimeError):
+        select_linker(driver, "lld", probes)
+
+    driver.use_linker("gold")
+    driver.set_link_threads(4)
+    assert driver.codegen_args() == []
+    driver.set_gdb_index()
+    # Compiles with it are kept off remote workers.
+    assert driver.codegen_args() == ["-ggnu-pubnames"]
+    args = driver.link_executable_args(["a.o"], "a")
+    assert args[:3] == [
+        "-fuse-ld=gold",
+        "-Wl,--threads,--thread-count=4",
+        "-Wl,--gdb-index",
+    ]
+    driver.set_split_dwarf()
+    assert "-gsplit-dwarf" in driver.compile_args("a.c", "a.o")
+
+
+def test_not_found(tmp_path, fake_gcc):
+    with pytest.raises(RuntimeError):
+        adapt_compiler("not-a-compiler", ProbeCache())
+
+
+def test_run_async():
+    lines = []
+    driver = CLIDriver("/bin/sh")
+    result = asyncio.run(
+        driver.run_async(["-c", "echo a; echo b >&2; exit 3"], lines.append)
+    )
+    assert result.returncode == 3
+    assert sorted(lines) == ["a", "b"]
+
+
+@pytest.mark.skipif(not MEASURED, reason="needs wait4")
+def test_resource_usage():
+    driver = CLIDriver(sys.executable)
+    code = "x = bytearray(64 << 20); print(len(x))"
+    result = driver.run(["-c", code], text=True, capture_output=True)
+    assert result.stdout == "{}\n".format(64 << 20)
+    assert result.usage.max_rss > 64 << 20
+    assert result.usage.cpu_seconds > 0
+
+    result = asyncio.run(
+        CLIDriver("/bin/sh").run_async(["-c", "echo a; kill -9 $$"], print)
+    )
+    assert result.returncode == -9
+    assert result.usage.max_rss > 0
+
+
+def test_response_file(tmp_path, fake_gcc):
+    driver = adapt_compiler("fake-gcc", ProbeCache())
+    driver.use_response_files(tmp_path / "rsp")
+    driver.add_definition("QUOTED", '"a b\\c"')
+    for _ in range(RESPONSE_FILE_THRESHOLD // len(str(tmp_path))):
+        driver.add_include_directory(tmp_path)
+    args = driver.compile_args("a.c", "a.o")
+    assert args[0].startswith("@") and args[1:] == ["-o", "a.o", "-c", "a.c"]
+    content = open(args[0][1:]).read().splitlines()
+    assert content[:2] == ['"-fPIC"', '"-Wall"']
+    assert '"-DQUOTED=\\"a b\\\\c\\""' in content
+    # Drivers with the same arguments share the file.
+    assert driver.pch_args("a.h", "a.h.gch", "c")[0] == args[0]
+
+    driver.set_standard("c11")
+    assert driver.compile_args("a.c", "a.o")[0] != args[0]
+    assert len(list((tmp_path / "rsp").iterdir())) == 2
+
+
+def test_link_shared_args(fake_gcc):
+    driver = adapt_compiler("fake-gcc", ProbeCache())
+    args = driver.link_shared_args(["a.o"], "liba.so")
+    assert args == ["-shared", "-pthread", "-o", "liba.so", "a.o"]
+
+
+def test_lto(tmp_path, fake_gcc):
+    driver = adapt_compiler("fake-gcc", ProbeCache())
+    with pytest.raises(ValueError):
+        driver.set_lto("fat")
+    driver.set_lto("thin", 4, tmp_path / "lto")
+    assert "-flto" in driver.compile_args("a.c", "a.o")
+    args = driver.link_executable_args(["a.o"], "a")
+    assert "-flto=4" in args
+
+    # Clang runs ThinLTO in the linker, with a cache of the modules.
+    driver.version = "clang version 15.0.0"
+    driver.use_linker("lld")
+    driver.set_lto("thin", 4, tmp_path / "lto")
+    assert "-flto=thin" in driver.compile_args("a.c", "a.o")
+    args = driver.link_executable_args(["a.o"], "a")
+    assert args[:4] == [
+        "-fuse-ld=lld",
+        "-flto=thin",
+        "-Wl,--thinlto-jobs=4",
+        "-Wl,--thinlto-cache-dir={}".format(tmp_path / "lto"),
+    ]
+    driver.set_lto("off")
+    assert not any(
+        x.startswith("-flto") for x in driver.compile_args("a.c", "a.o")
+    )
+
+
+def test_linker_probe_cache(tmp_path, fake_gcc):
+    # mold is installed but unusable, gold echoes lines of collect2 first.
+    fake_gcc.write_text(
+        "#!/bin/sh\necho probed >> {}\n"
+        'case "$1" in\n'
+        "-fuse-ld=mold) exit 1;;\n"
+        "-fuse-ld=gold) printf 'collect2 version 1.0\\n"
+        "/usr/bin/ld.gold --version\\nGNU gold 1.16\\n'; exit 0;;\n"
+        "esac\necho 'fake-gcc (GCC) 1.0 gcc'\n".format(tmp_path / "count")
+    )
+    for name in ("ld.gold", "ld.mold"):
+        (fake_gcc.parent / name).write_text("")
+    probes = ProbeCache(tmp_path / "probes.json")
+    driver = adapt_compiler("fake-gcc", probes)
+    assert probe_linker(driver, "gold", probes) == "GNU gold 1.16"
+    assert probe_linker(driver, "mold", probes) is None
+    assert probes_count(fake_gcc) == 3
+    probes.save()
+
+    # A warm build probes nothing, usable or not.
+    probes = ProbeCache(tmp_path / "probes.json")
+    driver = adapt_compiler("fake-gcc", probes)
+    assert probe_linker(driver, "mold", probes) is None
+    assert probe_linker(driver, "gold", probes) == "GNU gold 1.16"
+    assert probes_count(fake_gcc) == 3
+
+    # The answer depends on the compiler too.
+    driver.version = "fake-gcc (GCC) 2.0 gcc"
+    assert probe_linker(driver, "mold", probes) is None
+    assert probes_count(fake_gcc) == 4
+
+
+@pytest.mark.parametrize(
+    "first_line,adapted",
+    [
+        ("g++ (Debian 12.2.0-14) 12.2.0", True),
+        ("c++ (GCC) 12.2.0", True),
+        ("clang version 15.0.0", True),
+        ("GNU ld (GNU Binutils) 2.40", False),
+        ("GNU Make 4.3", False),
+    ],
+)
+def test_adapts(tmp_path, first_line, adapted):
+    program = tmp_path / "cc"
+    program.write_text(
+        "#!/bin/sh\necho '{}'\n"
+        "echo 'Copyright (C) 2022 Free Software Foundation, Inc.'\n".format(
+            first_line
+        )
+    )
+    program.chmod(0o755)
+    assert GCC().adapts(program) is adapted
@@ -0,0 +1,197 @@
+import shutil
+import subprocess
+import sys
+import pytest
+from cfpm import console
+from cfpm.packages import Constraint, parse_version
+from click.testing import CliRunner
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("git") is None, reason="git is not found"
+)
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for role in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv("GIT_{}_NAME".format(role), "cfpm")
+        monkeypatch.setenv("GIT_{}_EMAIL".format(role), "cfpm@example.com")
+
+
+def git(cwd, *args):
+    subprocess.run(
+        ["git"] + list(args), cwd=cwd, check=True, capture_output=True
+    )
+
+
+def make_package(tmp_path, name, versions, library=False):
+    """Create a bare repository tagging each of versions."""
+    work = tmp_path / "work" / name
+    work.mkdir(parents=True)
+    git(work, "init", "-q")
+    for (version, dependencies) in versions.items():
+        content = '[package]\nname = "{}"\nversion = "{}"\n'.format(
+            name, version
+        )
+        if library:
+            # A static library returning the major version
+            content += '\n[[targets]]\ndir = "src"\nname = "{}"\n'.format(
+                name
+            )
+            (work / "src").mkdir(exist_ok=True)
+            (work / "src" / (name + ".toml")).write_text(
+                '[target]\ntype = "lib"\nsources = ["."]\nheaders = ["."]\n'
+            )
+            (work / "src" / (name + ".c")).write_text(
+                "int {}_major(void) {{ return {}; }}\n".format(
+                    name, version.split(".")[0]
+                )
+            )
+            (work / "src" / (name + "_lib.h")).write_text(
+                "int {}_major(void);\n".format(name)
+            )
+        if dependencies:
+            content += "\n[dependencies]\n" + "".join(
+                '{} = {{ git = "{}", version = "{}" }}\n'.format(
+                    dep, tmp_path / "repos" / (dep + ".git"), constraint
+                )
+                for (dep, constraint) in dependencies.items()
+            )
+        (work / "cfpm.toml").write_text(content)
+        (work / "{}.h".format(name)).write_text("// {}\n".format(version))
+        git(work, "add", "-A")
+        git(work, "commit", "-q", "-m", version)
+        git(work, "tag", "v" + version)
+    bare = tmp_path / "repos" / (name + ".git")
+    git(tmp_path, "clone", "-q", "--bare", str(work), str(bare))
+    return bare
+
+
+def add_dependency(package, name, url, constraint):
+    with open(package / "cfpm.toml", "a") as f:
+        f.write(
+            '\n[dependencies]\n{} = {{ git = "{}", version = "{}" }}\n'.format(
+                name, url, constraint
+            )
+        )
+
+
+@pytest.mark.parametrize(
+    "constraint,allowed,denied",
+    [
+        ("^1.2", ["1.2.0", "1.9.3"], ["1.1.9", "2.0.0", "1.3.0-rc.1"]),
+        ("^0.2.3", ["0.2.3", "0.2.9"], ["0.3.0", "0.2.2"]),
+        ("~1.2.3", ["1.2.3", "1.2.8"], ["1.3.0"]),
+        ("1.*", ["1.0.0", "1.8.0"], ["2.0.0", "0.9.0"]),
+        (">=1.0, <1.5, !=1.2.0", ["1.0.0", "1.4.9"], ["1.2.0", "1.5.0"]),
+        ("=1.2", ["1.2.5"], ["1.3.0"]),
+        ("*", ["0.0.1", "5.0.0"], ["1.0.0-alpha"]),
+    ],
+)
+def test_constraint(constraint, allowed, denied):
+    c = Constraint(constraint)
+    assert all(c.allows(parse_version(x)) for x in allowed)
+    assert not any(c.allows(parse_version(x)) for x in denied)
+
+
+def test_bad_constraint():
+    for text in ["^x", ">=1.*", "1.2.3.4"]:
+        with pytest.raises(ValueError):
+            Constraint(text)
+
+
+def test_fetch(tmp_path, package):
+    make_package(tmp_path, "base", {"1.0.0": {}, "1.1.0": {}, "2.0.0": {}})
+    app = make_package(
+        tmp_path,
+        "app",
+        {"0.1.0": {"base": "^1.0"}, "0.2.0": {"base": ">=2.0"}},
+    )
+    # app 0.2.0 needs base 2, so the newest app with base 1 is 0.1.0.
+    add_dependency(package, "app", app, "^0.1")
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["fetch"])
+    assert result.exit_code == 0, result.output
+    lock = (package / "cfpm.lock").read_text()
+    assert 'version = "0.1.0"' in lock
+    assert 'version = "1.1.0"' in lock
+    header = package / "build" / "deps" / "base" / "base.h"
+    assert header.read_text() == "// 1.1.0\n"
+    store = tmp_path / "home" / "packages" / "objects"
+    inode = header.stat().st_ino
+    assert any(x.stat().st_ino == inode for x in store.glob("*/*"))
+    assert header.stat().st_nlink == 2
+
+    # The lockfile keeps the versions after new releases.
+    work = tmp_path / "work" / "base"
+    (work / "base.h").write_text("// 1.2.0\n")
+    git(work, "commit", "-q", "-am", "1.2.0")
+    git(work, "tag", "v1.2.0")
+    git(work, "push", "-q", str(tmp_path / "repos" / "base.git"), "v1.2.0")
+    result = runner.invoke(console.cli, ["fetch"])
+    assert result.exit_code == 0, result.output
+    assert "Installed" not in result.output
+    assert header.read_text() == "// 1.1.0\n"
+
+    result = runner.invoke(console.cli, ["fetch", "--update"])
+    assert result.exit_code == 0, result.output
+    assert header.read_text() == "// 1.2.0\n"
+    assert 'version = "1.2.0"' in (package / "cfpm.lock").read_text()
+
+
+def test_unresolvable(tmp_path, package):
+    base = make_package(tmp_path, "base", {"1.0.0": {}})
+    add_dependency(package, "base", base, "^2")
+    result = CliRunner().invoke(console.cli, ["fetch"])
+    assert result.exit_code != 0
+    assert "No version of base matches ^2" in result.output
+
+
+def use_base(project, base):
+    add_dependency(project, "base", base, "^2")
+    (project / "src" / "main.cpp").write_text(
+        'extern "C" {\n#include "base_lib.h"\n}\n'
+        "int main() { return base_major(); }\n"
+    )
+    with open(project / "src" / "hello.toml", "a") as f:
+        f.write('deps = ["base"]\n')
+    return build_with_base(project)
+
+
+def build_with_base(project):
+    runner = CliRunner()
+    result = runner.invoke(console.cli, ["fetch"])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(console.cli, ["build", "--no-daemon"])
+    assert result.exit_code == 0, result.output
+    hello = subprocess.run([str(project / "build" / "hello")])
+    assert hello.returncode == 2
+    return result.output
+
+
+@pytest.mark.skipif(
+    shutil.which("gcc") is None or sys.platform == "win32",
+    reason="needs gcc",
+)
+def test_prebuilt(tmp_path, package, monkeypatch):
+    base = make_package(tmp_path, "base", {"2.0.0": {}}, library=True)
+    monkeypatch.setenv("CFPM_ARTIFACTS_REMOTE", str(tmp_path / "remote"))
+    output = use_base(package, base)
+    assert "Building package base 2.0.0" in output
+    assert list((tmp_path / "remote").iterdir())
+    result = CliRunner().invoke(console.cli, ["build", "--no-daemon"])
+    assert "base" not in result.output
+
+    # Another project uses the libraries built by the first one.
+    monkeypatch.chdir(tmp_path)
+    assert CliRunner().invoke(console.cli, ["new", "other"]).exit_code == 0
+    monkeypatch.chdir(tmp_path / "other")
+    output = use_base(tmp_path / "other", base)
+    assert "Using prebuilt base 2.0.0" in output
+    assert "base.c" not in output
+
+    # And so does a machine with only the remote tier.
+    shutil.rmtree(tmp_path / "home" / "artifacts")
+    shutil.rmtree(tmp_path / "other" / "build")
+    output = build_with_base(tmp_path / "other")
+    assert "Using prebuilt base 2.0.0" in output
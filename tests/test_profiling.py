@@ -0,0 +1,35 @@
+import json
+import shutil
+import pytest
+from cfpm import console
+from cfpm.profiling import Tracer
+from click.testing import CliRunner
+
+
+def test_tracer_disabled():
+    tracer = Tracer()
+    with tracer.span("nothing"):
+        pass
+    assert tracer.events == []
+    tracer.enable()
+    with tracer.span("something", "compile"):
+        pass
+    assert [x[0] for x in tracer.slowest("compile", 5)] == ["something"]
+
+
+@pytest.mark.skipif(shutil.which("gcc") is None, reason="gcc is not found")
+def test_build_trace(package):
+    runner = CliRunner()
+    result = runner.invoke(
+        console.cli,
+        ["build", "-j", "2", "--trace", "trace.json", "--timings", "1"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Compiling" in result.output
+    with open(package / "trace.json", "r") as f:
+        events = json.load(f)["traceEvents"]
+    categories = {x.get("cat") for x in events}
+    assert {"build", "config", "compile", "link", "process"} <= categories
+    lanes = {x["tid"] for x in events if x.get("cat") == "compile"}
+    assert lanes <= {1, 2}
+    assert "s compile " in result.output
@@ -0,0 +1,81 @@
+import shutil
+import subprocess
+import threading
+import pytest
+from cfpm import console
+from cfpm.remote import LOAD_TTL, Worker, WorkerPool, parse_address
+from click.testing import CliRunner
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("gcc") is None or shutil.which("g++") is None,
+    reason="gcc is not found",
+)
+
+
+@pytest.fixture
+def workers():
+    """Start two workers on localhost."""
+    servers = []
+    for _ in range(2):
+        server = Worker(jobs=1).server(("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield ["127.0.0.1:{}".format(x.server_address[1]) for x in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_parse_address():
+    assert parse_address("localhost:3633") == ("localhost", 3633)
+    assert parse_address("[::1]:80") == ("::1", 80)
+    assert parse_address("unix:/tmp/cfpm.sock") == "/tmp/cfpm.sock"
+    with pytest.raises(ValueError):
+        parse_address("localhost")
+
+
+def test_pool(workers):
+    pool = WorkerPool(workers + ["127.0.0.1:1"])
+    assert len(pool.workers) == 2
+    assert pool.capacity() == 2
+    pool.close()
+
+
+def test_load(workers):
+    header, data = Worker(jobs=1).handle(
+        {"op": "compile", "language": "c", "standard": "c99"}, b"int x;\n"
+    )
+    assert header["returncode"] == 0 and data
+    assert header["running"] == 0
+
+    pool = WorkerPool(workers)
+    busy, idle = pool.workers
+    version = busy.versions["c"]
+    # Another client fills the only slot of the first worker.
+    busy.report(1)
+    assert pool._acquire("c", version) is idle
+    assert pool._acquire("c", version) is None
+    pool._release(idle, 0)
+    # Reports go stale, so the worker is tried again.
+    busy.reported -= LOAD_TTL + 1
+    assert pool._acquire("c", version) is busy
+    pool.close()
+
+
+def test_remote_build(package, workers):
+    (package / "src" / "bad.c").write_text("int x = ;\n")
+    runner = CliRunner()
+    args = ["-v", "DEBUG", "build", "--no-cache"]
+    args += ["--workers", ",".join(workers)]
+    result = runner.invoke(console.cli, args)
+    assert result.exit_code == 1
+    assert "error: expected expression" in result.output
+    assert "on 127.0.0.1" in result.output
+
+    (package / "src" / "bad.c").unlink()
+    result = runner.invoke(console.cli, args + ["--keep-going"])
+    assert result.exit_code == 0, result.output
+    output = subprocess.run(
+        [str(package / "build" / "hello")], capture_output=True, text=True
+    )
+    assert output.stdout == "Hello there!"
@@ -0,0 +1,112 @@
+import threading
+import time
+import pytest
+from cfpm.exceptions import ExternalProgramError
+from cfpm.scheduler import DurationHistory, Job, ResourceHistory, Scheduler
+
+
+def fail():
+    raise ExternalProgramError("failed")
+
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_dependencies(use_asyncio):
+    order = []
+
+    async def b_async():
+        order.append("b")
+
+    a = Job("a", lambda: order.append("a"))
+    b = Job("b", fail, (), b_async)
+    c = Job("c", lambda: order.append("c"), [a, b])
+    scheduler = Scheduler(jobs=2, use_asyncio=use_asyncio)
+    failed = scheduler.run([c, a, b])
+    if use_asyncio:
+        assert failed == []
+        assert order[-1] == "c"
+        assert all(job.state == Job.DONE for job in (a, b, c))
+    else:
+        assert failed == [b]
+        assert c.state == Job.SKIPPED
+
+
+def test_failure():
+    bad = Job("bad", fail)
+    after = Job("after", lambda: None, [bad])
+    other = Job("other", lambda: None)
+    assert Scheduler(jobs=1).run([bad, other, after]) == [bad]
+    assert after.state == Job.SKIPPED
+    assert other.state == Job.SKIPPED
+
+    bad = Job("bad", fail)
+    after = Job("after", lambda: None, [bad])
+    other = Job("other", lambda: None)
+    failed = Scheduler(jobs=1, keep_going=True).run([bad, other, after])
+    assert failed == [bad]
+    assert after.state == Job.SKIPPED
+    assert other.state == Job.DONE
+
+
+def test_critical_path(tmp_path):
+    history = DurationHistory(tmp_path / "durations.json")
+    history.record("short", 1.0)
+    history.record("long", 5.0)
+    history.record("last", 5.0)
+    history.save()
+    history = DurationHistory(tmp_path / "durations.json")
+    assert history.estimate("long") == 5.0
+    assert history.estimate("unknown") == pytest.approx(11.0 / 3)
+
+    order = []
+    short = Job("short", lambda: order.append("short"))
+    long = Job("long", lambda: order.append("long"))
+    last = Job("last", lambda: order.append("last"), [long])
+    Scheduler(jobs=1, history=history).run([short, long, last])
+    assert order == ["long", "last", "short"]
+    # Moving towards the fast durations measured by the run
+    assert history.estimate("long") < 5.0
+
+
+def test_unchanged_not_recorded():
+    history = DurationHistory()
+    Scheduler(jobs=1, history=history).run([Job("noop", lambda: False)])
+    assert "noop" not in history.durations
+
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_mem_limit(tmp_path, use_asyncio):
+    resources = ResourceHistory(tmp_path / "resources.json")
+    for name in ("a", "b", "c"):
+        resources.record(name, 600 << 20, 1.0)
+    resources.record("small", 100 << 20, 1.0)
+    resources.save()
+    resources = ResourceHistory(tmp_path / "resources.json")
+    assert resources.predict("a") == 600 << 20
+    assert resources.predict("unknown") == 475 << 20
+
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def action(name):
+        def run():
+            with lock:
+                running.append(name)
+                peak.append(list(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(name)
+
+        return run
+
+    jobs = [Job(x, action(x)) for x in ("a", "b", "c", "small")]
+    scheduler = Scheduler(
+        jobs=4,
+        use_asyncio=use_asyncio,
+        resources=resources,
+        mem_limit=1 << 30,
+    )
+    assert scheduler.run(jobs) == []
+    # Two heavy jobs never run together, a light one fits besides.
+    assert max(len(x) for x in peak) == 2
+    assert all(sum(y != "small" for y in x) == 1 for x in peak)
@@ -0,0 +1,79 @@
+import os
+import pytest
+from cfpm.projects import SOURCE_SUFFIXES
+from cfpm.sources import SourceFinder, glob_regex
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for name in [
+        "main.c",
+        "a/a.cpp",
+        "a/a.h",
+        "a/b/b.c",
+        "a/b/b_test.c",
+        "third_party/x/x.c",
+    ]:
+        path = tmp_path / "src" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    return tmp_path / "src"
+
+
+def names(tree, sources):
+    return [x.relative_to(tree).as_posix() for x in sources]
+
+
+def test_glob_regex():
+    assert glob_regex("**/*.c").match("a/b/c.c")
+    assert glob_regex("**/*.c").match("c.c")
+    assert not glob_regex("*.c").match("a/c.c")
+    assert glob_regex("a/[!x]?.c").match("a/yz.c")
+    assert not glob_regex("a/[!x]?.c").match("a/xz.c")
+
+
+def test_find(tree):
+    finder = SourceFinder()
+    assert names(tree, finder.find(tree, ["."], SOURCE_SUFFIXES)) == [
+        "a/a.cpp",
+        "a/b/b.c",
+        "a/b/b_test.c",
+        "main.c",
+        "third_party/x/x.c",
+    ]
+    sources = finder.find(
+        tree,
+        ["main.c", "a/**/*.c*"],
+        SOURCE_SUFFIXES,
+        ["third_party", "**/*_test.c"],
+    )
+    assert names(tree, sources) == ["main.c", "a/a.cpp", "a/b/b.c"]
+    assert finder.find(tree, ["."], SOURCE_SUFFIXES, ["a", "*.c", "t*"]) == []
+    with pytest.raises(RuntimeError):
+        finder.find(tree, ["missing.c"], SOURCE_SUFFIXES)
+
+
+def test_index(tree, tmp_path, monkeypatch):
+    # Old enough not to be racy
+    for (d, _, _) in os.walk(tree):
+        os.utime(d, ns=(0, 0))
+    finder = SourceFinder(tmp_path / "sources.json")
+    first = finder.find(tree, ["."], SOURCE_SUFFIXES)
+    finder.save()
+
+    scanned = []
+    real_scandir = os.scandir
+
+    def scandir(path):
+        scanned.append(path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", scandir)
+    finder = SourceFinder(tmp_path / "sources.json")
+    assert finder.find(tree, ["."], SOURCE_SUFFIXES) == first
+    assert scanned == []
+
+    (tree / "a" / "b" / "new.c").write_text("")
+    sources = finder.find(tree, ["."], SOURCE_SUFFIXES)
+    assert scanned == [str(tree / "a" / "b")]
+    assert tree / "a" / "b" / "new.c" in sources
@@ -0,0 +1,61 @@
+import subprocess
+import sys
+from typing import Dict
+
+# Budget of importing everything needed by cfpm version, in microseconds,
+# the interpreter's own imports included.
+# It's generous since CI machines are slow, the imports below are what
+# matter.
+STARTUP_BUDGET = 300_000
+
+# Heavy modules only needed by some subcommands
+HEAVY_MODULES = [
+    "tomlkit",
+    "asyncio",
+    "git",
+    "cfpm.projects",
+    "cfpm.remote",
+    "logging.handlers",
+]
+
+
+def import_times(*args: str) -> Dict[str, int]:
+    """
+    Self import time of every module from python -X importtime.
+
+    Self times add up to the total, cumulative times would count modules
+    once for every package importing them.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "cfpm.console"]
+        + list(args),
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    times: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, _, name = line.split("|")
+        times[name.strip()] = int(self_time.split(":")[1])
+    return times
+
+
+def test_version_startup():
+    times = import_times("version")
+    assert "cfpm.console" in times
+    for module in HEAVY_MODULES:
+        assert module not in times, "{} is imported".format(module)
+    assert sum(times.values()) < STARTUP_BUDGET
+
+
+def test_help_lists_commands():
+    result = subprocess.run(
+        [sys.executable, "-m", "cfpm.console", "--help"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0
+    for command in ["build", "cache", "new", "version", "worker"]:
+        assert command in result.stdout
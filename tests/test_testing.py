@@ -0,0 +1,106 @@
+import json
+import sys
+import xml.etree.ElementTree as ET
+import pytest
+from cfpm import console, testing
+from click.testing import CliRunner
+
+
+def test_shard():
+    assert testing.parse_shard("2/4") == (2, 4)
+    for text in ["0/4", "5/4", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            testing.parse_shard(text)
+    names = ["t{}".format(i) for i in range(7)]
+    shards = [testing.shard(names[::-1], i, 3) for i in (1, 2, 3)]
+    assert sorted(sum(shards, [])) == names
+    assert [len(x) for x in shards] == [3, 2, 2]
+
+
+def test_order(tmp_path):
+    history = testing.TestHistory(tmp_path / "tests.json")
+    for (name, outcome, seconds) in [
+        ("fast", testing.PASSED, 0.1),
+        ("slow", testing.PASSED, 5.0),
+        ("broken", testing.FAILED, 0.2),
+    ]:
+        history.record_result(testing.TestResult(name, outcome, seconds, ""))
+    history.save()
+    history = testing.TestHistory(tmp_path / "tests.json")
+    assert history.order(["fast", "slow", "broken"]) == [
+        "broken",
+        "slow",
+        "fast",
+    ]
+    history.record_result(
+        testing.TestResult("broken", testing.PASSED, 0.2, "")
+    )
+    assert history.order(["fast", "broken"]) == ["broken", "fast"]
+    assert history.order(["fast", "slow", "broken"])[0] == "slow"
+
+
+def add_test(package, name, code, config=""):
+    (package / name).mkdir()
+    (package / name / (name + ".c")).write_text(
+        "#include <stdio.h>\n#include <unistd.h>\n" + code
+    )
+    (package / name / (name + ".toml")).write_text(
+        '[target]\ntype = "test"\nsources = ["."]\n' + config
+    )
+    with open(package / "cfpm.toml", "a") as f:
+        f.write('\n[[targets]]\ndir = "{0}"\nname = "{0}"\n'.format(name))
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs unistd.h")
+def test_test(package):
+    add_test(
+        package,
+        "passing",
+        "int main(int argc, char **argv) { return argc != 2; }\n",
+        'args = ["x"]\n',
+    )
+    add_test(
+        package,
+        "failing",
+        'int main() { puts("expected 1 \\x01"); return 1; }\n',
+    )
+    add_test(
+        package,
+        "hanging",
+        "int main() { sleep(60); return 0; }\n",
+        "timeout = 0.5\n",
+    )
+    runner = CliRunner()
+    report = package / "report.xml"
+    result = runner.invoke(console.cli, ["test", "--junit", str(report)])
+    assert result.exit_code != 0
+    assert "1 passed, 2 failed." in result.output
+    assert "Timed out" in result.output
+    # Only the tests are built.
+    assert not (package / "build" / "hello").exists()
+
+    suite = ET.parse(report).getroot().find("testsuite")
+    assert suite.get("tests") == "3" and suite.get("failures") == "2"
+    failures = {
+        x.get("name"): x.find("failure") for x in suite.iter("testcase")
+    }
+    assert failures["passing"] is None
+    assert failures["failing"].get("type") == "failed"
+    assert failures["hanging"].get("type") == "timeout"
+    history = json.loads((package / "build" / "tests.json").read_text())
+    assert set(history["failures"]) == {"failing", "hanging"}
+
+    # The failed tests run first, and so do the longest ones.
+    result = runner.invoke(
+        console.cli, ["test", "-j", "1", "passing", "failing", "hanging"]
+    )
+    assert result.output.index("hanging") < result.output.index("passing")
+
+    result = runner.invoke(console.cli, ["test", "--shard", "3/3"])
+    assert result.exit_code == 0, result.output
+    assert "PASS passing" in result.output
+    assert "failing" not in result.output
+
+    result = runner.invoke(console.cli, ["test", "hello"])
+    assert result.exit_code != 0
+    assert "Target hello is not a test." in result.output